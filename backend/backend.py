@@ -1,6 +1,6 @@
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, HTTPException, Response
 import argparse
-import time
+import asyncio
 
 # Create the FastAPI instance
 app = FastAPI()
@@ -18,7 +18,7 @@ async def read_health(response: Response):
 
 @app.get("/task1")
 async def read_task1(response: Response):
-    time.sleep(5)
+    await asyncio.sleep(5)
     response.status_code = 200
     return {"message": "Task 1 completed"}
 
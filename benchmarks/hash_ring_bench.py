@@ -0,0 +1,66 @@
+"""Per-request cost of ip-hash selection as the fleet grows.
+
+Run from the repository root:
+    python3 benchmarks/hash_ring_bench.py
+"""
+import argparse, json, os, random, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from server import BackendServer
+from lb_algo import LBAlgo
+
+def build_fleet(size: int):
+    servers = [BackendServer(f"10.{i // 65536}.{i // 256 % 256}.{i % 256}", 8080, 1) for i in range(size)]
+    healthy_servers = set()
+    lb_algo = LBAlgo(servers, healthy_servers, "ip-hash")
+    # Like the initial health screen, the whole fleet turns healthy in one batch
+    with lb_algo.hash_ring.batch():
+        for server in servers:
+            healthy_servers.add(server)
+            lb_algo.on_health_change(server, True)
+    return servers, lb_algo
+
+def bench(size: int, lookups: int) -> dict:
+    start = time.perf_counter()
+    servers, lb_algo = build_fleet(size)
+    build_ms = (time.perf_counter() - start) * 1000
+    ips = [f"{random.randint(1, 223)}.{random.randint(0, 255)}.{random.randint(0, 255)}.{random.randint(0, 255)}" for _ in range(lookups)]
+
+    start = time.perf_counter()
+    for ip in ips:
+        lb_algo.get_next_server(ip=ip)
+    per_lookup_us = (time.perf_counter() - start) / lookups * 1e6
+
+    # Cost of one server leaving and re-joining the ring
+    start = time.perf_counter()
+    lb_algo.on_health_change(servers[0], False)
+    lb_algo.on_health_change(servers[0], True)
+    update_ms = (time.perf_counter() - start) * 1000
+
+    return {
+        "servers": size,
+        "ring_points": len(lb_algo.hash_ring.keys),
+        "build_ms": round(build_ms, 2),
+        "lookup_us": round(per_lookup_us, 3),
+        "health_flap_ms": round(update_ms, 2)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ip-hash server selection")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[3, 50, 500, 5000])
+    parser.add_argument("--lookups", type=int, default=100000)
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    results = [bench(size, args.lookups) for size in args.sizes]
+    if args.json:
+        print(json.dumps(results))
+        return
+
+    print(f"{'servers':>8} {'points':>8} {'build ms':>10} {'lookup us':>10} {'flap ms':>10}")
+    for r in results:
+        print(f"{r['servers']:>8} {r['ring_points']:>8} {r['build_ms']:>10} {r['lookup_us']:>10} {r['health_flap_ms']:>10}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,415 @@
+"""End-to-end throughput, latency and CPU cost of the balancer.
+
+Starts local stand-in backends in a separate process, runs the balancer
+for every engine and lb_method asked for and drives it with a built-in
+load generator, either closed-loop at a fixed concurrency or open-loop at
+a fixed request rate. Open-loop latencies are measured from the time a
+request was scheduled, so a stalled balancer can't hide its queueing.
+
+Run from the repository root:
+    python3 benchmarks/proxy_bench.py
+    python3 benchmarks/proxy_bench.py --engines fastapi raw --methods round-robin ewma --rate 2000 --json
+"""
+import argparse, asyncio, json, math, multiprocessing, os, random, signal, subprocess, sys, tempfile, time
+
+import httptools
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+class Latency:
+    """Backend response time distribution, e.g. `fixed:5`, `uniform:1:10`, `exp:5` or `lognormal:5:0.5` in ms."""
+    def __init__(self, spec: str):
+        kind, *params = spec.split(":")
+        self.spec = spec
+        self.kind = kind
+        self.params = [float(param) / 1000 for param in params]
+        if kind == "lognormal":
+            # The median is given in ms, sigma is unitless
+            self.params[1] *= 1000
+        expected = {"fixed": 1, "uniform": 2, "exp": 1, "lognormal": 2}
+        if expected.get(kind) != len(self.params):
+            raise ValueError(f"[BenchError] Unknown latency distribution: {spec}")
+
+    def sample(self, rng: random.Random) -> float:
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "exp":
+            return rng.expovariate(1 / self.params[0]) if self.params[0] else 0.0
+        median, sigma = self.params
+        return rng.lognormvariate(math.log(median), sigma) if median else 0.0
+
+
+class BackendProtocol(asyncio.Protocol):
+    """Minimal HTTP/1.1 stand-in backend, answers after a sampled delay."""
+    def __init__(self, latency: Latency, error_rate: float, payload: bytes, rng: random.Random):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.payload = payload
+        self.rng = rng
+        self.parser = httptools.HttpRequestParser(self)
+        self.transport = None
+        self.url = b""
+        # Responses go out in request order even if their delays differ
+        self.pending = 0
+        self.ready = {}
+        self.next_id = 0
+        self.next_to_send = 0
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        try:
+            self.parser.feed_data(data)
+        except httptools.HttpParserError:
+            self.transport.close()
+
+    def on_url(self, url: bytes) -> None:
+        self.url = url
+
+    def on_message_complete(self) -> None:
+        request_id = self.next_id
+        self.next_id += 1
+        keep_alive = self.parser.should_keep_alive()
+
+        if self.url.startswith(b"/health"):
+            self.respond(request_id, 200, b"ok", keep_alive)
+            return
+
+        status = 500 if self.rng.random() < self.error_rate else 200
+        body = b"error" if status == 500 else self.payload
+        delay = self.latency.sample(self.rng)
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.respond, request_id, status, body, keep_alive)
+        else:
+            self.respond(request_id, status, body, keep_alive)
+
+    def respond(self, request_id: int, status: int, body: bytes, keep_alive: bool) -> None:
+        reason = b"OK" if status == 200 else b"Internal Server Error"
+        head = b"HTTP/1.1 %d %s\r\ncontent-type: application/octet-stream\r\ncontent-length: %d\r\n" % (status, reason, len(body))
+        if not keep_alive:
+            head += b"connection: close\r\n"
+        self.ready[request_id] = (head + b"\r\n" + body, keep_alive)
+
+        while self.next_to_send in self.ready and not self.transport.is_closing():
+            data, keep_alive = self.ready.pop(self.next_to_send)
+            self.next_to_send += 1
+            self.transport.write(data)
+            if not keep_alive:
+                self.transport.close()
+
+
+def run_backends(ports, latency_spec: str, error_rate: float, payload_size: int, ready) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if uvloop is not None:
+        uvloop.install()
+
+    async def serve():
+        loop = asyncio.get_running_loop()
+        latency = Latency(latency_spec)
+        payload = b"x" * payload_size
+        servers = []
+        for i, port in enumerate(ports):
+            rng = random.Random(port)
+            servers.append(await loop.create_server(
+                lambda rng=rng: BackendProtocol(latency, error_rate, payload, rng), "127.0.0.1", port, backlog=2048
+            ))
+        ready.set()
+        await asyncio.gather(*[server.serve_forever() for server in servers])
+
+    asyncio.run(serve())
+
+
+class ClientConnection:
+    """Keep-alive HTTP/1.1 client connection, one request at a time."""
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.done = False
+
+    @classmethod
+    async def open(cls, host: str, port: int) -> "ClientConnection":
+        reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def on_message_complete(self) -> None:
+        self.done = True
+
+    async def request(self, raw: bytes):
+        self.done = False
+        parser = httptools.HttpResponseParser(self)
+        self.writer.write(raw)
+        while not self.done:
+            data = await self.reader.read(65536)
+            if not data:
+                raise ConnectionError("Connection closed mid-response")
+            parser.feed_data(data)
+        return parser.get_status_code(), parser.should_keep_alive()
+
+    def close(self) -> None:
+        self.writer.close()
+
+
+class LoadResult:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.dropped = 0
+
+    def record(self, status: int, latency: float) -> None:
+        self.latencies.append(latency)
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+
+async def send(host: str, port: int, raw: bytes, connection: ClientConnection, result: LoadResult, started: float):
+    try:
+        if connection is None:
+            connection = await ClientConnection.open(host, port)
+        status, keep_alive = await connection.request(raw)
+        result.record(status, time.perf_counter() - started)
+        if keep_alive:
+            return connection
+        connection.close()
+    except (OSError, ConnectionError, httptools.HttpParserError):
+        result.errors += 1
+        if connection is not None:
+            connection.close()
+    return None
+
+async def closed_loop(host: str, port: int, raw: bytes, concurrency: int, duration: float) -> LoadResult:
+    result = LoadResult()
+    deadline = time.perf_counter() + duration
+
+    async def client():
+        connection = None
+        while time.perf_counter() < deadline:
+            connection = await send(host, port, raw, connection, result, time.perf_counter())
+        if connection is not None:
+            connection.close()
+
+    await asyncio.gather(*[client() for _ in range(concurrency)])
+    return result
+
+async def open_loop(host: str, port: int, raw: bytes, rate: float, duration: float, max_in_flight: int) -> LoadResult:
+    result = LoadResult()
+    idle = []
+    in_flight = 0
+
+    async def one(scheduled: float):
+        nonlocal in_flight
+        connection = await send(host, port, raw, idle.pop() if idle else None, result, scheduled)
+        if connection is not None:
+            idle.append(connection)
+        in_flight -= 1
+
+    tasks = set()
+    start = time.perf_counter()
+    for i in range(int(rate * duration)):
+        scheduled = start + i / rate
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if in_flight >= max_in_flight:
+            # The balancer fell this far behind, count it instead of queueing without bound
+            result.dropped += 1
+            continue
+        in_flight += 1
+        task = asyncio.ensure_future(one(scheduled))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    if tasks:
+        await asyncio.gather(*tasks)
+    for connection in idle:
+        connection.close()
+    return result
+
+
+def process_tree_cpu(pid: int) -> float:
+    """User plus system CPU seconds of `pid` and its live descendants, None off Linux."""
+    try:
+        stats = {}
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        fields = f.read().rsplit(")", 1)[1].split()
+                except OSError:
+                    continue
+                # ppid, utime and stime after the state field
+                stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    except OSError:
+        return None
+
+    tree = {pid}
+    changed = True
+    while changed:
+        changed = False
+        for child, (ppid, _) in stats.items():
+            if ppid in tree and child not in tree:
+                tree.add(child)
+                changed = True
+    return sum(stats[p][1] for p in tree if p in stats) / CLOCK_TICKS
+
+def percentile(latencies, q: float) -> float:
+    if not latencies:
+        return None
+    return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 3)
+
+def wait_until_ready(host: str, port: int, raw: bytes, timeout: float) -> None:
+    async def probe():
+        deadline = time.perf_counter() + timeout
+        while time.perf_counter() < deadline:
+            try:
+                connection = await ClientConnection.open(host, port)
+                status, _ = await connection.request(raw)
+                connection.close()
+                if status < 500:
+                    return
+            except (OSError, ConnectionError, httptools.HttpParserError):
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"[BenchError] Balancer didn't come up on port {port}")
+
+    asyncio.run(probe())
+
+def run_case(args, engine: str, lb_method: str, backend_ports, workdir: str) -> dict:
+    with open(os.path.join(REPO_DIR, "config.json")) as f:
+        config = json.load(f)
+    config.update({
+        "upstream": [{"domain": f"http://127.0.0.1:{port}", "weight": 1} for port in backend_ports],
+        "listen": args.port,
+        "engine": engine,
+        "lb_method": lb_method,
+        "workers": args.workers,
+        "config_reload": False
+    })
+    for override in args.set:
+        key, value = override.split("=", 1)
+        config[key] = json.loads(value)
+
+    config_path = os.path.join(workdir, f"{engine}-{lb_method}.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f)
+
+    log = open(os.path.join(workdir, f"{engine}-{lb_method}.log"), "w")
+    lb = subprocess.Popen(
+        [sys.executable, os.path.join(REPO_DIR, "src", "main.py")],
+        env={**os.environ, "LB_CONFIG": config_path}, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    host = "127.0.0.1"
+    raw = f"GET {args.path} HTTP/1.1\r\nhost: {host}:{args.port}\r\n\r\n".encode()
+    try:
+        wait_until_ready(host, args.port, raw, timeout=30)
+
+        async def load(duration: float) -> LoadResult:
+            if args.rate:
+                return await open_loop(host, args.port, raw, args.rate, duration, args.concurrency)
+            return await closed_loop(host, args.port, raw, args.concurrency, duration)
+
+        asyncio.run(load(args.warmup))
+
+        cpu_start = process_tree_cpu(lb.pid)
+        started = time.perf_counter()
+        result = asyncio.run(load(args.duration))
+        elapsed = time.perf_counter() - started
+        cpu_end = process_tree_cpu(lb.pid)
+    finally:
+        lb.send_signal(signal.SIGINT)
+        try:
+            lb.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            lb.kill()
+            lb.wait()
+        log.close()
+
+    latencies = sorted(result.latencies)
+    requests = len(latencies)
+    ok = sum(count for status, count in result.statuses.items() if status < 400)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        "engine": engine,
+        "lb_method": lb_method,
+        "workers": args.workers,
+        "load": {"mode": "open", "rate": args.rate} if args.rate else {"mode": "closed", "concurrency": args.concurrency},
+        "duration_s": round(elapsed, 3),
+        "requests": requests,
+        "ok": ok,
+        "errors": result.errors + requests - ok,
+        "dropped": result.dropped,
+        "throughput_rps": round(requests / elapsed, 1),
+        "latency_ms": {
+            "p50": percentile(latencies, 0.50),
+            "p90": percentile(latencies, 0.90),
+            "p99": percentile(latencies, 0.99),
+            "p999": percentile(latencies, 0.999),
+            "max": round(latencies[-1] * 1000, 3) if latencies else None,
+            "mean": round(sum(latencies) / requests * 1000, 3) if requests else None
+        },
+        "lb_cpu_s": round(cpu, 3) if cpu is not None else None,
+        "cpu_us_per_request": round(cpu / requests * 1e6, 1) if cpu is not None and requests else None
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the balancer end to end against local stand-in backends")
+    parser.add_argument("--engines", nargs="+", default=["fastapi", "raw"], choices=["fastapi", "raw"])
+    parser.add_argument("--methods", nargs="+", default=["round-robin", "least-connections", "ewma"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--backends", type=int, default=4, help="Number of stand-in backends")
+    parser.add_argument("--backend-port", type=int, default=9100, help="Port of the first backend")
+    parser.add_argument("--latency", default="fixed:1", help="Backend latency in ms: fixed:MS, uniform:MIN:MAX, exp:MEAN or lognormal:MEDIAN:SIGMA")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Share of backend responses that are 500s")
+    parser.add_argument("--payload", type=int, default=1024, help="Backend response body size in bytes")
+    parser.add_argument("--port", type=int, default=8000, help="Port the balancer listens on")
+    parser.add_argument("--path", default="/bench")
+    parser.add_argument("--concurrency", type=int, default=64, help="Connections for closed-loop load, in-flight cap for open-loop load")
+    parser.add_argument("--rate", type=float, default=0, help="Open-loop requests per second, closed-loop when 0")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--warmup", type=float, default=2)
+    parser.add_argument("--set", nargs="*", default=[], metavar="KEY=JSON", help="Config overrides, e.g. proxy_mode='\"buffered\"' access_log=false")
+    parser.add_argument("--json", action="store_true", help="Print machine-readable results")
+    args = parser.parse_args()
+
+    if uvloop is not None:
+        uvloop.install()
+
+    backend_ports = [args.backend_port + i for i in range(args.backends)]
+    ready = multiprocessing.Event()
+    backends = multiprocessing.Process(
+        target=run_backends, args=(backend_ports, args.latency, args.error_rate, args.payload, ready), daemon=True
+    )
+    backends.start()
+    if not ready.wait(10):
+        raise RuntimeError("[BenchError] Stand-in backends didn't start")
+
+    results = []
+    try:
+        with tempfile.TemporaryDirectory(prefix="lb-bench-") as workdir:
+            for engine in args.engines:
+                for lb_method in args.methods:
+                    results.append(run_case(args, engine, lb_method, backend_ports, workdir))
+                    if not args.json:
+                        r = results[-1]
+                        print(f"{engine:>8} {lb_method:>20} {r['throughput_rps']:>10} rps  p50 {r['latency_ms']['p50']} ms  "
+                              f"p99 {r['latency_ms']['p99']} ms  p999 {r['latency_ms']['p999']} ms  "
+                              f"{r['cpu_us_per_request']} cpu us/req  {r['errors']} errors", flush=True)
+    finally:
+        backends.terminate()
+        backends.join()
+
+    if args.json:
+        print(json.dumps(results))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json, os, random, sys, threading, time
+from collections import deque
+
+LOG_LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+
+class AccessRecord:
+    """Filled in while a sampled request is handled, written once it is answered."""
+    __slots__ = ("method", "path", "client", "status", "upstream", "retries", "upstream_time", "cache", "started")
+
+    def __init__(self, method: str, path: str, client: str):
+        self.method = method
+        self.path = path
+        self.client = client
+        self.status = 0
+        self.upstream = None
+        self.retries = 0
+        self.upstream_time = None
+        self.cache = None
+        self.started = time.perf_counter()
+
+    def to_dict(self, ts: float, total_time: float) -> dict:
+        entry = {
+            "ts": round(ts, 6),
+            "type": "access",
+            "method": self.method,
+            "path": self.path,
+            "client": self.client,
+            "status": self.status,
+            "upstream": self.upstream,
+            "retries": self.retries,
+            "total_ms": round(total_time * 1000, 3),
+        }
+        if self.upstream_time is not None:
+            entry["upstream_ms"] = round(self.upstream_time * 1000, 3)
+        if self.cache is not None:
+            entry["cache"] = self.cache
+        return entry
+
+class AccessLog:
+    """Structured JSON lines written by a background thread.
+
+    The event loop only appends to a bounded deque, the thread wakes up every
+    `flush_interval` seconds, encodes what piled up and writes it in one
+    batch. Access records are sampled with `sample_rate` and events below
+    `level` are dropped before anything is built, so a disabled log costs an
+    attribute check per request.
+    """
+    def __init__(self, config: dict):
+        self.enabled = config['access_log']
+        self.sample_rate = config['access_log_sample_rate'] if self.enabled else 0.0
+        self.level = LOG_LEVELS[config['log_level']]
+        self.path = config['log_file']
+        self.flush_interval = config['log_flush_interval']
+        self.max_queue = config['log_queue_size']
+
+        self.queue = deque()
+        self.dropped = 0
+        self.written = 0
+        self.thread: threading.Thread = None
+        self.stopped = threading.Event()
+        self.pid = None
+
+    def start(self) -> None:
+        # Threads don't survive a fork, every worker starts its own writer
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.stopped.set()
+        self.thread.join()
+        self.thread = None
+        self.pid = None
+
+    def sample(self, method: str, path: str, client: str) -> AccessRecord:
+        if self.sample_rate <= 0 or (self.sample_rate < 1 and random.random() >= self.sample_rate):
+            return None
+        return AccessRecord(method, path, client)
+
+    def access(self, record: AccessRecord) -> None:
+        now = time.perf_counter()
+        self.put(record.to_dict(time.time(), now - record.started))
+
+    def is_enabled_for(self, level: str) -> bool:
+        return LOG_LEVELS[level] >= self.level
+
+    def event(self, level: str, message: str, **fields) -> None:
+        if LOG_LEVELS[level] < self.level:
+            return
+        entry = {"ts": round(time.time(), 6), "type": "event", "level": level, "message": message}
+        entry.update(fields)
+        self.put(entry)
+
+    def put(self, entry: dict) -> None:
+        # Never block the event loop, a full queue means the writer can't keep up
+        if len(self.queue) >= self.max_queue:
+            self.dropped += 1
+            return
+        self.queue.append(entry)
+
+    def run(self) -> None:
+        stream = open(self.path, "a", buffering=1 << 16) if self.path else sys.stdout
+        try:
+            while not self.stopped.wait(self.flush_interval):
+                self.flush(stream)
+            self.flush(stream)
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+
+    def flush(self, stream) -> None:
+        queue = self.queue
+        if not queue:
+            return
+
+        lines = []
+        while queue:
+            lines.append(json.dumps(queue.popleft(), separators=(",", ":"), default=str))
+        stream.write("\n".join(lines) + "\n")
+        stream.flush()
+        self.written += len(lines)
+
+    def get_stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "sample_rate": self.sample_rate,
+            "level": next(name for name, value in LOG_LEVELS.items() if value == self.level),
+            "queued": len(self.queue),
+            "written": self.written,
+            "dropped": self.dropped
+        }
@@ -0,0 +1,223 @@
+import asyncio
+from collections import deque
+from functools import partial
+from fastapi import HTTPException
+from starlette.responses import PlainTextResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Callable, Deque, Optional, Set, TypeVar
+from server import BackendServer
+from lb_algo import LBAlgo
+from metrics import Metrics
+from streaming import is_event_stream
+
+T = TypeVar("T")
+
+class Overloaded(HTTPException):
+    """Answered with 503 and Retry-After when a request can't be queued or waited too long."""
+    def __init__(self, retry_after: int):
+        super().__init__(status_code=503, detail="Overloaded, retry later.", headers={"Retry-After": str(retry_after)})
+
+class WaitQueue:
+    """FIFO of requests waiting for capacity, woken one at a time."""
+    def __init__(self):
+        self.waiters: Deque[asyncio.Future] = deque()
+
+    def __len__(self) -> int:
+        return len(self.waiters)
+
+    def wake(self) -> None:
+        waiters = self.waiters
+        while waiters:
+            waiter = waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def discard(self, waiter: asyncio.Future) -> None:
+        try:
+            self.waiters.remove(waiter)
+        except ValueError:
+            pass
+
+class AdmissionControl:
+    """Global and per-backend concurrency limits with bounded queueing.
+
+    At most `max_inflight` requests are handled at once and no backend gets
+    more than its `max_connections`. Requests over a limit wait in FIFO
+    order for up to `queue_timeout` seconds. Once `queue_size` requests are
+    waiting, new ones are shed right away with a 503 instead of piling onto
+    saturated backends until they time out.
+
+    Waking a request doesn't hand it a slot, it takes one by checking again,
+    so a request that was cancelled while being woken can't leak capacity.
+    """
+    def __init__(self, lb_algo: LBAlgo, config: dict, metrics: Metrics):
+        self.lb_algo = lb_algo
+        self.metrics = metrics
+        self.inflight = 0
+        self.admission_queue = WaitQueue()
+        self.backend_queue = WaitQueue()
+        self.update_config(config)
+
+    def update_config(self, config: dict) -> None:
+        self.max_inflight = config['max_inflight']
+        self.queue_size = config['queue_size']
+        self.queue_timeout = config['queue_timeout']
+        self.retry_after = config['retry_after']
+        # Skips the capacity checks entirely while no backend has a limit
+        self.limited = any(server.max_connections for server in self.lb_algo.servers)
+
+        # Limits may have gone up, woken requests wake the next one while there is room
+        self.admission_queue.wake()
+        self.backend_queue.wake()
+
+    async def wait(self, queue: WaitQueue, check: Callable[[], Optional[T]]) -> T:
+        """Waits in `queue` until `check` returns something, rechecking whenever capacity frees up."""
+        if len(self.admission_queue) + len(self.backend_queue) >= self.queue_size:
+            self.metrics.shed += 1
+            raise Overloaded(self.retry_after)
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.queue_timeout
+        self.metrics.queued += 1
+        try:
+            requeue = False
+            while True:
+                waiter = loop.create_future()
+                if requeue:
+                    # Woken but the capacity was taken, keep our place at the front
+                    queue.waiters.appendleft(waiter)
+                else:
+                    queue.waiters.append(waiter)
+
+                timer = loop.call_at(deadline, self.expire, waiter)
+                try:
+                    await waiter
+                except asyncio.TimeoutError:
+                    queue.discard(waiter)
+                    self.metrics.queue_timeouts += 1
+                    raise Overloaded(self.retry_after) from None
+                except asyncio.CancelledError:
+                    queue.discard(waiter)
+                    if waiter.done() and not waiter.cancelled():
+                        # Woken just before the client went away, pass it on
+                        queue.wake()
+                    raise
+                finally:
+                    timer.cancel()
+
+                result = check()
+                if result is not None:
+                    if queue.waiters:
+                        queue.wake()
+                    return result
+                requeue = True
+        finally:
+            self.metrics.queued -= 1
+
+    def expire(self, waiter: asyncio.Future) -> None:
+        if not waiter.done():
+            waiter.set_exception(asyncio.TimeoutError())
+
+    # Global limit, held from accepting a request until its response is sent
+    async def admit(self) -> None:
+        if not self.max_inflight or (self.inflight < self.max_inflight and not self.admission_queue.waiters):
+            self.inflight += 1
+            return
+        await self.wait(self.admission_queue, self.try_admit)
+
+    def try_admit(self) -> Optional[bool]:
+        if not self.max_inflight or self.inflight < self.max_inflight:
+            self.inflight += 1
+            return True
+        return None
+
+    def release(self) -> None:
+        self.inflight -= 1
+        if self.admission_queue.waiters:
+            self.admission_queue.wake()
+
+    # Per-backend limit, checked when a server is picked for an attempt
+    def has_capacity(self, server: BackendServer) -> bool:
+        return not server.max_connections or server.active_connections < server.max_connections
+
+    def pick(self, ip: str = None, exclude: Set[BackendServer] = None) -> Optional[BackendServer]:
+        if not self.lb_algo.healthy_list:
+            raise HTTPException(status_code=503, detail="No healthy servers available.")
+
+        server = self.lb_algo.get_next_server(ip=ip, exclude=exclude)
+        if not self.limited or self.has_capacity(server):
+            return server
+
+        # Try the other healthy servers before queueing, the algorithm decides the order
+        skipped = set(exclude) if exclude else set()
+        while True:
+            skipped.add(server)
+            server = self.lb_algo.get_next_server(ip=ip, exclude=skipped)
+            # Exclusion is ignored once every healthy server is excluded
+            if server in skipped:
+                return None
+            if self.has_capacity(server):
+                return server
+
+    async def get_server(self, ip: str = None, exclude: Set[BackendServer] = None) -> BackendServer:
+        server = self.pick(ip, exclude)
+        if server is None:
+            server = await self.wait(self.backend_queue, partial(self.pick, ip, exclude))
+        return server
+
+    # Registered as the LBAlgo release listener
+    def on_release(self, server: BackendServer) -> None:
+        if server.max_connections and self.backend_queue.waiters:
+            self.backend_queue.wake()
+
+    # Registered as a HealthCheck listener, recovered servers add capacity and
+    # queued requests shouldn't wait out their timeout once none are left
+    def on_health_change(self, server: BackendServer, healthy: bool) -> None:
+        if self.backend_queue.waiters:
+            self.backend_queue.wake()
+
+    def get_stats(self, metrics: Metrics) -> dict:
+        return {
+            "in_flight": metrics.in_flight,
+            "max_inflight": self.max_inflight,
+            "queued": metrics.queued,
+            "queue_size": self.queue_size,
+            "queue_timeout": self.queue_timeout,
+            "shed": metrics.shed,
+            "queue_timeouts": metrics.queue_timeouts,
+            "backends": [
+                {
+                    "url": server.get_url(),
+                    "active_connections": server.active_connections,
+                    "max_connections": server.max_connections
+                }
+                for server in self.lb_algo.servers
+            ]
+        }
+
+class AdmissionMiddleware:
+    """Holds every proxied request to `max_inflight`, including while its response streams.
+
+    Event streams are left to LongLivedConnections, like WebSockets.
+    """
+    def __init__(self, app: ASGIApp, admission: AdmissionControl):
+        self.app = app
+        self.admission = admission
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or is_event_stream(scope["headers"]):
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await self.admission.admit()
+        except Overloaded as e:
+            response = PlainTextResponse(e.detail, status_code=e.status_code, headers=e.headers)
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release()
@@ -0,0 +1,244 @@
+import asyncio, time, zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+from metrics import Metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Levels for compressing on the fly, close to what nginx and CDNs use: a
+# little less ratio for a lot less CPU than the maximum settings
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 4
+ZSTD_LEVEL = 3
+# Smaller inputs are compressed on the event loop, a hop to the thread pool costs more than the work
+INLINE_COMPRESS_BYTES = 4096
+# Distinct Accept-Encoding values remembered with their negotiated encoding
+NEGOTIATED_CACHE_SIZE = 1024
+# Response statuses that have no body or a partial one
+NO_COMPRESS_STATUS_CODES = {204, 206, 304}
+
+def timed(function: Callable[..., bytes], *args) -> Tuple[bytes, float]:
+    # CPU time of the calling thread, other threads' work isn't counted
+    started = time.thread_time()
+    result = function(*args)
+    return result, time.thread_time() - started
+
+class Encoder:
+    """One compressed stream, fed in order and finished once."""
+    __slots__ = ("compress", "finish", "size")
+
+    def __init__(self, encoding: str):
+        if encoding == "gzip":
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.compress, self.finish = compressor.compress, compressor.flush
+        elif encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self.compress, self.finish = compressor.process, compressor.finish
+        elif encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+            self.compress, self.finish = compressor.compress, compressor.flush
+        else:
+            raise ValueError(f"[CompressionError] Unsupported encoding: {encoding}")
+        # Bytes fed so far, decides whether finishing is worth the thread pool
+        self.size = 0
+
+class ResponseCompression:
+    """Compresses upstream responses for clients that accept it.
+
+    The encoding is negotiated from Accept-Encoding among the configured
+    ones that are installed. Responses are compressed as they are relayed,
+    on a small thread pool so the event loop keeps serving other requests
+    (zlib, brotli and zstd release the GIL while they work). Only responses
+    with an allowed content type and no content-encoding of their own are
+    touched, with `min_size` applying when the upstream sent a length.
+    """
+    def __init__(self, config: dict, metrics: Metrics):
+        self.enabled = config['compression']
+        self.metrics = metrics
+        self.min_size = config['compression_min_size']
+        self.threads = config['compression_threads']
+
+        self.encodings: List[str] = []
+        for encoding in config['compression_encodings']:
+            module = {"br": brotli, "zstd": zstandard}.get(encoding, zlib)
+            if module is None:
+                if self.enabled:
+                    print(f"[Compression] {'brotli' if encoding == 'br' else 'zstandard'} is not installed, not offering {encoding}")
+                continue
+            self.encodings.append(encoding)
+
+        # text/* style entries match a whole family
+        types = [content_type.lower().encode() for content_type in config['compression_types']]
+        self.types = {content_type for content_type in types if not content_type.endswith(b"/*")}
+        self.type_prefixes = tuple(content_type[:-1] for content_type in types if content_type.endswith(b"/*"))
+
+        self.negotiated: Dict[bytes, Optional[str]] = {}
+        # Started by the first compression, after workers were forked
+        self.executor: ThreadPoolExecutor = None
+
+    def negotiate(self, accept_encoding: Optional[bytes]) -> Optional[str]:
+        """The client's most preferred encoding, ties go to the configured order. None for identity."""
+        if not accept_encoding or not self.encodings:
+            return None
+        encoding = self.negotiated.get(accept_encoding, False)
+        if encoding is not False:
+            return encoding
+
+        accepted = {}
+        for part in accept_encoding.decode("latin-1").split(","):
+            name, _, params = part.partition(";")
+            q = 1.0
+            for param in params.split(";"):
+                key, _, value = param.partition("=")
+                if key.strip().lower() == "q":
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0.0
+            accepted[name.strip().lower()] = q
+
+        encoding = None
+        best = 0.0
+        for candidate in self.encodings:
+            q = accepted.get(candidate, accepted.get("*", 0.0))
+            if q > best:
+                encoding = candidate
+                best = q
+
+        if len(self.negotiated) >= NEGOTIATED_CACHE_SIZE:
+            self.negotiated.clear()
+        self.negotiated[accept_encoding] = encoding
+        return encoding
+
+    def negotiate_request(self, method: str, headers: List[Tuple[bytes, bytes]]) -> Optional[str]:
+        # HEAD responses have no body to compress, their headers must match the GET ones of an identity client
+        if not self.enabled or method == "HEAD":
+            return None
+        values = [value for name, value in headers if name.lower() == b"accept-encoding"]
+        return self.negotiate(b",".join(values)) if values else None
+
+    def should_compress(self, status_code: int, headers: List[Tuple[bytes, bytes]]) -> bool:
+        if status_code < 200 or status_code in NO_COMPRESS_STATUS_CODES:
+            return False
+
+        content_type = None
+        length = None
+        for name, value in headers:
+            name = name.lower()
+            if name == b"content-encoding":
+                if value.strip().lower() != b"identity":
+                    # Compressed by the upstream already, passed through as it is
+                    self.metrics.compression_passthrough += 1
+                    return False
+            elif name == b"content-type":
+                content_type = value
+            elif name == b"content-length":
+                length = value
+            elif name == b"cache-control" and b"no-transform" in value.lower():
+                return False
+
+        if content_type is None:
+            return False
+        mime = content_type.split(b";", 1)[0].strip().lower()
+        if mime not in self.types and not (self.type_prefixes and mime.startswith(self.type_prefixes)):
+            return False
+        try:
+            # Without a length the body is streamed and compressed whatever its size, like nginx
+            return length is None or int(length) >= self.min_size
+        except ValueError:
+            return False
+
+    def encode_headers(self, headers: List[Tuple[bytes, bytes]], encoding: str) -> List[Tuple[bytes, bytes]]:
+        """Response headers for the compressed body, the length is up to the caller."""
+        encoded = []
+        has_vary = False
+        for name, value in headers:
+            lowered = name.lower()
+            # Ranges would address the identity body
+            if lowered in (b"content-length", b"content-encoding", b"accept-ranges"):
+                continue
+            if lowered == b"etag" and not value.startswith(b"W/"):
+                # Different bytes, the validator can only stay a weak one
+                value = b"W/" + value
+            elif lowered == b"vary" and (b"accept-encoding" in value.lower() or value.strip() == b"*"):
+                has_vary = True
+            encoded.append((name, value))
+        encoded.append((b"content-encoding", encoding.encode()))
+        if not has_vary:
+            encoded.append((b"vary", b"Accept-Encoding"))
+        return encoded
+
+    async def run(self, function: Callable[..., bytes], size: int, *args) -> bytes:
+        if size < INLINE_COMPRESS_BYTES:
+            result, cpu = timed(function, *args)
+        else:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.threads, thread_name_prefix="compression")
+            result, cpu = await asyncio.get_running_loop().run_in_executor(self.executor, timed, function, *args)
+        self.metrics.compression_cpu_us += cpu * 1e6
+        return result
+
+    async def compress(self, encoder: Encoder, data: bytes) -> bytes:
+        encoder.size += len(data)
+        compressed = await self.run(encoder.compress, len(data), data)
+        self.metrics.compression_bytes_in += len(data)
+        self.metrics.compression_bytes_out += len(compressed)
+        return compressed
+
+    async def finish(self, encoder: Encoder) -> bytes:
+        # Whatever the compressor still holds, at most about one window of the input
+        compressed = await self.run(encoder.finish, encoder.size)
+        self.metrics.compression_bytes_out += len(compressed)
+        return compressed
+
+    def start(self, encoding: str) -> Encoder:
+        self.metrics.compressed += 1
+        return Encoder(encoding)
+
+    async def compress_stream(self, chunks: AsyncIterator[bytes], encoding: str) -> AsyncIterator[bytes]:
+        encoder = self.start(encoding)
+        async for chunk in chunks:
+            compressed = await self.compress(encoder, chunk)
+            if compressed:
+                yield compressed
+        compressed = await self.finish(encoder)
+        if compressed:
+            yield compressed
+
+    async def compress_body(self, body: bytes, encoding: str) -> bytes:
+        encoder = self.start(encoding)
+        # One hop for the whole body
+        compressed = await self.run(lambda: encoder.compress(body) + encoder.finish(), len(body))
+        self.metrics.compression_bytes_in += len(body)
+        self.metrics.compression_bytes_out += len(compressed)
+        return compressed
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def get_stats(self, metrics: Metrics) -> dict:
+        bytes_in = metrics.compression_bytes_in
+        bytes_out = metrics.compression_bytes_out
+        return {
+            "enabled": self.enabled,
+            "encodings": self.encodings,
+            "min_size": self.min_size,
+            "compressed_responses": metrics.compressed,
+            "passed_through_encoded": metrics.compression_passthrough,
+            "bytes_in": bytes_in,
+            "bytes_out": bytes_out,
+            "bytes_saved": bytes_in - bytes_out,
+            "ratio": round(bytes_out / bytes_in, 4) if bytes_in else None,
+            "cpu_seconds": round(metrics.compression_cpu_us / 1e6, 6),
+            "cpu_us_per_response": round(metrics.compression_cpu_us / metrics.compressed, 1) if metrics.compressed else None
+        }
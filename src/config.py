@@ -3,28 +3,45 @@ from cerberus import Validator
 import os
 
 
-def load_config() -> dict:
+def get_config_path() -> str:
+    # LB_CONFIG points at another config file, e.g. one generated by the benchmarks
+    if os.environ.get('LB_CONFIG'):
+        return os.environ['LB_CONFIG']
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    config_file = os.path.join(base_dir, '..', 'config.json')
-    with open(config_file) as f:
+    return os.path.join(base_dir, '..', 'config.json')
+
+def load_config() -> dict:
+    with open(get_config_path()) as f:
         config = json.load(f)
 
     return config
 
 class lbAlgorithm:
+    RANDOM = 'random'
     ROUND_ROBIN = 'round-robin'
     IP_HASH = 'ip-hash'
     WEIGHTED_ROUND_ROBIN = 'weighted-round-robin'
+    LEAST_CONNECTIONS = 'least-connections'
+    POWER_OF_TWO = 'power-of-two'
+    EWMA = 'ewma'
 
 def config_to_lbAlgorithm(lb_method: str) -> str:
-    if lb_method == 'round-robin':
+    if lb_method == 'random':
+        return lbAlgorithm.RANDOM
+    elif lb_method == 'round-robin':
         return lbAlgorithm.ROUND_ROBIN
     elif lb_method == 'ip-hash':
         return lbAlgorithm.IP_HASH
     elif lb_method == 'weighted-round-robin':
         return lbAlgorithm.WEIGHTED_ROUND_ROBIN
+    elif lb_method == 'least-connections':
+        return lbAlgorithm.LEAST_CONNECTIONS
+    elif lb_method == 'power-of-two':
+        return lbAlgorithm.POWER_OF_TWO
+    elif lb_method == 'ewma':
+        return lbAlgorithm.EWMA
     else:
-        raise ValueError(f"[ConfigError] Unknown lb_method: {lb_method}, must be one of 'round-robin', 'ip-hash', 'weighted-round-robin'")
+        raise ValueError(f"[ConfigError] Unknown lb_method: {lb_method}, must be one of 'random', 'round-robin', 'ip-hash', 'weighted-round-robin', 'least-connections', 'power-of-two', 'ewma'")
 
 # Validation schema for config.json
 config_schema = {
@@ -34,24 +51,95 @@ config_schema = {
             'type': 'dict',
             'schema': {
                 'domain': {'type': 'string', 'required': True},
-                'weight': {'type': 'integer', 'min': 1, 'nullable': True}
+                'weight': {'type': 'integer', 'min': 1, 'nullable': True},
+                'max_connections': {'type': 'integer', 'min': 0, 'nullable': True},
+                'http2': {'type': 'boolean', 'nullable': True}
             }
         }
     },
-    'lb_method': {'type': 'string', 'allowed': ['round-robin', 'ip-hash', 'weighted-round-robin', 'random'], 'required': True},
+    'lb_method': {'type': 'string', 'allowed': ['round-robin', 'ip-hash', 'weighted-round-robin', 'random', 'least-connections', 'power-of-two', 'ewma'], 'required': True},
+    'ewma_decay_time': {'type': 'number', 'min': 0.1, 'max': 3600, 'required': False},
+    'hash_ring_vnodes': {'type': 'integer', 'min': 1, 'max': 1000, 'required': False},
+    'slow_start': {'type': 'number', 'min': 0, 'max': 3600, 'required': False},
+    'slow_start_mode': {'type': 'string', 'allowed': ['linear', 'exponential'], 'required': False},
     'listen': {'type': 'integer', 'required': True},
+    'listen_http2': {'type': 'boolean', 'required': False},
+    'ssl_certfile': {'type': 'string', 'required': False, 'nullable': True},
+    'ssl_keyfile': {'type': 'string', 'required': False, 'nullable': True},
+    'proxy_mode': {'type': 'string', 'allowed': ['buffered', 'streaming'], 'required': False},
+    'engine': {'type': 'string', 'allowed': ['fastapi', 'raw'], 'required': False},
+    'workers': {'type': 'integer', 'min': 1, 'max': 256, 'required': False},
 
     'retries': {'type': 'integer', 'min': 0, 'required': True},
+    'retry_budget_ratio': {'type': 'number', 'min': 0, 'max': 10, 'required': False},
+    'retry_budget_min_per_second': {'type': 'number', 'min': 0, 'required': False},
+    'retry_backoff_base': {'type': 'number', 'min': 0, 'max': 60, 'required': False},
+    'retry_backoff_max': {'type': 'number', 'min': 0, 'max': 60, 'required': False},
+    'hedge': {'type': 'boolean', 'required': False},
+    'hedge_percentile': {'type': 'number', 'min': 1, 'max': 100, 'required': False},
+    'hedge_min_delay': {'type': 'number', 'min': 0, 'max': 60, 'required': False},
     'connect_timeout': {'type': 'integer', 'min': 0, 'max': 10000, 'required': False},
     'read_timeout': {'type': 'integer', 'min': 0, 'max': 10000, 'required': False},
     'send_timeout': {'type': 'integer', 'min': 0, 'max': 10000, 'required': False},
     'next_timeout': {'type': 'integer', 'min': 0, 'max': 10000, 'required': False},
 
+    'pool_max_connections': {'type': 'integer', 'min': 1, 'required': False},
+    'pool_max_keepalive': {'type': 'integer', 'min': 0, 'required': False},
+    'pool_keepalive_expiry': {'type': 'number', 'min': 0, 'max': 3600, 'required': False},
+    'prewarm_connections': {'type': 'integer', 'min': 0, 'max': 1000, 'required': False},
+
+    'max_inflight': {'type': 'integer', 'min': 0, 'required': False},
+    'backend_max_connections': {'type': 'integer', 'min': 0, 'required': False},
+    'queue_size': {'type': 'integer', 'min': 0, 'required': False},
+    'queue_timeout': {'type': 'number', 'min': 0, 'max': 300, 'required': False},
+    'retry_after': {'type': 'integer', 'min': 0, 'max': 3600, 'required': False},
+    'long_lived_idle_timeout': {'type': 'number', 'min': 0, 'required': False},
+    'long_lived_max_per_backend': {'type': 'integer', 'min': 0, 'required': False},
+    'stats_refresh_interval': {'type': 'number', 'min': 0.1, 'max': 60, 'required': False},
+
     'health_check_path': {'type': 'string', 'required': True},
     'health_check_timeout': {'type': 'integer', 'min': 0, 'max': 10, 'required': True},
     'health_check_fails': {'type': 'integer', 'min': 0, 'required': True},
     'health_check_pass': {'type': 'integer', 'min': 0, 'max': 10, 'required': True},
     'health_check_interval': {'type': 'integer', 'min': 0, 'max': 300 * 1000, 'required': True},
+    'health_check_concurrency': {'type': 'integer', 'min': 1, 'max': 10000, 'required': False},
+    'health_check_jitter': {'type': 'number', 'min': 0, 'max': 1, 'required': False},
+
+    'outlier_detection': {'type': 'boolean', 'required': False},
+    'outlier_consecutive_failures': {'type': 'integer', 'min': 1, 'required': False},
+    'outlier_error_rate': {'type': 'number', 'min': 0, 'max': 1, 'required': False},
+    'outlier_window': {'type': 'number', 'min': 1, 'max': 3600, 'required': False},
+    'outlier_min_requests': {'type': 'integer', 'min': 1, 'required': False},
+    'outlier_base_ejection_time': {'type': 'number', 'min': 0, 'max': 3600, 'required': False},
+    'outlier_max_ejection_time': {'type': 'number', 'min': 0, 'max': 3600, 'required': False},
+    'outlier_max_ejection_percent': {'type': 'integer', 'min': 0, 'max': 100, 'required': False},
+
+    'cache': {'type': 'boolean', 'required': False},
+    'cache_max_bytes': {'type': 'integer', 'min': 0, 'required': False},
+    'cache_max_entry_bytes': {'type': 'integer', 'min': 0, 'required': False},
+    'cache_default_ttl': {'type': 'number', 'min': 0, 'required': False},
+
+    'compression': {'type': 'boolean', 'required': False},
+    'compression_encodings': {'type': 'list', 'required': False, 'schema': {'type': 'string', 'allowed': ['zstd', 'br', 'gzip']}},
+    'compression_min_size': {'type': 'integer', 'min': 0, 'required': False},
+    'compression_types': {'type': 'list', 'required': False, 'schema': {'type': 'string'}},
+    'compression_threads': {'type': 'integer', 'min': 1, 'max': 64, 'required': False},
+
+    'sticky_sessions': {'type': 'string', 'allowed': ['off', 'cookie', 'header'], 'required': False},
+    'sticky_cookie': {'type': 'string', 'regex': '^[A-Za-z0-9_-]+$', 'required': False},
+    'sticky_header': {'type': 'string', 'regex': '^[A-Za-z0-9_-]+$', 'required': False},
+    'sticky_ttl': {'type': 'integer', 'min': 1, 'required': False},
+    'sticky_max_sessions': {'type': 'integer', 'min': 1, 'required': False},
+
+    'access_log': {'type': 'boolean', 'required': False},
+    'access_log_sample_rate': {'type': 'number', 'min': 0, 'max': 1, 'required': False},
+    'log_level': {'type': 'string', 'allowed': ['debug', 'info', 'warning', 'error'], 'required': False},
+    'log_file': {'type': 'string', 'required': False, 'nullable': True},
+    'log_flush_interval': {'type': 'number', 'min': 0.01, 'max': 60, 'required': False},
+    'log_queue_size': {'type': 'integer', 'min': 1, 'required': False},
+
+    'config_reload': {'type': 'boolean', 'required': False},
+    'reload_drain_timeout': {'type': 'number', 'min': 0, 'max': 3600, 'required': False},
 
     'send_alert_webhook': {'type': 'string', 'required': False, 'nullable': True, 'default': False},
     'alert_on_failure_streak': {'type': 'integer', 'min': 1, 'max': 100, 'required': False, 'default': 3},
@@ -65,6 +153,15 @@ def validate_config(config):
     if not v.validate(config):
         raise ValueError(f"[ConfigError] {v.errors}")
 
+    # The raw engine is a plain HTTP/1.1 pass-through on both sides
+    if config.get('engine') == 'raw':
+        if config.get('listen_http2') or config.get('ssl_certfile') or any(srv.get('http2') for srv in config['upstream']):
+            raise ValueError("[ConfigError] HTTP/2 and TLS need engine 'fastapi', the raw engine only speaks plaintext HTTP/1.1")
+
+    # Cached responses are relayed as the upstream sent them, buffered mode wraps responses in JSON instead
+    if config.get('cache') and config.get('proxy_mode', 'buffered') != 'streaming':
+        raise ValueError("[ConfigError] cache needs proxy_mode 'streaming', buffered mode answers with a JSON envelope")
+
     print("[Success] Validated Config")
     return True
 
@@ -73,19 +170,91 @@ def validate_config(config):
 def initialize_config(config: dict) -> dict:
     # Assign default values if not present
     config['lb_method'] = config.get('lb_method', 'round-robin')
+    config['hash_ring_vnodes'] = config.get('hash_ring_vnodes', 100)
+    config['ewma_decay_time'] = config.get('ewma_decay_time', 10)
+    config['slow_start'] = config.get('slow_start', 0)
+    config['slow_start_mode'] = config.get('slow_start_mode', 'linear')
     config['listen'] = config.get('listen', 80)
+    config['listen_http2'] = config.get('listen_http2', False)
+    config['ssl_certfile'] = config.get('ssl_certfile', None)
+    config['ssl_keyfile'] = config.get('ssl_keyfile', None)
+    config['proxy_mode'] = config.get('proxy_mode', 'buffered')
+    config['engine'] = config.get('engine', 'fastapi')
+    config['workers'] = config.get('workers', 1)
     
     config['retries'] = config.get('retries', 3)
-    config['connect_timeout'] = config.get('retry_interval', 5)
-    config['read_timeout'] = config.get('retry_interval', 5)
-    config['send_timeout'] = config.get('retry_interval', 5)
-    config['next_timeout'] = config.get('retry_interval', 5)
+    config['retry_budget_ratio'] = config.get('retry_budget_ratio', 0.2)
+    config['retry_budget_min_per_second'] = config.get('retry_budget_min_per_second', 10)
+    config['retry_backoff_base'] = config.get('retry_backoff_base', 0.025)
+    config['retry_backoff_max'] = config.get('retry_backoff_max', 1)
+    config['hedge'] = config.get('hedge', False)
+    config['hedge_percentile'] = config.get('hedge_percentile', 95)
+    config['hedge_min_delay'] = config.get('hedge_min_delay', 0.01)
+    config['connect_timeout'] = config.get('connect_timeout', 5)
+    config['read_timeout'] = config.get('read_timeout', 5)
+    config['send_timeout'] = config.get('send_timeout', 5)
+    config['next_timeout'] = config.get('next_timeout', 5)
+
+    config['pool_max_connections'] = config.get('pool_max_connections', 100)
+    config['pool_max_keepalive'] = config.get('pool_max_keepalive', 20)
+    config['pool_keepalive_expiry'] = config.get('pool_keepalive_expiry', 5)
+    config['prewarm_connections'] = config.get('prewarm_connections', 0)
+    
+    config['max_inflight'] = config.get('max_inflight', 0)
+    config['backend_max_connections'] = config.get('backend_max_connections', 0)
+    config['queue_size'] = config.get('queue_size', 1024)
+    config['queue_timeout'] = config.get('queue_timeout', 5)
+    config['retry_after'] = config.get('retry_after', 1)
+    config['long_lived_idle_timeout'] = config.get('long_lived_idle_timeout', 300)
+    config['long_lived_max_per_backend'] = config.get('long_lived_max_per_backend', 0)
+    config['stats_refresh_interval'] = config.get('stats_refresh_interval', 1)
     
     config['health_check_path'] = config.get('health_check_path', '/health')
     config['health_check_timeout'] = config.get('health_check_timeout', 2)
     config['health_check_fails'] = config.get('health_check_fails', 3)
     config['health_check_pass'] = config.get('health_check_pass', 2)
     config['health_check_interval'] = config.get('health_check_interval', 10)
+    config['health_check_concurrency'] = config.get('health_check_concurrency', 512)
+    config['health_check_jitter'] = config.get('health_check_jitter', 0.2)
+
+    config['outlier_detection'] = config.get('outlier_detection', False)
+    config['outlier_consecutive_failures'] = config.get('outlier_consecutive_failures', 5)
+    config['outlier_error_rate'] = config.get('outlier_error_rate', 0.5)
+    config['outlier_window'] = config.get('outlier_window', 10)
+    config['outlier_min_requests'] = config.get('outlier_min_requests', 20)
+    config['outlier_base_ejection_time'] = config.get('outlier_base_ejection_time', 30)
+    config['outlier_max_ejection_time'] = config.get('outlier_max_ejection_time', 300)
+    config['outlier_max_ejection_percent'] = config.get('outlier_max_ejection_percent', 50)
+
+    config['cache'] = config.get('cache', False)
+    config['cache_max_bytes'] = config.get('cache_max_bytes', 64 * 1024 * 1024)
+    config['cache_max_entry_bytes'] = config.get('cache_max_entry_bytes', 1024 * 1024)
+    config['cache_default_ttl'] = config.get('cache_default_ttl', 0)
+
+    config['compression'] = config.get('compression', False)
+    config['compression_encodings'] = config.get('compression_encodings', ['zstd', 'br', 'gzip'])
+    config['compression_min_size'] = config.get('compression_min_size', 1024)
+    config['compression_types'] = config.get('compression_types', [
+        'text/html', 'text/plain', 'text/css', 'text/csv', 'text/xml', 'text/javascript', 'application/javascript',
+        'application/json', 'application/x-ndjson', 'application/xml', 'application/problem+json', 'image/svg+xml'
+    ])
+    config['compression_threads'] = config.get('compression_threads', 2)
+
+    config['sticky_sessions'] = config.get('sticky_sessions', 'off')
+    config['sticky_cookie'] = config.get('sticky_cookie', 'lb_session')
+    config['sticky_header'] = config.get('sticky_header', 'X-LB-Session')
+    config['sticky_ttl'] = config.get('sticky_ttl', 3600)
+    config['sticky_max_sessions'] = config.get('sticky_max_sessions', 1000000)
+
+    config['access_log'] = config.get('access_log', True)
+    config['access_log_sample_rate'] = config.get('access_log_sample_rate', 1.0)
+    config['log_level'] = config.get('log_level', 'info')
+    config['log_file'] = config.get('log_file', None)
+    config['log_flush_interval'] = config.get('log_flush_interval', 0.2)
+    config['log_queue_size'] = config.get('log_queue_size', 65536)
+
+    config['config_reload'] = config.get('config_reload', True)
+    config['reload_drain_timeout'] = config.get('reload_drain_timeout', 30)
     
     config['alert_on_failure_streak'] = config.get('alert_on_failure_streak', 3)
     config['enableSelfHealing'] = config.get('enableSelfHealing', False)
@@ -0,0 +1,53 @@
+import asyncio, os, signal
+import config
+
+try:
+    from watchfiles import awatch
+except ImportError:
+    awatch = None
+
+class ConfigReloader:
+    """Reloads config.json on SIGHUP and, with watchfiles installed, whenever it changes.
+
+    A config that fails to load, validate or apply is logged and ignored,
+    the balancer keeps running with the one it has.
+    """
+    def __init__(self, lb):
+        self.lb = lb
+        self.path = config.get_config_path()
+        self.reloads = 0
+        self.failed_reloads = 0
+
+    def reload(self) -> None:
+        try:
+            new_config = config.initialize_config(config.load_config())
+            config.validate_config(new_config)
+            self.lb.apply_config(new_config)
+        except Exception as e:
+            # Also runs as a signal handler and in the watch loop, neither may die on a bad file
+            self.failed_reloads += 1
+            self.lb.access_log.event("error", "config reload failed, keeping the current config", error=repr(e))
+            return
+
+        self.reloads += 1
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self.reload)
+        try:
+            if awatch is None:
+                print("[ConfigReload] watchfiles is not installed, send SIGHUP to reload config.json")
+                await loop.create_future()
+
+            # Watch the directory, editors often replace the file instead of writing to it
+            path = os.path.realpath(self.path)
+            async for _ in awatch(os.path.dirname(path), watch_filter=lambda change, changed: os.path.realpath(changed) == path):
+                self.reload()
+        finally:
+            loop.remove_signal_handler(signal.SIGHUP)
+
+    def get_stats(self) -> dict:
+        return {
+            "reloads": self.reloads,
+            "failed_reloads": self.failed_reloads
+        }
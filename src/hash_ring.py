@@ -0,0 +1,136 @@
+import bisect, hashlib
+from contextlib import contextmanager
+from server import BackendServer
+from typing import Dict, Iterator, List, Optional, Set
+
+# Past this many changes in one batch a full rebuild is cheaper than merging server by server
+REBUILD_THRESHOLD = 8
+
+def stable_hash(key: str) -> int:
+    # hash() of str is randomized per process, workers and restarts must agree
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+def splice(keys: List[int], points: List[int], skip: int) -> List[int]:
+    """Copy of the sorted `keys` with the sorted `points` inserted (skip 0) or removed (skip 1).
+
+    Only the boundaries are found in Python, the runs between them are
+    copied as slices.
+    """
+    spliced = []
+    start = 0
+    for point in points:
+        i = bisect.bisect_left(keys, point, start)
+        spliced += keys[start:i]
+        if not skip:
+            spliced.append(point)
+        start = i + skip
+    spliced += keys[start:]
+    return spliced
+
+class HashRing:
+    """Consistent hash ring with `vnodes * weight` points per server.
+
+    Lookups are a bisect over the sorted points plus one dict lookup for
+    the owner. Membership changes are applied as they happen, a server's
+    points are kept sorted so adding or removing one is a bisect per point
+    and a single copy of the ring. Bursts of changes inside batch(), like the initial
+    screen of a large fleet, are applied with one rebuild when it exits.
+    """
+    def __init__(self, vnodes: int = 100):
+        if vnodes < 1:
+            raise ValueError("[HashRingError] vnodes must be at least 1")
+
+        self.vnodes = vnodes
+        self.keys: List[int] = []
+        self.owners: Dict[int, BackendServer] = {}
+        # Servers on the ring, in the order they were added
+        self.points: Dict[BackendServer, List[int]] = {}
+        # Changes seen by the running batch(), None outside one
+        self.batch_changes: Optional[int] = None
+
+    def __len__(self) -> int:
+        return len(self.points)
+
+    def server_points(self, server: BackendServer) -> List[int]:
+        # Cached on the server, a flapping server is rehashed only when its weight changed
+        count = self.vnodes * server.weight
+        points = server.ring_points
+        if points is None or len(points) != count:
+            url = server.url
+            points = server.ring_points = sorted(stable_hash(f"{url}#{i}") for i in range(count))
+        return points
+
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.points:
+            return
+        points = self.points[server] = self.server_points(server)
+        if self.defer():
+            return
+
+        owners = self.owners
+        # 64 bit points next to never collide, when they do the server that was there first keeps the point
+        added = [point for point in points if point not in owners]
+        owners.update(dict.fromkeys(added, server))
+        self.keys = splice(self.keys, added, 0)
+
+    def remove_server(self, server: BackendServer) -> None:
+        points = self.points.pop(server, None)
+        if points is None or self.defer():
+            return
+
+        owners = self.owners
+        removed = [point for point in points if owners.get(point) is server]
+        for point in removed:
+            del owners[point]
+        self.keys = splice(self.keys, removed, 1)
+
+    def defer(self) -> bool:
+        if self.batch_changes is None:
+            return False
+        self.batch_changes += 1
+        return self.batch_changes > REBUILD_THRESHOLD
+
+    @contextmanager
+    def batch(self) -> Iterator[None]:
+        """Past REBUILD_THRESHOLD changes in the block, the rest is left to one rebuild when it exits.
+
+        Lookups don't see the deferred changes until then, the block
+        mustn't be open while requests are being proxied.
+        """
+        if self.batch_changes is not None:
+            yield
+            return
+        self.batch_changes = 0
+        try:
+            yield
+        finally:
+            deferred = self.batch_changes > REBUILD_THRESHOLD
+            self.batch_changes = None
+            if deferred:
+                self.rebuild()
+
+    def rebuild(self) -> None:
+        # Walked newest first so the first server to claim a point keeps it, like add_server
+        self.owners = {point: server for server, points in reversed(self.points.items()) for point in points}
+        self.keys = sorted(self.owners)
+
+    def get_server(self, key: str, exclude: Set[BackendServer] = None) -> BackendServer:
+        keys = self.keys
+        if not keys:
+            return None
+
+        i = bisect.bisect(keys, stable_hash(key))
+        if i == len(keys):
+            i = 0
+
+        owners = self.owners
+        server = owners[keys[i]]
+        if exclude and server in exclude:
+            # Walk clockwise to the next point owned by a server that isn't excluded
+            for step in range(1, len(keys)):
+                server = owners[keys[(i + step) % len(keys)]]
+                if server not in exclude:
+                    return server
+            return None
+
+        return server
@@ -1,9 +1,10 @@
-import httpx, asyncio
+import httpx, asyncio, random, time
 from server import BackendServer, ServerStatus
-from typing import List, Set
+from access_log import AccessLog
+from typing import Awaitable, Callable, Dict, List, Set
 
 class HealthCheck:
-    def __init__(self, servers: List[BackendServer], healthy_servers: Set[BackendServer], config: dict):
+    def __init__(self, servers: List[BackendServer], healthy_servers: Set[BackendServer], config: dict, access_log: AccessLog):
 
         self.servers = servers
         self.healthy_servers = healthy_servers
@@ -11,69 +12,165 @@ class HealthCheck:
         self.timeout = config['health_check_timeout']
         self.fails = config['health_check_fails']
         self.passes = config['health_check_pass']
+        self.path = config['health_check_path']
+        self.concurrency = config['health_check_concurrency']
+        self.jitter = config['health_check_jitter']
+        self.access_log = access_log
 
+        # Pooled probe client and concurrency bound, created on the loop that runs the checks
+        self.client: httpx.AsyncClient = None
+        self.semaphore: asyncio.Semaphore = None
 
-        self.server_status = {server: {"healthy": True, "fail_count": 0, "pass_count": 0} for server in servers}
+        self.listeners: List[Callable[[BackendServer, bool], None]] = []
+        # Per server check loops while run_health_checks is running
+        self.tasks: Dict[BackendServer, asyncio.Task] = {}
+        # Awaited before a recovering server is marked healthy, e.g. to open connections to it
+        self.prewarm: Callable[[BackendServer], Awaitable[None]] = None
+        # Servers another process found healthy, warmed up in the background, see is_warm
+        self.warming: Dict[BackendServer, asyncio.Task] = {}
+
+    def add_listener(self, listener: Callable[[BackendServer, bool], None]) -> None:
+        self.listeners.append(listener)
+
+    # Single place where a server's health changes, healthy_servers follows server.health
+    def set_server_health(self, server: BackendServer, healthy: bool) -> None:
+        if healthy:
+            self.healthy_servers.add(server)
+            server.set_status(ServerStatus.HEALTHY)
+        else:
+            self.healthy_servers.discard(server)
+            server.set_status(ServerStatus.UNHEALTHY)
+
+        self.access_log.event("info", "health changed", upstream=server.get_url(), healthy=healthy)
+        for listener in self.listeners:
+            listener(server, healthy)
+
+    async def mark_healthy(self, server: BackendServer) -> None:
+        if self.prewarm is not None:
+            await self.prewarm(server)
+            # Ejected while its connections were being opened
+            if self.is_ejected(server):
+                return
+        self.set_server_health(server, True)
+
+    def is_warm(self, server: BackendServer) -> bool:
+        """Starts warming the server up in the background, True once that is done."""
+        if self.prewarm is None:
+            return True
+        task = self.warming.get(server)
+        if task is None:
+            self.warming[server] = asyncio.ensure_future(self.prewarm(server))
+            return False
+        if not task.done():
+            return False
+        del self.warming[server]
+        return True
+
+    def stop_warming(self, server: BackendServer) -> None:
+        task = self.warming.pop(server, None)
+        if task is not None:
+            task.cancel()
+
+    # Passive ejection from live traffic, probes can't bring the server back before `until`
+    def eject_server(self, server: BackendServer, until: float) -> None:
+        server.ejected_until = until
+        server.pass_count = 0
+        self.set_server_health(server, False)
+        server.increment_failures()
+
+    def is_ejected(self, server: BackendServer) -> bool:
+        return server.ejected_until > time.monotonic()
+
+    def create_client(self) -> httpx.AsyncClient:
+        limits = httpx.Limits(max_connections=self.concurrency, max_keepalive_connections=self.concurrency)
+        return httpx.AsyncClient(timeout=self.timeout, limits=limits)
 
     async def check_server(self, server) -> bool:
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(f"{server.get_url()}/health", timeout=self.timeout)
-                if response.status_code == 200:
-                    print(f"Server {server.get_url()} is healthy")
-                    return True
-            
-                print(f"Server {server.get_url()} is unhealthy")
-                return False
-
-        except (httpx.RequestError, httpx.TimeoutException):
-            print(f"Server {server.get_url()} is unavailable")
+            async with self.semaphore:
+                response = await self.client.get(f"{server.get_url()}{self.path}")
+            if response.status_code == 200:
+                self.access_log.event("debug", "health probe", upstream=server.get_url(), healthy=True)
+                return True
+
+            self.access_log.event("debug", "health probe", upstream=server.get_url(), healthy=False, status=response.status_code)
+            return False
+
+        except (httpx.RequestError, httpx.TimeoutException) as e:
+            self.access_log.event("debug", "health probe", upstream=server.get_url(), healthy=False, error=repr(e))
             return False
 
     async def perform_health_check(self, server) -> None:
        
         is_healthy = await self.check_server(server)
         if is_healthy:
-            self.server_status[server]["fail_count"] = 0
-            self.server_status[server]["pass_count"] += 1
+            server.fail_count = 0
+            server.pass_count += 1
             # Mark as healthy if it passes enough checks
-            if self.server_status[server]["pass_count"] >= self.passes and server not in self.healthy_servers:
-                self.server_status[server]["healthy"] = True
-                self.healthy_servers.add(server)
-                server.set_status(ServerStatus.HEALTHY)
+            if server.pass_count >= self.passes and server not in self.healthy_servers and not self.is_ejected(server):
+                await self.mark_healthy(server)
         else:
-            self.server_status[server]["fail_count"] += 1
-            self.server_status[server]["pass_count"] = 0
+            server.fail_count += 1
+            server.pass_count = 0
             # Mark as unhealthy if it fails enough checks
-            if self.server_status[server]["fail_count"] >= self.fails and server in self.healthy_servers:
-                self.server_status[server]["healthy"] = False
-                self.healthy_servers.remove(server)
-                server.set_status(ServerStatus.UNHEALTHY)
+            if server.fail_count >= self.fails and server in self.healthy_servers:
+                self.set_server_health(server, False)
                 server.increment_failures()
 
-    async def run_health_checks(self) -> None:
+    async def run_server_checks(self, server: BackendServer, initial: bool = False) -> None:
+        if initial:
+            # Servers added at runtime take traffic after their first passing probe,
+            # like the initial screen does for the servers we start with
+            if await self.check_server(server) and not self.is_ejected(server):
+                await self.mark_healthy(server)
+        # Spread the first probes over one interval and keep every server on its own
+        # jittered schedule so a large fleet isn't probed in one burst
+        await asyncio.sleep(random.uniform(0, self.interval))
         while True:
-            tasks = [self.perform_health_check(server) for server in self.servers]
-            await asyncio.gather(*tasks)
-            # Wait for the next round of health checks
-            await asyncio.sleep(self.interval)
+            await self.perform_health_check(server)
+            await asyncio.sleep(self.interval * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def run_health_checks(self) -> None:
+        self.client = self.create_client()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        for server in self.servers:
+            self.tasks[server] = asyncio.create_task(self.run_server_checks(server))
+        try:
+            # Runs until cancelled, servers can be added and removed in the meantime
+            await asyncio.get_running_loop().create_future()
+        finally:
+            for task in self.tasks.values():
+                task.cancel()
+            self.tasks.clear()
+            await self.client.aclose()
+
+    # Servers are added unhealthy and probed right away
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.tasks:
+            return
+        if self.client is not None and not self.client.is_closed:
+            self.tasks[server] = asyncio.create_task(self.run_server_checks(server, initial=True))
 
-            # print("Healthy Servers: ", self.get_healthy_servers())
+    def remove_server(self, server: BackendServer) -> None:
+        task = self.tasks.pop(server, None)
+        if task is not None:
+            task.cancel()
+        self.stop_warming(server)
+        if server in self.healthy_servers:
+            self.set_server_health(server, False)
 
     def get_healthy_servers(self) -> List[BackendServer]:
-        return [server for server, status in self.server_status.items() if status["healthy"]]
+        return [server for server in self.servers if server.health == ServerStatus.HEALTHY]
 
-    def initial_health_screen(self) -> None:
-        for server in self.servers:
-            try:
-                response = httpx.get(f"{server.get_url()}/health", timeout=0.5)
-                
-                if response.status_code == 200:
-                    self.healthy_servers.add(server)
-                    server.set_status(ServerStatus.HEALTHY)
-
-
-            except httpx.TimeoutException:
-                print(f"[TIMEOUT] {server} did not respond in time.")
-            except httpx.RequestError as exc:
-                print(f"[ERROR] Error occurred while requesting {server}: {exc}")
+    # One concurrent sweep, the whole fleet is screened in about one probe timeout
+    async def initial_health_screen(self) -> None:
+        self.client = self.create_client()
+        self.semaphore = asyncio.Semaphore(self.concurrency)
+        try:
+            results = await asyncio.gather(*[self.check_server(server) for server in self.servers])
+        finally:
+            await self.client.aclose()
+
+        for server, is_healthy in zip(self.servers, results):
+            if is_healthy:
+                self.set_server_health(server, True)
@@ -1,85 +1,450 @@
-import random, bisect
+import random, heapq, itertools, time, zlib
 from server import BackendServer
+from hash_ring import HashRing
 from enum import Enum
-from typing import List, Set
+from typing import Dict, List, Set
 
 class LoadBalancingAlgo(Enum):
     RANDOM = 1
     ROUND_ROBIN = 2
     IP_HASH = 3
+    WEIGHTED_ROUND_ROBIN = 4
+    LEAST_CONNECTIONS = 5
+    POWER_OF_TWO = 6
+    EWMA = 7
 
 algo_map = {
     "random": LoadBalancingAlgo.RANDOM,
     "round-robin": LoadBalancingAlgo.ROUND_ROBIN,
-    "ip-hash": LoadBalancingAlgo.IP_HASH
+    "ip-hash": LoadBalancingAlgo.IP_HASH,
+    "weighted-round-robin": LoadBalancingAlgo.WEIGHTED_ROUND_ROBIN,
+    "least-connections": LoadBalancingAlgo.LEAST_CONNECTIONS,
+    "power-of-two": LoadBalancingAlgo.POWER_OF_TWO,
+    "ewma": LoadBalancingAlgo.EWMA
 }
 
+# Cost of a server with requests in flight but no latency sample yet
+EWMA_PENALTY = 1e9
+# Share of its normal traffic a server gets right after it became healthy with slow start on
+SLOW_START_MIN_FACTOR = 0.05
+
+class WeightedRoundRobin:
+    """Earliest deadline first scheduling, O(log n) per pick.
+
+    Every server is due again 1/weight after it was picked, which interleaves
+    servers the same way nginx's smooth weighted round robin does instead of
+    sending a heavy server its whole share in a burst.
+    """
+    def __init__(self):
+        self.heap = []
+        self.entries: Dict[BackendServer, list] = {}
+        self.counter = itertools.count()
+        self.current_time = 0.0
+
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.entries:
+            return
+        # Start half a period in so equal weights spread out instead of bunching
+        entry = [self.current_time + 0.5 / server.weight, next(self.counter), server, True]
+        self.entries[server] = entry
+        heapq.heappush(self.heap, entry)
+
+    def remove_server(self, server: BackendServer) -> None:
+        entry = self.entries.pop(server, None)
+        if entry is not None:
+            # Dropped lazily when it reaches the top of the heap
+            entry[3] = False
+
+    def next_server(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        heap = self.heap
+        skipped = []
+        while heap and (not heap[0][3] or (exclude and heap[0][2] in exclude)):
+            entry = heapq.heappop(heap)
+            if entry[3]:
+                skipped.append(entry)
+
+        server = None
+        if heap:
+            entry = heap[0]
+            server = entry[2]
+            self.current_time = entry[0]
+            entry[0] += 1.0 / server.weight
+            entry[1] = next(self.counter)
+            heapq.heapreplace(heap, entry)
+
+        # Excluded servers keep their place in the schedule
+        for entry in skipped:
+            heapq.heappush(heap, entry)
+
+        return server
+
+class LeastConnections:
+    """Healthy servers bucketed by active connection count.
+
+    Connection counts only move by one, so keeping the buckets and the lowest
+    non-empty count up to date is O(1) per acquire/release and per pick.
+    """
+    def __init__(self):
+        self.buckets: Dict[int, Dict[BackendServer, None]] = {}
+        self.members: Dict[BackendServer, int] = {}
+        self.min_count = 0
+
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.members:
+            return
+        count = server.active_connections
+        self.members[server] = count
+        self.buckets.setdefault(count, {})[server] = None
+        if len(self.members) == 1 or count < self.min_count:
+            self.min_count = count
+
+    def remove_server(self, server: BackendServer) -> None:
+        count = self.members.pop(server, None)
+        if count is None:
+            return
+        self.discard(count, server)
+        if count == self.min_count and count not in self.buckets:
+            self.min_count = min(self.buckets) if self.buckets else 0
+
+    def discard(self, count: int, server: BackendServer) -> None:
+        bucket = self.buckets[count]
+        del bucket[server]
+        if not bucket:
+            del self.buckets[count]
+
+    def update(self, server: BackendServer) -> None:
+        old_count = self.members.get(server)
+        if old_count is None:
+            return
+        new_count = server.active_connections
+        self.members[server] = new_count
+        self.discard(old_count, server)
+        self.buckets.setdefault(new_count, {})[server] = None
+
+        if new_count < self.min_count:
+            self.min_count = new_count
+        elif old_count == self.min_count and old_count not in self.buckets:
+            self.min_count = new_count
+
+    def next_server(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        bucket = self.buckets.get(self.min_count)
+        if not bucket:
+            return None
+        if not exclude:
+            return next(iter(bucket))
+
+        for server in bucket:
+            if server not in exclude:
+                return server
+        # Only reached when every least loaded server is excluded
+        for count in sorted(self.buckets):
+            for server in self.buckets[count]:
+                if server not in exclude:
+                    return server
+
+        return None
+
 class LBAlgo:
-    def __init__(self, servers: List[BackendServer], healthy_servers: Set[BackendServer], algo_type: str):
+    def __init__(self, servers: List[BackendServer], healthy_servers: Set[BackendServer], algo_type: str, vnodes: int = 100, decay_time: float = 10.0,
+                 slow_start: float = 0.0, slow_start_mode: str = "linear"):
         
         algo_type_str = algo_type.lower().strip()
         if algo_type_str not in algo_map:
-            raise ValueError(f"[LBAlgoError] Unsupported algorithm type: {algo_type_str}, please enter either 'random', 'round-robin' or 'ip-hash'")
+            raise ValueError(f"[LBAlgoError] Unsupported algorithm type: {algo_type_str}, please enter one of {', '.join(algo_map)}")
         
         self.servers = servers
         self.healthy_servers = healthy_servers
         self.algo_type = algo_map[algo_type_str]
+        self.algo_name = algo_type_str
         self.round_robin_index = 0
+        self.decay_time = decay_time
+        # Called with the server after every release, e.g. to wake requests queued for capacity
+        self.release_listener = None
+
+        # Per algorithm views of the healthy servers, kept in sync by on_health_change
+        self.hash_ring = HashRing(vnodes)
+        self.weighted_round_robin = WeightedRoundRobin()
+        self.least_connections = LeastConnections()
+        self.healthy_list: List[BackendServer] = []
+        self.healthy_index: Dict[BackendServer, int] = {}
+        # Servers ramping up after becoming healthy and when they did, see slow_start_pick
+        self.slow_start = 0.0
+        self.slow_start_mode = slow_start_mode
+        self.ramping: Dict[BackendServer, float] = {}
+        with self.hash_ring.batch():
+            for server in healthy_servers:
+                self.on_health_change(server, True)
+        # Set after the initial servers, they take their full share right away
+        self.slow_start = slow_start
+
+    def get_next_server(self, ip: str = None, exclude: Set[BackendServer] = None) -> BackendServer:
+        """Picks a healthy server, skipping the ones in `exclude` (e.g. already tried by a retry).
+
+        If every healthy server is excluded the exclusion is ignored, so a
+        single healthy server can still be retried.
+        """
+        if exclude:
+            excluded_healthy = sum(1 for server in exclude if server in self.healthy_index)
+            if excluded_healthy >= len(self.healthy_list):
+                exclude = None
+
+        server = self.pick(ip, exclude)
+        # With every server ramping up together there is nowhere else for their traffic to go
+        if server in self.ramping and len(self.ramping) < len(self.healthy_list):
+            server = self.slow_start_pick(server, ip, exclude)
 
-    def get_next_server(self, ip: str = None) -> BackendServer:
+        return server
+
+    def pick(self, ip: str = None, exclude: Set[BackendServer] = None) -> BackendServer:
         if self.algo_type == LoadBalancingAlgo.RANDOM:
-            return self.random_algo()
+            return self.random_algo(exclude)
         elif self.algo_type == LoadBalancingAlgo.ROUND_ROBIN:
-            return self.round_robin_algo()
+            return self.round_robin_algo(exclude)
         elif self.algo_type == LoadBalancingAlgo.IP_HASH:
             if ip is None:
                 raise ValueError("[IPHashAlgoError] IP is required for IP Hashing")
-            return self.ip_hash_algo(ip)
+            return self.ip_hash_algo(ip, exclude)
+        elif self.algo_type == LoadBalancingAlgo.WEIGHTED_ROUND_ROBIN:
+            return self.weighted_round_robin_algo(exclude)
+        elif self.algo_type == LoadBalancingAlgo.LEAST_CONNECTIONS:
+            return self.least_connections_algo(exclude)
+        elif self.algo_type == LoadBalancingAlgo.POWER_OF_TWO:
+            return self.power_of_two_algo(exclude)
+        elif self.algo_type == LoadBalancingAlgo.EWMA:
+            return self.ewma_algo(exclude)
         else:
             raise ValueError("[LBAlgoError] Unknown load balancing algorithm")
 
-    def random_algo(self) -> BackendServer:
-        if not self.servers:
+    def slow_start_pick(self, server: BackendServer, ip: str, exclude: Set[BackendServer] = None) -> BackendServer:
+        """Keeps the pick of a ramping server with probability equal to its ramp factor, picks again without it otherwise.
+
+        Turning picks down scales the server's share the way scaling its
+        weight would, for every algorithm. ip-hash decides per client
+        instead of per request, a client moves over to the recovering
+        server once the factor passes its hash and stays there.
+        """
+        now = time.monotonic()
+        skipped = set(exclude) if exclude else set()
+        excluded_healthy = sum(1 for skipped_server in skipped if skipped_server in self.healthy_index)
+        while server in self.ramping and not self.slow_start_admits(server, ip, now):
+            skipped.add(server)
+            excluded_healthy += 1
+            if excluded_healthy >= len(self.healthy_list):
+                # Turned down by every server it could go to, the last one takes it
+                break
+            server = self.pick(ip, skipped)
+
+        return server
+
+    def slow_start_admits(self, server: BackendServer, ip: str, now: float) -> bool:
+        factor = self.slow_start_factor(server, now)
+        if factor >= 1.0:
+            self.ramping.pop(server, None)
+            return True
+        if ip is not None and self.algo_type == LoadBalancingAlgo.IP_HASH:
+            draw = zlib.crc32(ip.encode()) / 0x100000000
+        else:
+            draw = random.random()
+        return draw < factor
+
+    # Ramps from SLOW_START_MIN_FACTOR to 1 over the slow_start window, 1 for servers not ramping
+    def slow_start_factor(self, server: BackendServer, now: float) -> float:
+        started = self.ramping.get(server)
+        if started is None or not self.slow_start:
+            return 1.0
+        progress = (now - started) / self.slow_start
+        if progress >= 1.0:
+            return 1.0
+        if self.slow_start_mode == "exponential":
+            # Traffic grows by the same ratio every second, slow at first like TCP slow start
+            return SLOW_START_MIN_FACTOR ** (1.0 - progress)
+        return SLOW_START_MIN_FACTOR + (1.0 - SLOW_START_MIN_FACTOR) * progress
+
+    def set_slow_start(self, slow_start: float, slow_start_mode: str) -> None:
+        self.slow_start = slow_start
+        self.slow_start_mode = slow_start_mode
+        if not slow_start:
+            self.ramping.clear()
+
+    def get_slow_start_stats(self) -> Dict[str, float]:
+        now = time.monotonic()
+        factors = {server.url: self.slow_start_factor(server, now) for server in self.ramping}
+        return {url: round(factor, 3) for url, factor in factors.items() if factor < 1.0}
+
+    # Steps past excluded servers, at most len(exclude) steps
+    def healthy_at(self, i: int, exclude: Set[BackendServer] = None) -> BackendServer:
+        healthy_list = self.healthy_list
+        server = healthy_list[i % len(healthy_list)]
+        if exclude:
+            while server in exclude:
+                i += 1
+                server = healthy_list[i % len(healthy_list)]
+
+        return server
+
+    # Redraws a few times before stepping so retries stay evenly spread
+    def random_healthy(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        healthy_list = self.healthy_list
+        server = healthy_list[random.randrange(len(healthy_list))]
+        if exclude and server in exclude:
+            for _ in range(len(exclude)):
+                server = healthy_list[random.randrange(len(healthy_list))]
+                if server not in exclude:
+                    return server
+            server = self.healthy_at(random.randrange(len(healthy_list)), exclude)
+
+        return server
+
+    def random_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        if not self.healthy_list:
             raise ValueError("[RandomAlgoError] No servers available")
 
-        server = random.choice(self.servers)
+        server = self.random_healthy(exclude)
 
         return server
 
-    def round_robin_algo(self) -> BackendServer:
-        if not self.servers:
+    def round_robin_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        if not self.healthy_list:
             raise ValueError("[RoundRobinAlgoError] No servers available")
 
-        server = self.servers[self.round_robin_index]
-        self.round_robin_index = (self.round_robin_index + 1) % len(self.servers)  # Move to next server
+        server = self.healthy_at(self.round_robin_index, exclude)
+        self.round_robin_index = (self.round_robin_index + 1) % len(self.healthy_list)  # Move to next server
         return server
 
-    # Not optimized for large number of servers
-    # Use only for small number of servers
-    def ip_hash_algo(self, ip: str) -> BackendServer:
-        if not self.healthy_servers:
+    def ip_hash_algo(self, ip: str, exclude: Set[BackendServer] = None) -> BackendServer:
+        # Excluded servers fail over to the next server on the ring, which stays consistent per client
+        server = self.hash_ring.get_server(ip, exclude)
+        if server is None:
             raise ValueError("[IPHashAlgoError] No servers available")
 
-        healthy_servers_list = sorted(self.healthy_servers, key=lambda s: s.get_url())
+        return server
+
+    def weighted_round_robin_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        server = self.weighted_round_robin.next_server(exclude)
+        if server is None:
+            raise ValueError("[WeightedRoundRobinAlgoError] No servers available")
 
-        ip_hash = hash(ip)
-        server_index = bisect.bisect_right([hash(s.get_url()) for s in healthy_servers_list], ip_hash) % len(healthy_servers_list)
+        return server
 
-        server = healthy_servers_list[server_index]
+    def least_connections_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        server = self.least_connections.next_server(exclude)
+        if server is None:
+            raise ValueError("[LeastConnectionsAlgoError] No servers available")
 
         return server
 
+    def random_pair(self, exclude: Set[BackendServer] = None):
+        if exclude:
+            return self.random_healthy(exclude), self.random_healthy(exclude)
+
+        n = len(self.healthy_list)
+        i = random.randrange(n)
+        j = (i + random.randrange(1, n)) % n
+        return self.healthy_list[i], self.healthy_list[j]
+
+    # Two random healthy servers, keep the one with fewer active connections
+    def power_of_two_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        healthy_list = self.healthy_list
+        if not healthy_list:
+            raise ValueError("[PowerOfTwoAlgoError] No servers available")
+        if len(healthy_list) == 1:
+            return healthy_list[0]
+
+        first, second = self.random_pair(exclude)
+        if second.active_connections < first.active_connections:
+            return second
+
+        return first
+
+    # Peak-EWMA as in Finagle and Linkerd, expected latency times outstanding requests
+    def ewma_cost(self, server: BackendServer, now: float) -> float:
+        latency = server.get_latency(self.decay_time, now)
+        if latency == 0.0:
+            # Cold servers get one request to measure, then wait for its answer
+            return EWMA_PENALTY if server.active_connections else 0.0
+
+        return latency * (server.active_connections + 1)
+
+    def ewma_algo(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        healthy_list = self.healthy_list
+        if not healthy_list:
+            raise ValueError("[EWMAAlgoError] No servers available")
+        if len(healthy_list) == 1:
+            return healthy_list[0]
+
+        now = time.monotonic()
+        first, second = self.random_pair(exclude)
+        if self.ewma_cost(second, now) < self.ewma_cost(first, now):
+            return second
+
+        return first
+
+    def record_latency(self, server: BackendServer, rtt: float) -> None:
+        server.record_latency(rtt, self.decay_time, time.monotonic())
+
+    # Every proxied request is wrapped in acquire/release so active_connections stays accurate
+    def acquire(self, server: BackendServer) -> None:
+        server.active_connections += 1
+        self.least_connections.update(server)
+
+    def release(self, server: BackendServer) -> None:
+        server.active_connections -= 1
+        self.least_connections.update(server)
+        if self.release_listener is not None:
+            self.release_listener(server)
+
+    # Registered as a HealthCheck listener
+    def on_health_change(self, server: BackendServer, healthy: bool) -> None:
+        if healthy:
+            if server in self.healthy_index:
+                return
+            self.healthy_index[server] = len(self.healthy_list)
+            self.healthy_list.append(server)
+            # Recovered servers start cold instead of with the latency they failed with
+            server.reset_latency()
+            if self.slow_start:
+                now = time.monotonic()
+                # Drops finished ramps that weren't picked since, they would stop the new one from counting
+                for finished in [ramping for ramping, started in self.ramping.items() if now - started >= self.slow_start]:
+                    del self.ramping[finished]
+                self.ramping[server] = now
+            self.hash_ring.add_server(server)
+            self.weighted_round_robin.add_server(server)
+            self.least_connections.add_server(server)
+        else:
+            i = self.healthy_index.pop(server, None)
+            if i is None:
+                return
+            # Swap with the last server to remove in O(1)
+            last = self.healthy_list.pop()
+            if last is not server:
+                self.healthy_list[i] = last
+                self.healthy_index[last] = i
+            self.ramping.pop(server, None)
+            self.hash_ring.remove_server(server)
+            self.weighted_round_robin.remove_server(server)
+            self.least_connections.remove_server(server)
+
+    # Re-adds a healthy server so the ring and the schedule pick up its new weight
+    def set_weight(self, server: BackendServer, weight: int) -> None:
+        healthy = server in self.healthy_index
+        if healthy:
+            self.hash_ring.remove_server(server)
+            self.weighted_round_robin.remove_server(server)
+
+        server.weight = weight
+        if healthy:
+            self.hash_ring.add_server(server)
+            self.weighted_round_robin.add_server(server)
+
     def update_algo(self, algo_type: str) -> None:
         algo_type_str = algo_type.lower().strip()
         if algo_type_str not in algo_map:
-            raise ValueError(f"[LBAlgoError] Unsupported algorithm type: {algo_type_str}, please enter either 'random', 'round-robin' or 'ip-hash'")
+            raise ValueError(f"[LBAlgoError] Unsupported algorithm type: {algo_type_str}, please enter one of {', '.join(algo_map)}")
         
         self.algo_type = algo_map[algo_type_str]
+        self.algo_name = algo_type_str
 
 
     def get_algo(self) -> str:
-        for algo_str, algo_enum in algo_map.items():
-            if algo_enum == self.algo_type:
-                return algo_str
-
-        raise ValueError("[LBAlgoError] No matching algorithm string found for the current algo_type.")
\ No newline at end of file
+        return self.algo_name
\ No newline at end of file
@@ -1,11 +1,43 @@
-from fastapi import FastAPI, HTTPException, Request, Response
-import asyncio
+from fastapi import FastAPI, HTTPException, Request, Response, WebSocket
+from fastapi.responses import PlainTextResponse
+import asyncio, signal, socket, time
+from functools import partial
 import uvicorn, httpx
-from typing import List, Set
+from typing import AsyncIterator, List, Optional, Set, Tuple, Union
 from pydantic import BaseModel
 from server import BackendServer
+import utils
 from lb_algo import LBAlgo
 from health_check import HealthCheck
+from upstream_pool import UpstreamPool
+from outlier_detection import OutlierDetector
+from response_cache import CachedResponse, ResponseCache
+from metrics import Metrics, MetricsMiddleware
+from access_log import AccessLog
+from admission import AdmissionControl, AdmissionMiddleware
+from compression import ResponseCompression
+from long_lived import LongLivedConnections, UpstreamRejected, WebSocketTunnel, connect_websocket, websocket_connect
+from raw_proxy import RETRY_STATUS_CODES, RawProxyServer
+from workers import WORKER_SYNC_INTERVAL
+from config_reload import ConfigReloader
+from retry_policy import UNSENT_ERRORS, RetryPolicy
+from stats_snapshot import StatsSnapshot
+from sticky_sessions import StickySessions
+from streaming import (RequestBodyStream, UpstreamStreamingResponse, filter_hop_by_hop, filter_response_headers, has_body,
+                       is_event_stream, prepend)
+
+try:
+    from hypercorn.asyncio import serve as hypercorn_serve
+    from hypercorn.config import Config as HypercornConfig
+except ImportError:
+    hypercorn_serve = None
+
+# Config keys that take effect on reload besides the upstreams, the rest needs a restart
+RELOADABLE_KEYS = ("lb_method", "retries", "proxy_mode", "reload_drain_timeout",
+                   "max_inflight", "backend_max_connections", "queue_size", "queue_timeout", "retry_after",
+                   "retry_budget_ratio", "retry_budget_min_per_second", "retry_backoff_base", "retry_backoff_max",
+                   "hedge", "hedge_percentile", "hedge_min_delay", "long_lived_idle_timeout", "long_lived_max_per_backend",
+                   "stats_refresh_interval", "slow_start", "slow_start_mode", "prewarm_connections")
 
 class LoadBalancer:
     def __init__(self, servers: List[BackendServer], healthy_servers: Set[BackendServer], config: dict, port: int = 80):
@@ -16,21 +48,60 @@ class LoadBalancer:
         self.unhealthy_servers = []
         self.total_requests_served = 0
 
+        # Set when running as one of several worker processes
+        self.shared_state = None
+        self.worker_id = None
+
         print(self.backend_servers)
 
-        self.lb_algo = LBAlgo(servers, healthy_servers, config['lb_method'])
+        self.metrics = Metrics()
+        self.access_log = AccessLog(config)
+        self.lb_algo = LBAlgo(servers, healthy_servers, config['lb_method'], config['hash_ring_vnodes'], config['ewma_decay_time'],
+                              config['slow_start'], config['slow_start_mode'])
+        self.admission = AdmissionControl(self.lb_algo, config, self.metrics)
+        self.lb_algo.release_listener = self.admission.on_release
+        self.retry_policy = RetryPolicy(config, self.metrics)
+        self.long_lived = LongLivedConnections(self.lb_algo, config, self.metrics)
+        self.compression = ResponseCompression(config, self.metrics)
+        self.sessions = StickySessions(servers, self.lb_algo, config, self.metrics)
+        self.upstream_pool = UpstreamPool(servers, config)
+        self.raw_proxy = RawProxyServer(self) if config['engine'] == 'raw' else None
+        # uvicorn has no HTTP/2, hypercorn serves the same app when it is asked for
+        self.use_hypercorn = self.raw_proxy is None and config['listen_http2'] and hypercorn_serve is not None
         self.app = self.create_app()
         self.debug_app = self.create_debug_app()
-        self.healthchecker = HealthCheck(servers, healthy_servers, config)
+        self.healthchecker = HealthCheck(servers, healthy_servers, config, self.access_log)
+        self.healthchecker.add_listener(self.lb_algo.on_health_change)
+        self.healthchecker.add_listener(self.admission.on_health_change)
+        self.outlier_detector = OutlierDetector(self.healthchecker, config)
+        self.response_cache = ResponseCache(config, self.access_log)
+        self.config_reloader = ConfigReloader(self)
+        self.stats_snapshot = StatsSnapshot(self.build_stats, config['stats_refresh_interval'])
+        self.draining: Set[asyncio.Task] = set()
 
 
     def create_app(self) -> FastAPI:
         app = FastAPI()
+        # Added first so it runs inside the metrics middleware, shed requests are counted too
+        app.add_middleware(AdmissionMiddleware, admission=self.admission)
+        app.add_middleware(MetricsMiddleware, metrics=self.metrics, access_log=self.access_log)
 
         @app.api_route("/{full_path:path}", methods=["GET", "POST", "PUT", "DELETE", "PATCH"])
-        async def proxy(full_path: str, request: Request):
+        async def proxy(full_path: str, request: Request, proxy_response: Response):
+            if is_event_stream(request.headers.raw):
+                # Never buffered or cached, balanced by open connections like WebSockets
+                return await self.stream_request(full_path, request, long_lived=True)
+
+            if self.response_cache.enabled and self.response_cache.is_cacheable_request(request.method, request.headers):
+                return await self.cached_request(full_path, request)
+
+            if self.config['proxy_mode'] == 'streaming':
+                return await self.stream_request(full_path, request)
+
             client_ip = request.client.host
-            server = self.get_next_server(ip=client_ip)
+            tried = set()
+            session = self.sessions.get_session(request.headers.raw) if self.sessions.enabled else None
+            select_server = partial(self.select_server, pinned=self.sessions.lookup(session))
             
             retry_limit = self.config["retries"]
 
@@ -42,88 +113,640 @@ class LoadBalancer:
             # Read the body for POST/PUT requests
             body = await request.body()
 
-            timeout = httpx.Timeout(
-            connect=self.config['connect_timeout'],
-            read=self.config['read_timeout'],
-            write=self.config['send_timeout'],
-            pool=self.config['next_timeout']
-            )
-
-            # Use httpx to forward the request to the backend server
+            retry_policy = self.retry_policy
+            retry_policy.start_request()
+            idempotent = retry_policy.is_idempotent(method, "idempotency-key" in request.headers)
+            hedge_delay = retry_policy.hedge_delay(method, bool(body))
+
+            # One try on one server with its pooled client
+            async def attempt(server: BackendServer) -> httpx.Response:
+                self.lb_algo.acquire(server)
+                started = time.monotonic()
+                try:
+                    response = await self.upstream_pool.request(
+                        server,
+                        method=method, 
+                        url=f"/{full_path}",
+                        headers=headers,
+                        params=query_params,
+                        content=body
+                    )
+                except httpx.RequestError:
+                    # Failures count too, a timing out server must look slow
+                    self.record_upstream(server, None, time.monotonic() - started)
+                    raise
+                finally:
+                    self.lb_algo.release(server)
+
+                self.record_upstream(server, response.status_code, time.monotonic() - started)
+                return response
+
+            # Picked right before the first attempt, so its max_connections slot is still free
+            server = await select_server(ip=client_ip)
             retry = 0
-            while retry <= retry_limit:
-                url = f"{server.get_url()}/{full_path}"
-                print(f"Proxying request to {url}")
-                
-                async with httpx.AsyncClient(timeout=timeout) as client:
-
-                    # for _ in range(retry_limit):
-                    
-                    try: 
-                        response = await client.request(
-                            method=method, 
-                            url=url,
-                            headers=headers,
-                            params=query_params,
-                            content=body
+            while True:
+                started = time.monotonic()
+                try: 
+                    if hedge_delay is not None:
+                        server, response = await retry_policy.hedge(
+                            hedge_delay, attempt, server, partial(self.pick_hedge_server, client_ip, server, tried), self.discard_buffered
                         )
-                        if response.status_code == 200:
-                            server.increment_requests_served()
-                            self.total_requests_served += 1
-
-                            return {
-                                "status_code": response.status_code,
-                                "headers": dict(response.headers),
-                                "content": response.text
-                            }
-
-                        elif response.status_code in [500, 502, 503, 504]:
-                            retry += 1
-                            print(f"Server {server.get_url()} returned {response.status_code}. Switching to another server.")
-                            if self.lb_algo.get_algo() == "ip-hash":
-                                self.lb_algo.update_algo("round-robin")
-                            server = self.get_next_server(ip=client_ip)
-                            self.lb_algo.update_algo(self.config['lb_method'])
-
-                            print(f"Switched to new server: {server.get_url()}")
-                            continue
-                        else:
-                            break
-
-                    except httpx.RequestError as e:
-                        retry += 1
-                        print(f"Network error: {e}. Switching to another server.")
-                        if self.lb_algo.get_algo() == "ip-hash":
-                            self.lb_algo.update_algo("round-robin")
-                        server = self.get_next_server(ip=client_ip)
-                        self.lb_algo.update_algo(self.config['lb_method'])
-                        
-                        print(f"Switched to new server: {server.get_url()}")
-
-                
+                    else:
+                        response = await attempt(server)
+                except httpx.RequestError as e:
+                    if retry >= retry_limit or not retry_policy.can_retry(idempotent, not isinstance(e, UNSENT_ERRORS)):
+                        break
+                    self.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+                else:
+                    if response.status_code == 200:
+                        server.increment_requests_served()
+                        self.total_requests_served += 1
+                        self.annotate(request, server, retry, time.monotonic() - started)
+                        # Merged into the JSON response by FastAPI
+                        header = self.session_header(session, server)
+                        if header is not None:
+                            proxy_response.raw_headers.append(header)
+
+                        return {
+                            "status_code": response.status_code,
+                            "headers": dict(response.headers),
+                            "content": response.text
+                        }
+
+                    if response.status_code not in RETRY_STATUS_CODES or retry >= retry_limit or not retry_policy.can_retry(idempotent, True):
+                        break
+                    self.access_log.event("warning", "retry", upstream=server.get_url(), status=response.status_code)
+
+                retry += 1
+                self.metrics.retries += 1
+                tried.add(server)
+                await retry_policy.backoff(retry)
+                server = await select_server(ip=client_ip, exclude=tried)
 
             raise HTTPException(status_code=500, detail="All retries failed on all servers.")
 
+        @app.websocket("/{full_path:path}")
+        async def websocket_proxy(websocket: WebSocket, full_path: str):
+            await self.proxy_websocket(websocket)
+
         return app
 
-    def get_next_server(self, ip: str = None) -> BackendServer:
+    async def proxy_websocket(self, websocket: WebSocket) -> None:
+        # Closing before accepting answers the handshake with 403
+        if websocket_connect is None:
+            self.access_log.event("warning", "websocket refused, websockets is not installed")
+            await websocket.close()
+            return
+
+        tried = set()
+        retry = 0
+        while True:
+            try:
+                server = self.long_lived.pick(exclude=tried)
+            except HTTPException as e:
+                await self.deny_websocket(websocket, PlainTextResponse(e.detail, status_code=e.status_code, headers=e.headers))
+                return
+
+            # Held while connecting so concurrent handshakes spread out too
+            self.lb_algo.acquire(server)
+            started = time.monotonic()
+            try:
+                upstream = await connect_websocket(server, websocket, self.config['connect_timeout'])
+            except UpstreamRejected as e:
+                self.lb_algo.release(server)
+                self.record_upstream(server, e.status_code, time.monotonic() - started)
+                await self.deny_websocket(websocket, Response(e.body, status_code=e.status_code))
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                self.lb_algo.release(server)
+                self.record_upstream(server, None, time.monotonic() - started)
+                if retry >= self.config['retries']:
+                    await self.deny_websocket(websocket, PlainTextResponse("Bad Gateway", status_code=502))
+                    return
+                self.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+                retry += 1
+                self.metrics.retries += 1
+                tried.add(server)
+                continue
+            break
+
+        self.record_upstream(server, 101, time.monotonic() - started)
+        server.increment_requests_served()
+        self.total_requests_served += 1
+
+        tunnel = WebSocketTunnel(server, websocket, upstream)
+        self.long_lived.track(tunnel)
+        try:
+            await websocket.accept(subprotocol=upstream.subprotocol)
+            await tunnel.relay()
+        finally:
+            self.long_lived.untrack(tunnel)
+            self.lb_algo.release(server)
+            await upstream.close()
+
+    async def deny_websocket(self, websocket: WebSocket, response: Response) -> None:
+        # Servers without the denial response extension can only refuse with 403
+        if "websocket.http.response" in websocket.scope.get("extensions", {}):
+            await websocket.send_denial_response(response)
+        else:
+            await websocket.close()
+
+    async def stream_request(self, full_path: str, request: Request, long_lived: bool = False) -> UpstreamStreamingResponse:
+        """Streams the request and response bodies, `long_lived` for event streams that stay open."""
+        client_ip = request.client.host
+        session = None
+        if long_lived:
+            select_server = self.select_long_lived
+        else:
+            if self.sessions.enabled:
+                session = self.sessions.get_session(request.headers.raw)
+            select_server = partial(self.select_server, pinned=self.sessions.lookup(session))
+        server = await select_server(ip=client_ip)
+        tried = set()
+
+        retry_limit = self.config["retries"]
+
+        # Forward the raw query string and headers, minus the hop-by-hop ones
+        url = f"/{full_path}"
+        query_string = request.scope["query_string"]
+        if query_string:
+            url = f"{url}?{query_string.decode('latin-1')}"
+        headers = filter_hop_by_hop(request.headers.raw)
+        body = RequestBodyStream(request) if has_body(request) else None
+
+        retry_policy = self.retry_policy
+        retry_policy.start_request()
+        idempotent = retry_policy.is_idempotent(request.method, "idempotency-key" in request.headers)
+        hedge_delay = None if long_lived else retry_policy.hedge_delay(request.method, body is not None)
+        encoding = None if long_lived else self.compression.negotiate_request(request.method, request.headers.raw)
+
+        # Returns at the response headers, the server stays acquired until the body is relayed or discarded
+        async def attempt(server: BackendServer) -> httpx.Response:
+            upstream_request = self.upstream_pool.build_request(
+                server,
+                method=request.method,
+                url=url,
+                long_lived=long_lived,
+                headers=headers,
+                content=body
+            )
+
+            self.lb_algo.acquire(server)
+            started = time.monotonic()
+            try:
+                response = await self.upstream_pool.get_client(server, long_lived).send(upstream_request, stream=True)
+            except httpx.RequestError:
+                self.record_upstream(server, None, time.monotonic() - started)
+                self.lb_algo.release(server)
+                raise
+            except BaseException:
+                self.lb_algo.release(server)
+                raise
+
+            # Time to response headers, the body is paced by the client
+            self.record_upstream(server, response.status_code, time.monotonic() - started)
+            return response
+
+        retry = 0
+        while True:
+            started = time.monotonic()
+            try:
+                if hedge_delay is not None:
+                    server, response = await retry_policy.hedge(
+                        hedge_delay, attempt, server, partial(self.pick_hedge_server, client_ip, server, tried), self.discard_stream
+                    )
+                else:
+                    response = await attempt(server)
+            except httpx.RequestError as e:
+                # A partially sent body can't be replayed on another server
+                if body is not None and body.started:
+                    raise HTTPException(status_code=502, detail="Upstream failed while streaming the request body.")
+
+                if retry >= retry_limit or not retry_policy.can_retry(idempotent, not isinstance(e, UNSENT_ERRORS)):
+                    break
+                self.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+            else:
+                can_retry = (response.status_code in RETRY_STATUS_CODES and retry < retry_limit
+                             and (body is None or not body.started) and retry_policy.can_retry(idempotent, True))
+                if not can_retry:
+                    server.increment_requests_served()
+                    self.total_requests_served += 1
+                    self.annotate(request, server, retry, time.monotonic() - started)
+
+                    if long_lived:
+                        self.long_lived.open_stream(server)
+                        return UpstreamStreamingResponse(response, on_close=partial(self.close_long_lived, server),
+                                                         on_idle=self.long_lived.record_idle_close)
+                    if encoding is not None and not self.compression.should_compress(response.status_code, response.headers.raw):
+                        encoding = None
+                    # The connection stays active until the body is fully relayed
+                    streaming_response = UpstreamStreamingResponse(response, on_close=partial(self.lb_algo.release, server),
+                                                                   compression=self.compression, encoding=encoding)
+                    header = self.session_header(session, server)
+                    if header is not None:
+                        streaming_response.raw_headers.append(header)
+                    return streaming_response
+
+                await self.discard_stream(server, response)
+                self.access_log.event("warning", "retry", upstream=server.get_url(), status=response.status_code)
+
+            retry += 1
+            self.metrics.retries += 1
+            tried.add(server)
+            await retry_policy.backoff(retry)
+            server = await select_server(ip=client_ip, exclude=tried)
+
+        raise HTTPException(status_code=502, detail="All retries failed on all servers.")
+
+    async def cached_request(self, full_path: str, request: Request) -> Response:
+        url = f"/{full_path}"
+        query_string = request.scope["query_string"]
+        if query_string:
+            url = f"{url}?{query_string.decode('latin-1')}"
+
+        key = self.response_cache.make_key(request.method, url, request.headers)
+        # The key includes Accept-Encoding, entries are stored compressed for it and hits cost no compression
+        encoding = self.compression.negotiate_request(request.method, request.headers.raw)
+        session = self.sessions.get_session(request.headers.raw) if self.sessions.enabled else None
+        fetcher = partial(self.fetch_cacheable, request.method, url, filter_hop_by_hop(request.headers.raw), request.client.host,
+                          encoding, session)
+        cached, cache_status = await self.response_cache.fetch(key, fetcher)
+        record = request.scope.get("access_record")
+        if record is not None:
+            record.cache = cache_status
+
+        if not isinstance(cached, CachedResponse):
+            # Too large or not cacheable, relayed as it comes in like in streaming mode
+            cached.raw_headers.append((b"x-cache", cache_status.encode()))
+            return cached
+
+        response = Response(content=cached.body, status_code=cached.status_code)
+        # The stored headers already frame the body, don't let Response add its own content-length
+        response.raw_headers = cached.headers + [(b"x-cache", cache_status.encode())]
+        if cached.stored_at:
+            # Responses that weren't stored came straight from the upstream, they have no age of ours
+            response.raw_headers.append((b"age", str(cached.get_age(time.monotonic())).encode()))
+        return response
+
+    # Buffers one GET/HEAD response with its raw body so it can be stored and shared. Responses that can't
+    # be stored or outgrow cache_max_entry_bytes are streamed instead, memory stays bounded by the entry size.
+    # Misses go to the backend `session` is pinned to, only streamed ones carry a token since stored ones are shared.
+    async def fetch_cacheable(self, method: str, url: str, headers: list, client_ip: str, encoding: str = None,
+                              session: int = None) -> Union[CachedResponse, UpstreamStreamingResponse]:
+        select_server = partial(self.select_server, pinned=self.sessions.lookup(session))
+        server = await select_server(ip=client_ip)
+        tried = set()
+
+        retry_limit = self.config["retries"]
+        retry_policy = self.retry_policy
+        retry_policy.start_request()
+        hedge_delay = retry_policy.hedge_delay(method, False)
+
+        # The rest of the body is None once it was read whole, otherwise the server stays acquired until it is relayed
+        async def attempt(server: BackendServer) -> Tuple[httpx.Response, bytes, Optional[AsyncIterator[bytes]]]:
+            upstream_request = self.upstream_pool.build_request(server, method=method, url=url, headers=headers)
+            self.lb_algo.acquire(server)
+            started = time.monotonic()
+            rest = None
+            try:
+                response = await self.upstream_pool.get_client(server).send(upstream_request, stream=True)
+                try:
+                    # Raw bytes, so the stored content-encoding and content-length stay valid
+                    raw = response.aiter_raw()
+                    body = b""
+                    if self.response_cache.may_store(response.status_code, response.headers.raw):
+                        chunks = []
+                        size = 0
+                        async for chunk in raw:
+                            chunks.append(chunk)
+                            size += len(chunk)
+                            if size > self.response_cache.max_entry_bytes:
+                                rest = raw
+                                break
+                        body = b"".join(chunks)
+                    else:
+                        rest = raw
+                finally:
+                    if rest is None:
+                        await response.aclose()
+            except httpx.RequestError:
+                self.record_upstream(server, None, time.monotonic() - started)
+                self.lb_algo.release(server)
+                raise
+            except BaseException:
+                self.lb_algo.release(server)
+                raise
+            if rest is None:
+                self.lb_algo.release(server)
+
+            self.record_upstream(server, response.status_code, time.monotonic() - started)
+            return response, body, rest
+
+        retry = 0
+        while True:
+            try:
+                if hedge_delay is not None:
+                    server, (response, body, rest) = await retry_policy.hedge(
+                        hedge_delay, attempt, server, partial(self.pick_hedge_server, client_ip, server, tried), self.discard_cacheable
+                    )
+                else:
+                    response, body, rest = await attempt(server)
+            except httpx.RequestError as e:
+                if retry >= retry_limit or not retry_policy.can_retry(True, not isinstance(e, UNSENT_ERRORS)):
+                    break
+                self.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+            else:
+                if response.status_code not in RETRY_STATUS_CODES or retry >= retry_limit or not retry_policy.can_retry(True, True):
+                    server.increment_requests_served()
+                    self.total_requests_served += 1
+                    if rest is not None:
+                        if encoding is not None and not self.compression.should_compress(response.status_code, response.headers.raw):
+                            encoding = None
+                        streaming_response = UpstreamStreamingResponse(response, on_close=partial(self.lb_algo.release, server),
+                                                                       compression=self.compression, encoding=encoding,
+                                                                       body=prepend(body, rest))
+                        header = self.session_header(session, server)
+                        if header is not None:
+                            streaming_response.raw_headers.append(header)
+                        return streaming_response
+                    headers = filter_response_headers(response.headers.raw)
+                    if encoding is not None and self.compression.should_compress(response.status_code, headers):
+                        body = await self.compression.compress_body(body, encoding)
+                        headers = self.compression.encode_headers(headers, encoding)
+                        headers.append((b"content-length", str(len(body)).encode()))
+                    elif method != "HEAD" and "content-length" not in response.headers and response.status_code not in (204, 304):
+                        # Upstream sent it chunked, the stored body has a known length
+                        headers.append((b"content-length", str(len(body)).encode()))
+                    return CachedResponse(response.status_code, headers, body)
+
+                await self.discard_cacheable(server, (response, body, rest))
+                self.access_log.event("warning", "retry", upstream=server.get_url(), status=response.status_code)
+
+            retry += 1
+            self.metrics.retries += 1
+            tried.add(server)
+            await retry_policy.backoff(retry)
+            server = await select_server(ip=client_ip, exclude=tried)
+
+        raise HTTPException(status_code=502, detail="All retries failed on all servers.")
+
+    # A second server for a hedged attempt, None when there is no other one with room
+    def pick_hedge_server(self, ip: str, server: BackendServer, tried: Set[BackendServer]) -> BackendServer:
+        exclude = tried | {server}
+        try:
+            hedge_server = self.admission.pick(ip=ip, exclude=exclude)
+        except HTTPException:
+            return None
+        return hedge_server if hedge_server not in exclude else None
+
+    # Buffered attempts have released their server and connection already
+    async def discard_buffered(self, server: BackendServer, result) -> None:
+        pass
+
+    async def discard_cacheable(self, server: BackendServer, result: Tuple[httpx.Response, bytes, Optional[AsyncIterator[bytes]]]) -> None:
+        response, _, rest = result
+        if rest is not None:
+            await self.discard_stream(server, response)
+
+    async def discard_stream(self, server: BackendServer, response: httpx.Response) -> None:
+        await response.aclose()
+        self.lb_algo.release(server)
+
+    # Fills in the access record when the request was sampled
+    def annotate(self, request: Request, server: BackendServer, retries: int, upstream_time: float) -> None:
+        record = request.scope.get("access_record")
+        if record is not None:
+            record.upstream = server.get_url()
+            record.retries = retries
+            record.upstream_time = upstream_time
+
+    # Everything learned from one attempt on a backend, status_code is None for network errors
+    def record_upstream(self, server: BackendServer, status_code: int, elapsed: float) -> None:
+        self.lb_algo.record_latency(server, elapsed)
+        self.retry_policy.observe(elapsed)
+        self.outlier_detector.record_result(server, status_code is not None and status_code not in RETRY_STATUS_CODES)
+        self.metrics.observe_upstream(server, status_code, elapsed)
+
+    def apply_config(self, new_config: dict) -> None:
+        """Applies a reloaded config in one go, without awaiting in between.
+
+        Requests see either the old or the new upstream set. Servers that stay
+        keep their stats, health and pooled connections, removed ones stop
+        getting new requests and are drained in the background. The upstream
+        entries are all parsed before anything changes, an invalid one leaves
+        the current config in place.
+        """
+        parsed = []
+        for srv in new_config['upstream']:
+            host, port = utils.extract_host_and_port(srv['domain'])
+            max_connections = srv.get('max_connections')
+            if max_connections is None:
+                max_connections = new_config['backend_max_connections']
+            parsed.append(BackendServer(host, port, srv.get('weight') or 1, max_connections, bool(srv.get('http2'))))
+
+        current = {server.get_url(): server for server in self.backend_servers}
+        servers = []
+        added = []
+        reweighted = 0
+        for server in parsed:
+            url = server.get_url()
+            weight = server.weight
+            max_connections = server.max_connections
+            if url in current:
+                if current[url].http2 != server.http2:
+                    # The pooled client is bound to one protocol
+                    print(f"[ConfigReload] Restart to switch {url} to {'h2c' if server.http2 else 'HTTP/1.1'}")
+                server = current.pop(url)
+                server.max_connections = max_connections
+                if server.weight != weight:
+                    self.lb_algo.set_weight(server, weight)
+                    reweighted += 1
+            elif any(existing.get_url() == url for existing in servers):
+                continue
+            else:
+                added.append(server)
+            servers.append(server)
+
+        removed = list(current.values())
+        for server in removed:
+            self.healthchecker.remove_server(server)
+            self.outlier_detector.state.pop(server, None)
+            self.metrics.backends.pop(server, None)
+
+        # The list is shared with LBAlgo, HealthCheck and the pools
+        self.backend_servers[:] = servers
+        for server in added:
+            self.upstream_pool.add_server(server)
+            self.healthchecker.add_server(server)
+
+        for server in removed:
+            task = asyncio.ensure_future(self.drain_server(server))
+            self.draining.add(task)
+            task.add_done_callback(self.draining.discard)
+
+        if new_config['lb_method'] != self.config['lb_method']:
+            self.lb_algo.update_algo(new_config['lb_method'])
+        for key in RELOADABLE_KEYS:
+            self.config[key] = new_config[key]
+        self.admission.update_config(self.config)
+        self.retry_policy.update_config(self.config)
+        self.long_lived.update_config(self.config)
+        self.stats_snapshot.interval = self.config['stats_refresh_interval']
+        self.lb_algo.set_slow_start(self.config['slow_start'], self.config['slow_start_mode'])
+        # /stats shows the new upstream set right away
+        self.stats_snapshot.refresh()
+
+        restart_keys = [key for key in new_config if key != 'upstream' and key not in RELOADABLE_KEYS and new_config[key] != self.config.get(key)]
+        if restart_keys:
+            print(f"[ConfigReload] Restart to apply changes to: {', '.join(restart_keys)}")
+
+        print(f"[Success] Reloaded config: {len(added)} added, {len(removed)} removed, {reweighted} reweighted")
+
+    # Closes the pooled connections of a removed server once its in-flight requests are done
+    async def drain_server(self, server: BackendServer) -> None:
+        deadline = time.monotonic() + self.config['reload_drain_timeout']
+        while server.active_connections > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+
+        if server.active_connections > 0:
+            print(f"[ConfigReload] Closing {server.get_url()} with {server.active_connections} requests in flight")
+        await self.upstream_pool.remove_server(server)
+        if self.raw_proxy is not None:
+            self.raw_proxy.pool.remove_server(server)
+
+    def get_next_server(self, ip: str = None, exclude: Set[BackendServer] = None) -> BackendServer:
         if not self.healthy_servers:
             raise HTTPException(status_code=503, detail="No healthy servers available.")
 
-        server = self.lb_algo.get_next_server(ip=ip)
-        while server not in self.healthy_servers and self.healthy_servers:
-            server = self.lb_algo.get_next_server(ip=ip)
-        
-        return server
+        return self.lb_algo.get_next_server(ip=ip, exclude=exclude)
+
+    async def select_server(self, ip: str = None, exclude: Set[BackendServer] = None, pinned: BackendServer = None) -> BackendServer:
+        """Like get_next_server, but waits in the queue while every healthy server is at max_connections.
+
+        `pinned` is the healthy server of the client's sticky session, it is
+        used unless a retry excludes it or it is at max_connections.
+        """
+        if pinned is not None and (not exclude or pinned not in exclude) and self.admission.has_capacity(pinned):
+            return pinned
+        return await self.admission.get_server(ip=ip, exclude=exclude)
+
+    # Header carrying a new affinity token, None when the request's session is still valid
+    def session_header(self, session: Optional[int], server: BackendServer) -> Optional[Tuple[bytes, bytes]]:
+        if not self.sessions.enabled:
+            return None
+        token = self.sessions.pin(session, server)
+        return None if token is None else self.sessions.token_header(token)
+
+    async def select_long_lived(self, ip: str = None, exclude: Set[BackendServer] = None) -> BackendServer:
+        """The backend with the fewest open connections that is below long_lived_max_per_backend."""
+        return self.long_lived.pick(exclude=exclude)
+
+    def close_long_lived(self, server: BackendServer) -> None:
+        self.long_lived.close_stream(server)
+        self.lb_algo.release(server)
 
     def get_backend_server(self) -> BackendServer:
         return self.lb_algo.get_next_server()
 
+    def get_total_requests_served(self) -> int:
+        if self.shared_state is not None:
+            return self.shared_state.aggregate_total_requests()
+        return self.total_requests_served
+
+    def get_backend_stats(self) -> List[dict]:
+        if self.shared_state is None:
+            return [server.get_stats() for server in self.backend_servers]
+
+        # The master serves no traffic, counters come from the workers. Health check
+        # failures are counted by the master itself.
+        backend_stats = []
+        for server in self.backend_servers:
+            stats = server.get_stats()
+            counters = self.shared_state.aggregate_counters(server)
+            stats["requests_served"] = counters["requests_served"]
+            stats["failures"] = server.failures + counters["failures"]
+            stats["active_connections"] = counters["active_connections"]
+            stats["latency_ewma_ms"] = counters["latency_ewma_us"] / 1000
+            backend_stats.append(stats)
+
+        return backend_stats
+
+    # Built by the stats snapshot, the debug app serves the encoded result
+    def build_stats(self) -> dict:
+        return {
+            "stats": {
+                "total_requests_served": self.get_total_requests_served(),
+                "lb_algo": self.lb_algo.get_algo(),
+                "live_count": len(self.healthy_servers),
+                "healthy_servers": [server.url for server in self.backend_servers if server in self.healthy_servers],
+                "backend_servers": [server.url for server in self.backend_servers],
+                "slow_start": self.lb_algo.get_slow_start_stats()
+            },
+            "backend_stats": {"backend_stats": self.get_backend_stats()}
+        }
+
+    def get_metrics(self) -> str:
+        if self.shared_state is None:
+            active_connections = [server.active_connections for server in self.backend_servers]
+            return self.metrics.export(self.backend_servers, active_connections, self.healthy_servers)
+
+        # Workers publish their metrics on every sync, the master adds them up
+        metrics = self.shared_state.aggregate_metrics()
+        active_connections = [self.shared_state.aggregate_counters(server)["active_connections"] for server in self.backend_servers]
+        return metrics.export(self.backend_servers, active_connections, self.healthy_servers)
+
+    def get_retry_stats(self) -> dict:
+        metrics = self.metrics if self.shared_state is None else self.shared_state.aggregate_metrics()
+        return self.retry_policy.get_stats(metrics)
+
+    def get_long_lived_stats(self) -> dict:
+        if self.shared_state is None:
+            return self.long_lived.get_stats(self.metrics, self.backend_servers)
+        # Per backend counts stay in the workers, only the totals are shared
+        return self.long_lived.get_stats(self.shared_state.aggregate_metrics())
+
+    def get_sticky_stats(self) -> dict:
+        metrics = self.metrics if self.shared_state is None else self.shared_state.aggregate_metrics()
+        return self.sessions.get_stats(metrics)
+
+    def get_compression_stats(self) -> dict:
+        metrics = self.metrics if self.shared_state is None else self.shared_state.aggregate_metrics()
+        return self.compression.get_stats(metrics)
+
+    def get_admission_stats(self) -> dict:
+        if self.shared_state is None:
+            return self.admission.get_stats(self.metrics)
+
+        stats = self.admission.get_stats(self.shared_state.aggregate_metrics())
+        for backend, server in zip(stats["backends"], self.backend_servers):
+            backend["active_connections"] = self.shared_state.aggregate_counters(server)["active_connections"]
+        return stats
+
     def print_backend_stats(self):
         print("Backend Stats:")
         for server in self.backend_servers:
             print(f"Server: {server.url}, Requests Served: {server.requests_served}, Status: {server.get_status()}")
 
+    # Set as the health checker's prewarm hook in the processes that serve traffic
+    async def prewarm(self, server: BackendServer) -> None:
+        count = self.config['prewarm_connections']
+        if not count:
+            return
+        started = time.monotonic()
+        if self.raw_proxy is not None:
+            opened = await self.raw_proxy.pool.prewarm(server, count)
+        else:
+            opened = await self.upstream_pool.prewarm(server, count, self.config['health_check_path'])
+        self.access_log.event("info", "prewarmed", upstream=server.get_url(), connections=opened,
+                              seconds=round(time.monotonic() - started, 6))
+
+    async def initial_health_screen(self):
+        # Nothing is proxied yet, the healthy part of the fleet joins the ring in one rebuild
+        with self.lb_algo.hash_ring.batch():
+            await self.healthchecker.initial_health_screen()
+        # The servers we start with take their full share, slow start is for the ones that recover
+        self.lb_algo.ramping.clear()
+
     async def start_healthchecks(self):
         await self.healthchecker.run_health_checks()
 
@@ -139,21 +762,70 @@ class LoadBalancer:
             response.status_code = 200
             return {"message": "Welcome to the debug server"}
 
+        # Up to stats_refresh_interval seconds old, see StatsSnapshot
         @app.get("/stats")
-        def lb_stats(response: Response):
-            response.status_code = 200
-            return {
-                "total_requests_served": self.total_requests_served,
-                "lb_algo": self.lb_algo.get_algo(),
-                "live_count": len(self.healthy_servers),
-                "healthy_servers": [server.get_url() for server in self.healthy_servers],
-                "backend_servers": [server.get_url() for server in self.backend_servers]
-            }
+        def lb_stats():
+            return Response(self.stats_snapshot.get("stats"), media_type="application/json")
 
         @app.get("/backend_stats")
-        def backend_stats(response: Response):
+        def backend_stats():
+            return Response(self.stats_snapshot.get("backend_stats"), media_type="application/json")
+
+        @app.get("/pool_stats")
+        def pool_stats(response: Response):
             response.status_code = 200
-            return {"backend_stats": [server.get_stats() for server in self.backend_servers]}
+            if self.raw_proxy is not None:
+                return self.raw_proxy.pool.get_stats()
+            return self.upstream_pool.get_stats()
+
+        @app.get("/outlier_stats")
+        def outlier_stats(response: Response):
+            response.status_code = 200
+            return self.outlier_detector.get_stats()
+
+        @app.get("/cache_stats")
+        def cache_stats(response: Response):
+            response.status_code = 200
+            return self.response_cache.get_stats()
+
+        @app.get("/reload_stats")
+        def reload_stats(response: Response):
+            response.status_code = 200
+            return self.config_reloader.get_stats()
+
+        @app.get("/admission_stats")
+        def admission_stats(response: Response):
+            response.status_code = 200
+            return self.get_admission_stats()
+
+        @app.get("/retry_stats")
+        def retry_stats(response: Response):
+            response.status_code = 200
+            return self.get_retry_stats()
+
+        @app.get("/long_lived_stats")
+        def long_lived_stats(response: Response):
+            response.status_code = 200
+            return self.get_long_lived_stats()
+
+        @app.get("/sticky_stats")
+        def sticky_stats(response: Response):
+            response.status_code = 200
+            return self.get_sticky_stats()
+
+        @app.get("/compression_stats")
+        def compression_stats(response: Response):
+            response.status_code = 200
+            return self.get_compression_stats()
+
+        @app.get("/log_stats")
+        def log_stats(response: Response):
+            response.status_code = 200
+            return self.access_log.get_stats()
+
+        @app.get("/metrics", response_class=PlainTextResponse)
+        def metrics():
+            return PlainTextResponse(self.get_metrics(), media_type="text/plain; version=0.0.4")
 
         @app.get("/health")
         def health(response: Response):
@@ -162,19 +834,123 @@ class LoadBalancer:
 
         return app
 
-    async def run(self):
-        self.healthchecker.initial_health_screen()
-        health_check_task = asyncio.create_task(self.start_healthchecks())
-        uvicorn_config = uvicorn.Config(app=self.app, host="0.0.0.0", port=self.port)
-        uvicorn_server = uvicorn.Server(uvicorn_config)
+    async def serve_proxy(self, sock: socket.socket = None):
+        if self.raw_proxy is None and websocket_connect is None:
+            print("[WebSocket] websockets is not installed, WebSocket upgrades will be refused")
+        # The raw engine replaces the FastAPI app on the proxy port, the debug app stays the same
+        if self.raw_proxy is not None:
+            print("Starting raw proxy engine...")
+            await self.raw_proxy.serve("0.0.0.0", self.port, sock=sock)
+        elif self.use_hypercorn:
+            print("Starting Hypercorn server with HTTP/2...")
+            hypercorn_config = HypercornConfig()
+            hypercorn_config.bind = [f"fd://{sock.fileno()}"] if sock is not None else [f"0.0.0.0:{self.port}"]
+            # h2 over TLS via ALPN, h2c with prior knowledge or Upgrade on plaintext
+            hypercorn_config.certfile = self.config['ssl_certfile']
+            hypercorn_config.keyfile = self.config['ssl_keyfile']
+            # Stopped by cancellation like the raw engine, uvicorn owns the signal handlers
+            await hypercorn_serve(self.app, hypercorn_config, shutdown_trigger=asyncio.Event().wait)
+        else:
+            if self.config['listen_http2']:
+                print("[HTTP2] hypercorn is not installed, serving HTTP/1.1 with uvicorn")
+            print("Starting Uvicorn server...")
+            # Requests are logged by the access log, uvicorn's own would print every one of them
+            # permessage-deflate keeps zlib state per socket, too much for many idle WebSockets
+            uvicorn_config = uvicorn.Config(
+                app=self.app, host="0.0.0.0", port=self.port, access_log=False, ws_per_message_deflate=False,
+                ssl_certfile=self.config['ssl_certfile'], ssl_keyfile=self.config['ssl_keyfile']
+            )
+            uvicorn_server = uvicorn.Server(uvicorn_config)
+            await uvicorn_server.serve(sockets=[sock] if sock is not None else None)
 
-        uvicorn_debug_config = uvicorn.Config(app=self.debug_app, host="0.0.0.0", port=3030)
+    async def serve_debug(self):
+        # Every Config sets up uvicorn's logging again, the debug one must not turn the proxy's access lines back on
+        uvicorn_debug_config = uvicorn.Config(app=self.debug_app, host="0.0.0.0", port=3030, access_log=False)
         uvicorn_debug_server = uvicorn.Server(uvicorn_debug_config)
+        await uvicorn_debug_server.serve()
 
-        print("Starting Uvicorn server...")
-
-        await asyncio.gather(
-            uvicorn_server.serve(),
-            uvicorn_debug_server.serve(),
-            health_check_task 
+    async def run(self):
+        self.access_log.start()
+        await self.initial_health_screen()
+        self.healthchecker.prewarm = self.prewarm
+        health_check_task = asyncio.create_task(self.start_healthchecks())
+        reload_task = asyncio.create_task(self.config_reloader.run()) if self.config['config_reload'] else None
+        idle_sweep_task = asyncio.create_task(self.long_lived.run())
+        stats_task = asyncio.create_task(self.stats_snapshot.run())
+
+        self.upstream_pool.open()
+        proxy_task = asyncio.ensure_future(self.serve_proxy())
+        debug_task = asyncio.ensure_future(self.serve_debug())
+        try:
+            done, _ = await asyncio.wait([proxy_task, debug_task], return_when=asyncio.FIRST_COMPLETED)
+            if debug_task in done and (self.raw_proxy is not None or self.use_hypercorn):
+                # uvicorn takes over SIGINT, the raw engine and hypercorn have to stop along with the debug server
+                proxy_task.cancel()
+                try:
+                    await proxy_task
+                except asyncio.CancelledError:
+                    pass
+            else:
+                await asyncio.gather(proxy_task, debug_task)
+        finally:
+            # Stop probing and close pooled upstream connections on shutdown
+            health_check_task.cancel()
+            idle_sweep_task.cancel()
+            stats_task.cancel()
+            if reload_task is not None:
+                reload_task.cancel()
+            for task in self.draining:
+                task.cancel()
+            await self.upstream_pool.close()
+            self.compression.close()
+            self.access_log.stop()
+
+    # Health checks and the debug app, the workers serve the traffic
+    async def run_master(self):
+        self.access_log.start()
+        health_check_task = asyncio.create_task(self.start_healthchecks())
+        stats_task = asyncio.create_task(self.stats_snapshot.run())
+        # Workers share fixed per-server slots with the master, a new upstream set needs new workers
+        asyncio.get_running_loop().add_signal_handler(
+            signal.SIGHUP, print, "[ConfigReload] Hot reload is not supported with multiple workers, restart to apply config.json"
         )
+        try:
+            await self.serve_debug()
+        finally:
+            health_check_task.cancel()
+            stats_task.cancel()
+            self.access_log.stop()
+
+    async def run_worker(self, sock: socket.socket, worker_id: int):
+        self.worker_id = worker_id
+        self.sessions.set_partition(worker_id, self.config['workers'])
+        self.access_log.start()
+        # The master only probes, every worker warms up its own connections
+        self.healthchecker.prewarm = self.prewarm
+        sync_task = asyncio.create_task(self.sync_with_master())
+        idle_sweep_task = asyncio.create_task(self.long_lived.run())
+
+        self.upstream_pool.open()
+        proxy_task = asyncio.ensure_future(self.serve_proxy(sock))
+        if self.raw_proxy is not None or self.use_hypercorn:
+            # uvicorn handles SIGTERM itself, the raw engine and hypercorn stop by cancellation
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, proxy_task.cancel)
+
+        try:
+            await proxy_task
+        except asyncio.CancelledError:
+            pass
+        finally:
+            sync_task.cancel()
+            idle_sweep_task.cancel()
+            await self.upstream_pool.close()
+            self.compression.close()
+            self.access_log.stop()
+
+    async def sync_with_master(self):
+        while True:
+            # Everything the master changed since the last sync lands at once, e.g. a rack going down
+            with self.lb_algo.hash_ring.batch():
+                self.shared_state.apply_health(self.healthchecker)
+            self.shared_state.publish_counters(self.worker_id, self.total_requests_served, self.metrics)
+            await asyncio.sleep(WORKER_SYNC_INTERVAL)
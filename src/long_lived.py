@@ -0,0 +1,237 @@
+import asyncio, time
+from fastapi import HTTPException, WebSocket, WebSocketDisconnect
+from typing import Dict, List, Set
+from server import BackendServer
+from lb_algo import LBAlgo
+from metrics import Metrics
+from admission import Overloaded
+from streaming import filter_hop_by_hop
+
+try:
+    from websockets.asyncio.client import connect as websocket_connect
+    from websockets.exceptions import ConnectionClosed, InvalidHandshake, InvalidStatus
+except ImportError:
+    websocket_connect = None
+
+# How often idle connections are looked for, one pass over all of them
+IDLE_SWEEP_INTERVAL = 1.0
+# Same as uvicorn's ws_max_size, a bigger message from the upstream closes the socket
+WEBSOCKET_MAX_MESSAGE = 16 * 1024 * 1024
+# Client handshake headers the upstream handshake sets for itself
+WEBSOCKET_HANDSHAKE_HEADERS = {b"host", b"sec-websocket-key", b"sec-websocket-version",
+                               b"sec-websocket-extensions", b"sec-websocket-protocol"}
+
+class UpstreamRejected(Exception):
+    """The upstream answered the WebSocket handshake without switching protocols."""
+    def __init__(self, status_code: int, body: bytes):
+        super().__init__(status_code)
+        self.status_code = status_code
+        self.body = body
+
+class LongLivedConnections:
+    """WebSockets, upgraded tunnels and event streams, balanced by open connections.
+
+    Each one holds its backend's `active_connections` for as long as it is
+    open, so picking the least connected backend spreads sockets rather than
+    requests, whatever `lb_method` is. `long_lived_max_per_backend` caps them
+    per backend. They don't count against `max_inflight`, a few thousand idle
+    sockets would otherwise lock out every request.
+
+    A single sweeper closes the ones without traffic for `idle_timeout`
+    seconds instead of a timer per connection, an idle socket costs its
+    buffers and one dict entry.
+    """
+    def __init__(self, lb_algo: LBAlgo, config: dict, metrics: Metrics):
+        self.lb_algo = lb_algo
+        self.metrics = metrics
+        # Connections the sweeper watches, anything with `last_activity` and close()
+        self.connections: Dict[object, None] = {}
+        self.update_config(config)
+
+    def update_config(self, config: dict) -> None:
+        self.idle_timeout = config['long_lived_idle_timeout']
+        self.max_per_backend = config['long_lived_max_per_backend']
+        self.retry_after = config['retry_after']
+
+    def pick(self, exclude: Set[BackendServer] = None) -> BackendServer:
+        if not self.lb_algo.healthy_list:
+            raise HTTPException(status_code=503, detail="No healthy servers available.")
+
+        lb_algo = self.lb_algo
+        skipped = set(exclude) if exclude else set()
+        # A recovering server has the fewest sockets, slow start keeps it from getting every new one
+        deferred = None
+        while True:
+            server = lb_algo.least_connections.next_server(skipped)
+            if server is None:
+                if deferred is not None:
+                    return deferred
+                self.metrics.long_lived_rejected += 1
+                raise Overloaded(self.retry_after)
+            if not self.max_per_backend or server.long_lived_connections < self.max_per_backend:
+                if (deferred is not None or server not in lb_algo.ramping or len(lb_algo.ramping) == len(lb_algo.healthy_list)
+                        or lb_algo.slow_start_admits(server, None, time.monotonic())):
+                    return server
+                deferred = server
+            skipped.add(server)
+
+    # Counted against the per-backend cap, callers hold the server with LBAlgo.acquire themselves
+    def open_stream(self, server: BackendServer) -> None:
+        server.long_lived_connections += 1
+        self.metrics.long_lived_open += 1
+
+    def close_stream(self, server: BackendServer) -> None:
+        server.long_lived_connections -= 1
+        self.metrics.long_lived_open -= 1
+
+    # Tunnels and WebSockets, the sweeper closes them when idle
+    def track(self, connection) -> None:
+        self.open_stream(connection.server)
+        self.connections[connection] = None
+
+    def untrack(self, connection) -> None:
+        if self.connections.pop(connection, False) is None:
+            self.close_stream(connection.server)
+
+    # Event streams time out by themselves, see UpstreamStreamingResponse
+    def record_idle_close(self) -> None:
+        self.metrics.long_lived_idle_closed += 1
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(IDLE_SWEEP_INTERVAL)
+            self.sweep(time.monotonic())
+
+    def sweep(self, now: float) -> None:
+        if not self.idle_timeout:
+            return
+        deadline = now - self.idle_timeout
+        for connection in [connection for connection in self.connections if connection.last_activity < deadline]:
+            self.metrics.long_lived_idle_closed += 1
+            connection.close()
+
+    def get_stats(self, metrics: Metrics, servers: List[BackendServer] = None) -> dict:
+        stats = {
+            "open": metrics.long_lived_open,
+            "idle_timeout": self.idle_timeout,
+            "max_per_backend": self.max_per_backend,
+            "idle_closed": metrics.long_lived_idle_closed,
+            "rejected": metrics.long_lived_rejected
+        }
+        if servers is not None:
+            stats["backends"] = [
+                {
+                    "url": server.get_url(),
+                    "long_lived_connections": server.long_lived_connections,
+                    "active_connections": server.active_connections
+                }
+                for server in servers
+            ]
+        return stats
+
+def sendable_close_code(code: int) -> int:
+    # 1005 and 1006 stand for "no code" and "dropped", they can't be sent on
+    if code is None or code == 1005:
+        return 1000
+    return 1001 if code == 1006 else code
+
+async def connect_websocket(server: BackendServer, websocket: WebSocket, open_timeout: float):
+    """Opens the upstream WebSocket with the client's path, headers and subprotocols."""
+    url = f"ws://{server.host}:{server.port}{websocket.scope['path']}"
+    query_string = websocket.scope["query_string"]
+    if query_string:
+        url = f"{url}?{query_string.decode('latin-1')}"
+    headers = [(name.decode("latin-1"), value.decode("latin-1")) for name, value in filter_hop_by_hop(websocket.headers.raw)
+               if name.lower() not in WEBSOCKET_HANDSHAKE_HEADERS]
+    subprotocols = [protocol.strip() for protocol in websocket.headers.get("sec-websocket-protocol", "").split(",") if protocol.strip()]
+
+    try:
+        # No compression or keepalive pings, per-socket zlib state and ping tasks
+        # would dominate the memory of idle sockets, the idle sweeper stands in for pings
+        return await websocket_connect(
+            url, additional_headers=headers, subprotocols=subprotocols or None, open_timeout=open_timeout,
+            ping_interval=None, compression=None, max_size=WEBSOCKET_MAX_MESSAGE, user_agent_header=None
+        )
+    except InvalidStatus as e:
+        raise UpstreamRejected(e.response.status_code, e.response.body or b"") from e
+    except InvalidHandshake as e:
+        raise ConnectionError(f"WebSocket handshake with {server.get_url()} failed: {e!r}") from e
+
+class WebSocketTunnel:
+    """Relays messages between a client WebSocket and an upstream one.
+
+    Messages are forwarded as they are, text stays text and binary stays
+    binary, and a close on either side is passed on with its code.
+    """
+    __slots__ = ("server", "client", "upstream", "last_activity", "task", "stopping")
+
+    def __init__(self, server: BackendServer, client: WebSocket, upstream):
+        self.server = server
+        self.client = client
+        self.upstream = upstream
+        self.last_activity = time.monotonic()
+        self.task = None
+        self.stopping = False
+
+    async def relay(self) -> None:
+        self.task = asyncio.current_task()
+        to_client = asyncio.ensure_future(self.upstream_to_client())
+        try:
+            await self.client_to_upstream()
+        except asyncio.CancelledError:
+            # Stopped by close(), anything else is the server shutting down
+            if not self.stopping:
+                raise
+        finally:
+            to_client.cancel()
+            await self.upstream.close()
+            try:
+                # Going away, after an idle timeout or when the upstream dropped
+                await self.client.close(code=1001)
+            except (RuntimeError, OSError, WebSocketDisconnect):
+                # Already closed by either side
+                pass
+
+    async def client_to_upstream(self) -> None:
+        client = self.client
+        upstream = self.upstream
+        while True:
+            message = await client.receive()
+            if message["type"] == "websocket.disconnect":
+                await upstream.close(sendable_close_code(message.get("code")))
+                return
+            self.last_activity = time.monotonic()
+            text = message.get("text")
+            try:
+                await upstream.send(text if text is not None else message["bytes"])
+            except ConnectionClosed:
+                return
+
+    async def upstream_to_client(self) -> None:
+        client = self.client
+        try:
+            async for message in self.upstream:
+                self.last_activity = time.monotonic()
+                if isinstance(message, str):
+                    await client.send_text(message)
+                else:
+                    await client.send_bytes(message)
+            await client.close(code=sendable_close_code(self.upstream.protocol.close_code))
+        except ConnectionClosed:
+            # The upstream went away, pass its close code on
+            try:
+                await client.close(code=sendable_close_code(self.upstream.protocol.close_code))
+            except (RuntimeError, OSError, WebSocketDisconnect):
+                pass
+        except (RuntimeError, OSError, WebSocketDisconnect):
+            # The client went away
+            pass
+        finally:
+            # Stops the client side too, relay() cleans up
+            self.close()
+
+    # Also called by the sweeper
+    def close(self) -> None:
+        if self.task is not None and not self.stopping:
+            self.stopping = True
+            self.task.cancel()
@@ -1,9 +1,15 @@
 import config, lb_algo, load_balancer, server, utils
-import health_check
+import health_check, workers
 import asyncio
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 def main():
     config_data = config.load_config()
+    config_data = config.initialize_config(config_data)
     config.validate_config(config_data)
 
     # debug
@@ -14,14 +20,23 @@ def main():
 
     for srv in config_data['upstream']:
         host, port = utils.extract_host_and_port(srv['domain'])
-        weight = srv.get('weight', 1)
+        weight = srv.get('weight') or 1
+        max_connections = srv.get('max_connections')
+        if max_connections is None:
+            max_connections = config_data['backend_max_connections']
         
-        backend_server = server.BackendServer(host, port, weight)
+        backend_server = server.BackendServer(host, port, weight, max_connections, bool(srv.get('http2')))
         servers.append(backend_server)
 
     lb = load_balancer.LoadBalancer(servers, healthy_servers, config_data, config_data['listen'])
 
-    asyncio.run(lb.run())
+    if uvloop is not None:
+        uvloop.install()
+
+    if config_data['workers'] > 1:
+        workers.run_workers(lb, config_data['workers'])
+    else:
+        asyncio.run(lb.run())
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,320 @@
+import bisect, time
+from server import BackendServer
+from access_log import AccessLog
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from typing import Dict, List, Sequence, Set
+
+# Upper bounds in seconds, values above the last one land in +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx")
+
+class Histogram:
+    """Fixed-bucket latency histogram, one bisect and three increments per value."""
+    __slots__ = ("counts", "sum", "count")
+
+    # counts, sum and count
+    WIDTH = len(LATENCY_BUCKETS) + 3
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.sum += seconds
+        self.count += 1
+
+    def to_values(self) -> List[float]:
+        return self.counts + [self.sum, self.count]
+
+    def add_values(self, values: Sequence[float]) -> None:
+        n = len(self.counts)
+        for i in range(n):
+            self.counts[i] += int(values[i])
+        self.sum += values[n]
+        self.count += int(values[n + 1])
+
+    def export(self, name: str, labels: str = "") -> List[str]:
+        prefix = f"{labels}," if labels else ""
+        lines = []
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {self.count}')
+        suffix = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{suffix} {self.sum:.6f}")
+        lines.append(f"{name}_count{suffix} {self.count}")
+        return lines
+
+class BackendMetrics:
+    __slots__ = ("responses", "errors", "upstream")
+
+    # responses per status class, errors and the upstream histogram
+    WIDTH = len(STATUS_CLASSES) + 1 + Histogram.WIDTH
+
+    def __init__(self):
+        self.responses = [0] * len(STATUS_CLASSES)
+        self.errors = 0
+        self.upstream = Histogram()
+
+    def to_values(self) -> List[float]:
+        return self.responses + [self.errors] + self.upstream.to_values()
+
+    def add_values(self, values: Sequence[float]) -> None:
+        n = len(self.responses)
+        for i in range(n):
+            self.responses[i] += int(values[i])
+        self.errors += int(values[n])
+        self.upstream.add_values(values[n + 1:])
+
+class Metrics:
+    """Request counters and latency histograms, exported in the Prometheus text format.
+
+    Recording is plain attribute and list increments on the event loop
+    thread, so there is nothing to lock. In multi-process mode every worker
+    publishes its values as one flat row of shared memory on each sync and
+    the master adds the rows up when /metrics is scraped.
+    """
+    # Status codes 100 to 599 are counted individually
+    STATUS_CODES = 500
+    # Plain counters and gauges, in the order they are shared
+    SCALARS = ("in_flight", "retries", "queued", "shed", "queue_timeouts",
+               "retries_throttled", "retries_skipped", "hedges", "hedge_wins",
+               "long_lived_open", "long_lived_idle_closed", "long_lived_rejected",
+               "compressed", "compression_passthrough", "compression_bytes_in", "compression_bytes_out", "compression_cpu_us",
+               "sticky_hits", "sticky_created", "sticky_repinned", "sticky_evicted", "sticky_slots_used")
+    # scalars, status codes and the request histogram
+    WIDTH = len(SCALARS) + STATUS_CODES + Histogram.WIDTH
+
+    def __init__(self):
+        self.in_flight = 0
+        self.retries = 0
+        # Requests waiting for capacity and the ones turned away, see AdmissionControl
+        self.queued = 0
+        self.shed = 0
+        self.queue_timeouts = 0
+        # Retries denied by the budget or because the method isn't idempotent, see RetryPolicy
+        self.retries_throttled = 0
+        self.retries_skipped = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        # WebSockets, tunnels and event streams, see LongLivedConnections
+        self.long_lived_open = 0
+        self.long_lived_idle_closed = 0
+        self.long_lived_rejected = 0
+        # Responses compressed by the proxy and the ones that came compressed, see ResponseCompression
+        self.compressed = 0
+        self.compression_passthrough = 0
+        self.compression_bytes_in = 0
+        self.compression_bytes_out = 0
+        self.compression_cpu_us = 0.0
+        # Requests routed by their session and the session table, see StickySessions
+        self.sticky_hits = 0
+        self.sticky_created = 0
+        self.sticky_repinned = 0
+        self.sticky_evicted = 0
+        self.sticky_slots_used = 0
+        self.responses = [0] * self.STATUS_CODES
+        self.request_duration = Histogram()
+        self.backends: Dict[BackendServer, BackendMetrics] = {}
+
+    @classmethod
+    def width(cls, servers: int) -> int:
+        return cls.WIDTH + servers * BackendMetrics.WIDTH
+
+    def get_backend(self, server: BackendServer) -> BackendMetrics:
+        backend = self.backends.get(server)
+        if backend is None:
+            backend = self.backends[server] = BackendMetrics()
+        return backend
+
+    # Total time in the load balancer, as seen by the client
+    def observe_request(self, status_code: int, seconds: float) -> None:
+        if 100 <= status_code < 600:
+            self.responses[status_code - 100] += 1
+        self.request_duration.observe(seconds)
+
+    # One attempt on a backend, status_code is None for network errors and timeouts
+    def observe_upstream(self, server: BackendServer, status_code: int, seconds: float) -> None:
+        backend = self.get_backend(server)
+        if status_code is None:
+            backend.errors += 1
+        elif 100 <= status_code < 600:
+            backend.responses[status_code // 100 - 1] += 1
+        backend.upstream.observe(seconds)
+
+    def to_values(self, servers: List[BackendServer]) -> List[float]:
+        values = [getattr(self, name) for name in self.SCALARS] + self.responses + self.request_duration.to_values()
+        for server in servers:
+            values += self.get_backend(server).to_values()
+        return values
+
+    def add_values(self, values: Sequence[float], servers: List[BackendServer]) -> None:
+        for i, name in enumerate(self.SCALARS):
+            setattr(self, name, getattr(self, name) + int(values[i]))
+        offset = len(self.SCALARS)
+        for i in range(self.STATUS_CODES):
+            self.responses[i] += int(values[offset + i])
+        offset += self.STATUS_CODES
+        self.request_duration.add_values(values[offset:offset + Histogram.WIDTH])
+
+        offset = self.WIDTH
+        for server in servers:
+            self.get_backend(server).add_values(values[offset:offset + BackendMetrics.WIDTH])
+            offset += BackendMetrics.WIDTH
+
+    def export(self, servers: List[BackendServer], active_connections: List[int], healthy_servers: Set[BackendServer]) -> str:
+        lines = [
+            "# HELP lb_requests_total Responses sent to clients by status code.",
+            "# TYPE lb_requests_total counter"
+        ]
+        for i, count in enumerate(self.responses):
+            if count:
+                lines.append(f'lb_requests_total{{code="{i + 100}"}} {count}')
+
+        lines += [
+            "# HELP lb_request_duration_seconds Time from accepting a request to the end of its response.",
+            "# TYPE lb_request_duration_seconds histogram"
+        ]
+        lines += self.request_duration.export("lb_request_duration_seconds")
+
+        lines += [
+            "# HELP lb_requests_in_flight Requests currently being handled.",
+            "# TYPE lb_requests_in_flight gauge",
+            f"lb_requests_in_flight {self.in_flight}",
+            "# HELP lb_retries_total Requests retried on another backend.",
+            "# TYPE lb_retries_total counter",
+            f"lb_retries_total {self.retries}",
+            "# HELP lb_retries_denied_total Failed attempts that weren't retried, by reason.",
+            "# TYPE lb_retries_denied_total counter",
+            f'lb_retries_denied_total{{reason="budget"}} {self.retries_throttled}',
+            f'lb_retries_denied_total{{reason="non_idempotent"}} {self.retries_skipped}',
+            "# HELP lb_hedged_requests_total Second attempts sent because the first was slower than the hedge delay.",
+            "# TYPE lb_hedged_requests_total counter",
+            f"lb_hedged_requests_total {self.hedges}",
+            "# HELP lb_hedge_wins_total Hedged attempts that answered before the first one.",
+            "# TYPE lb_hedge_wins_total counter",
+            f"lb_hedge_wins_total {self.hedge_wins}",
+            "# HELP lb_queue_depth Requests waiting for a max_inflight or max_connections slot.",
+            "# TYPE lb_queue_depth gauge",
+            f"lb_queue_depth {self.queued}",
+            "# HELP lb_requests_shed_total Requests answered with 503 because the queue was full or they waited too long.",
+            "# TYPE lb_requests_shed_total counter",
+            f'lb_requests_shed_total{{reason="queue_full"}} {self.shed}',
+            f'lb_requests_shed_total{{reason="queue_timeout"}} {self.queue_timeouts}',
+            "# HELP lb_long_lived_connections WebSockets, upgraded tunnels and event streams currently open.",
+            "# TYPE lb_long_lived_connections gauge",
+            f"lb_long_lived_connections {self.long_lived_open}",
+            "# HELP lb_long_lived_idle_closed_total Long-lived connections closed after long_lived_idle_timeout without traffic.",
+            "# TYPE lb_long_lived_idle_closed_total counter",
+            f"lb_long_lived_idle_closed_total {self.long_lived_idle_closed}",
+            "# HELP lb_long_lived_rejected_total Long-lived connections refused because every backend was at long_lived_max_per_backend.",
+            "# TYPE lb_long_lived_rejected_total counter",
+            f"lb_long_lived_rejected_total {self.long_lived_rejected}",
+            "# HELP lb_compressed_responses_total Responses compressed by the load balancer.",
+            "# TYPE lb_compressed_responses_total counter",
+            f"lb_compressed_responses_total {self.compressed}",
+            "# HELP lb_compression_bytes_total Body bytes before and after compression.",
+            "# TYPE lb_compression_bytes_total counter",
+            f'lb_compression_bytes_total{{stage="in"}} {self.compression_bytes_in}',
+            f'lb_compression_bytes_total{{stage="out"}} {self.compression_bytes_out}',
+            "# HELP lb_compression_cpu_seconds_total CPU time spent compressing responses.",
+            "# TYPE lb_compression_cpu_seconds_total counter",
+            f"lb_compression_cpu_seconds_total {self.compression_cpu_us / 1e6:.6f}",
+            "# HELP lb_sticky_session_hits_total Requests sent to the backend their session is pinned to.",
+            "# TYPE lb_sticky_session_hits_total counter",
+            f"lb_sticky_session_hits_total {self.sticky_hits}",
+            "# HELP lb_sticky_sessions_total Session table changes: new sessions, sessions moved to another backend and live ones evicted.",
+            "# TYPE lb_sticky_sessions_total counter",
+            f'lb_sticky_sessions_total{{event="created"}} {self.sticky_created}',
+            f'lb_sticky_sessions_total{{event="repinned"}} {self.sticky_repinned}',
+            f'lb_sticky_sessions_total{{event="evicted"}} {self.sticky_evicted}',
+            "# HELP lb_sticky_session_slots Slots of the session table in use.",
+            "# TYPE lb_sticky_session_slots gauge",
+            f"lb_sticky_session_slots {self.sticky_slots_used}"
+        ]
+
+        backends = [(server.get_url(), self.get_backend(server)) for server in servers]
+        lines += [
+            "# HELP lb_upstream_responses_total Backend responses by status class.",
+            "# TYPE lb_upstream_responses_total counter"
+        ]
+        for url, backend in backends:
+            for status_class, count in zip(STATUS_CLASSES, backend.responses):
+                lines.append(f'lb_upstream_responses_total{{backend="{url}",code="{status_class}"}} {count}')
+
+        lines += [
+            "# HELP lb_upstream_errors_total Backend attempts that failed with a network error or timeout.",
+            "# TYPE lb_upstream_errors_total counter"
+        ]
+        for url, backend in backends:
+            lines.append(f'lb_upstream_errors_total{{backend="{url}"}} {backend.errors}')
+
+        lines += [
+            "# HELP lb_upstream_duration_seconds Time a backend took to respond, up to the response headers when streaming.",
+            "# TYPE lb_upstream_duration_seconds histogram"
+        ]
+        for url, backend in backends:
+            lines += backend.upstream.export("lb_upstream_duration_seconds", f'backend="{url}"')
+
+        lines += [
+            "# HELP lb_backend_active_connections Requests currently in flight per backend.",
+            "# TYPE lb_backend_active_connections gauge"
+        ]
+        for (url, _), count in zip(backends, active_connections):
+            lines.append(f'lb_backend_active_connections{{backend="{url}"}} {count}')
+
+        lines += [
+            "# HELP lb_backend_healthy Whether the backend currently takes traffic.",
+            "# TYPE lb_backend_healthy gauge"
+        ]
+        for server, (url, _) in zip(servers, backends):
+            lines.append(f'lb_backend_healthy{{backend="{url}"}} {1 if server in healthy_servers else 0}')
+
+        return "\n".join(lines) + "\n"
+
+class MetricsMiddleware:
+    """Counts every request of the proxy app by the status it was answered with.
+
+    Sampled requests get an AccessRecord in the scope for the proxy to fill
+    in, it is written to the access log once the response is done.
+    """
+    def __init__(self, app: ASGIApp, metrics: Metrics, access_log: AccessLog):
+        self.app = app
+        self.metrics = metrics
+        self.access_log = access_log
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        metrics = self.metrics
+        # Stays 500 if the app fails before it starts a response
+        status_code = 500
+
+        record = None
+        if self.access_log.sample_rate:
+            client = scope.get("client")
+            record = self.access_log.sample(scope["method"], scope["path"], client[0] if client else None)
+            if record is not None:
+                scope["access_record"] = record
+
+        async def send_with_status(message: Message) -> None:
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            metrics.in_flight -= 1
+            metrics.observe_request(status_code, time.perf_counter() - started)
+            if record is not None:
+                record.status = status_code
+                self.access_log.access(record)
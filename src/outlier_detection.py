@@ -0,0 +1,113 @@
+import time
+from server import BackendServer
+from health_check import HealthCheck
+from typing import Dict
+
+class OutlierState:
+    __slots__ = ("consecutive_failures", "window_start", "window_requests", "window_errors", "ejections")
+
+    def __init__(self):
+        self.consecutive_failures = 0
+        self.window_start = 0.0
+        self.window_requests = 0
+        self.window_errors = 0
+        self.ejections = 0
+
+class OutlierDetector:
+    """Passive health checking from the results of proxied requests.
+
+    A server is ejected from healthy_servers after too many consecutive
+    failures or a too high error rate in the current window. Each ejection
+    lasts twice as long as the previous one, and HealthCheck only lets the
+    server back in once the ejection is over and its probes pass again.
+    """
+    def __init__(self, healthchecker: HealthCheck, config: dict):
+        self.healthchecker = healthchecker
+        self.access_log = healthchecker.access_log
+        self.enabled = config['outlier_detection']
+        self.consecutive_limit = config['outlier_consecutive_failures']
+        self.error_rate = config['outlier_error_rate']
+        self.window = config['outlier_window']
+        self.min_requests = config['outlier_min_requests']
+        self.base_ejection_time = config['outlier_base_ejection_time']
+        self.max_ejection_time = config['outlier_max_ejection_time']
+        self.max_ejection_percent = config['outlier_max_ejection_percent']
+
+        self.state: Dict[BackendServer, OutlierState] = {}
+        self.total_ejections = 0
+        self.skipped_ejections = 0
+
+    def get_state(self, server: BackendServer) -> OutlierState:
+        state = self.state.get(server)
+        if state is None:
+            state = self.state[server] = OutlierState()
+        return state
+
+    def record_result(self, server: BackendServer, success: bool) -> None:
+        if not self.enabled:
+            return
+
+        state = self.get_state(server)
+        now = time.monotonic()
+        # Tumbling window, cheaper than a sliding one and good enough for error rates
+        if now - state.window_start > self.window:
+            state.window_start = now
+            state.window_requests = 0
+            state.window_errors = 0
+
+        state.window_requests += 1
+        if success:
+            state.consecutive_failures = 0
+            return
+
+        state.consecutive_failures += 1
+        state.window_errors += 1
+        if state.consecutive_failures >= self.consecutive_limit:
+            self.eject(server, state, now)
+        elif state.window_requests >= self.min_requests and state.window_errors / state.window_requests >= self.error_rate:
+            self.eject(server, state, now)
+
+    def ejected_count(self, now: float) -> int:
+        return sum(1 for server in self.state if server.ejected_until > now)
+
+    def eject(self, server: BackendServer, state: OutlierState, now: float) -> None:
+        if server not in self.healthchecker.healthy_servers or server.ejected_until > now:
+            return
+
+        # Never eject so much of the fleet that the rest gets overloaded. Small fleets round down to 0,
+        # they can still eject one server as long as another one stays healthy.
+        max_ejected = len(self.healthchecker.servers) * self.max_ejection_percent // 100
+        if max_ejected == 0 and self.max_ejection_percent > 0 and len(self.healthchecker.healthy_servers) > 1:
+            max_ejected = 1
+        if self.ejected_count(now) >= max_ejected:
+            self.skipped_ejections += 1
+            return
+
+        # A server that behaved since its last ejection starts over at the base time
+        if now - server.ejected_until > self.max_ejection_time:
+            state.ejections = 0
+        state.ejections += 1
+        duration = min(self.base_ejection_time * 2 ** (state.ejections - 1), self.max_ejection_time)
+        state.consecutive_failures = 0
+        state.window_requests = 0
+        state.window_errors = 0
+        self.total_ejections += 1
+
+        self.access_log.event("warning", "outlier ejected", upstream=server.get_url(), seconds=duration, ejections=state.ejections)
+        self.healthchecker.eject_server(server, now + duration)
+
+    def get_stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "enabled": self.enabled,
+            "total_ejections": self.total_ejections,
+            "skipped_ejections": self.skipped_ejections,
+            "ejected_servers": [
+                {
+                    "url": server.get_url(),
+                    "ejections": state.ejections,
+                    "ejected_for": round(server.ejected_until - now, 3)
+                }
+                for server, state in self.state.items() if server.ejected_until > now
+            ]
+        }
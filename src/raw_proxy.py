@@ -0,0 +1,946 @@
+import asyncio, socket, time
+import httptools
+from collections import deque
+from fastapi import HTTPException
+from functools import partial
+from http import HTTPStatus
+from typing import Deque, Dict, List, Mapping, Tuple
+from server import BackendServer
+from compression import ResponseCompression
+from streaming import filter_hop_by_hop, is_event_stream
+
+# Stop reading from a client once this many pipelined requests are waiting
+MAX_PIPELINED_REQUESTS = 32
+# Stop reading from an upstream once this much of its body waits for the compressor
+COMPRESSION_BACKLOG = 256 * 1024
+RETRY_STATUS_CODES = {500, 502, 503, 504}
+
+class UpstreamConnectError(ConnectionError):
+    """No connection to the backend, nothing was sent so any method can be retried."""
+
+def error_response(status_code: int, reason: str, headers: Mapping[str, str] = None) -> bytes:
+    body = reason.encode()
+    extra = "".join(f"{name}: {value}\r\n" for name, value in headers.items()) if headers else ""
+    return (f"HTTP/1.1 {status_code} {reason}\r\n"
+            f"content-type: text/plain\r\n"
+            f"{extra}"
+            f"content-length: {len(body)}\r\n\r\n").encode() + body
+
+
+class ProxyRequest:
+    __slots__ = ("method", "url", "headers", "body", "keep_alive", "status_code", "access", "upgrade", "encoding")
+
+    def __init__(self, method: bytes, url: bytes, headers: List[Tuple[bytes, bytes]], body: List[bytes], keep_alive: bool):
+        self.method = method
+        self.url = url
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+        # Status the client was answered with, 499 like nginx if it went away first
+        self.status_code = 499
+        self.access = None
+        # Asks to switch protocols, e.g. to a WebSocket, the connection becomes a tunnel
+        self.upgrade = False
+        # Negotiated from Accept-Encoding, the response is compressed if it qualifies
+        self.encoding = None
+
+    def build_head(self, body_length: int) -> bytes:
+        lines = [self.method, b" ", self.url, b" HTTP/1.1\r\n"]
+        for name, value in filter_hop_by_hop(self.headers):
+            lowered = name.lower()
+            # The body was de-chunked by the parser, it is re-framed with content-length
+            if lowered == b"content-length" or lowered == b"expect":
+                continue
+            lines.extend((name, b": ", value, b"\r\n"))
+        if body_length or self.method in (b"POST", b"PUT", b"PATCH"):
+            lines.append(b"content-length: %d\r\n" % body_length)
+        lines.append(b"connection: keep-alive\r\n\r\n")
+        return b"".join(lines)
+
+    def build_upgrade_head(self) -> bytes:
+        # Connection and Upgrade are what this request is about, all headers go through as they are
+        lines = [self.method, b" ", self.url, b" HTTP/1.1\r\n"]
+        for name, value in self.headers:
+            lines.extend((name, b": ", value, b"\r\n"))
+        lines.append(b"\r\n")
+        return b"".join(lines)
+
+
+class Exchange:
+    """A single request/response on an upstream connection.
+
+    Upstream bytes are held back until the status line is known so a 5xx can
+    still be retried on another server, after that they are written to the
+    client as they arrive without being re-encoded.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: "ClientProtocol", head_only: bool):
+        self.parser = httptools.HttpResponseParser(self)
+        self.client = client
+        self.head_only = head_only
+        self.headers_done = loop.create_future()
+        self.done = loop.create_future()
+        self.buffer = []
+        self.forwarding = False
+        self.framed = True
+
+    def feed(self, data: bytes) -> None:
+        if self.forwarding:
+            self.client.write(data)
+        else:
+            self.buffer.append(data)
+
+        try:
+            self.parser.feed_data(data)
+        except httptools.HttpParserError as exc:
+            self.fail(exc)
+
+    def start_forwarding(self, extra_headers: bytes = b"") -> None:
+        self.forwarding = True
+        data = b"".join(self.buffer)
+        if extra_headers:
+            # Right after the status line, the whole head is in the buffer by now
+            end = data.index(b"\r\n") + 2
+            data = b"".join((data[:end], extra_headers, data[end:]))
+        self.client.write(data)
+        self.buffer = None
+
+    def fail(self, exc: Exception) -> None:
+        if not self.headers_done.done():
+            self.headers_done.set_exception(exc)
+        if not self.done.done():
+            self.done.set_exception(exc)
+
+    def connection_lost(self) -> None:
+        if self.headers_done.done() and not self.done.done():
+            # Responses without content-length or chunking end when the upstream closes
+            self.framed = False
+            self.done.set_result(False)
+        else:
+            self.fail(ConnectionError("Upstream closed the connection"))
+
+    # httptools callbacks
+    def on_headers_complete(self) -> None:
+        if not self.headers_done.done():
+            self.headers_done.set_result(self.parser.get_status_code())
+        if self.head_only:
+            self.on_message_complete()
+
+    def on_message_complete(self) -> None:
+        if not self.done.done():
+            self.done.set_result(self.parser.should_keep_alive())
+
+
+class CompressingExchange(Exchange):
+    """An Exchange for a client that accepts a compressed response.
+
+    Once the response headers are in, responses ResponseCompression turns
+    down are relayed byte for byte like in any other exchange. The others
+    get new headers and their body, as decoded by the parser, goes through
+    the compressor in order and out in chunks. `done` resolves after the
+    last chunk was written.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, client: "ClientProtocol", head_only: bool,
+                 connection: "UpstreamProtocol", compression: ResponseCompression, encoding: str):
+        super().__init__(loop, client, head_only)
+        self.loop = loop
+        self.connection = connection
+        self.compression = compression
+        self.encoding = encoding
+        self.headers = []
+        self.compressing = False
+        # The body ends when the upstream closes, there is no length or chunking to go by
+        self.until_close = False
+        self.chunks = []
+        self.backlog = 0
+        # The upstream's keep-alive, set once its body is complete
+        self.keep_alive = None
+        self.wakeup = None
+        self.task = None
+
+    def feed(self, data: bytes) -> None:
+        if not self.compressing:
+            super().feed(data)
+            return
+        # Only the decoded body is forwarded, through on_body
+        try:
+            self.parser.feed_data(data)
+        except httptools.HttpParserError as exc:
+            self.fail(exc)
+
+    def start_forwarding(self, extra_headers: bytes = b"") -> None:
+        super().start_forwarding(extra_headers)
+        if self.compressing:
+            self.task = self.loop.create_task(self.pump())
+
+    def fail(self, exc: Exception) -> None:
+        if self.task is not None and self.task is not asyncio.current_task():
+            self.task.cancel()
+        super().fail(exc)
+
+    def connection_lost(self) -> None:
+        if not self.compressing or not self.headers_done.done():
+            super().connection_lost()
+        elif self.keep_alive is None:
+            if not self.until_close:
+                self.fail(ConnectionError("Upstream closed the connection mid-body"))
+                return
+            # The client's framing is ours, the body still ends cleanly
+            self.keep_alive = False
+            self.wake()
+
+    def build_head(self, status_code: int) -> bytes:
+        try:
+            reason = HTTPStatus(status_code).phrase.encode()
+        except ValueError:
+            reason = b""
+        lines = [b"HTTP/1.1 %d %s\r\n" % (status_code, reason)]
+        for name, value in self.compression.encode_headers(filter_hop_by_hop(self.headers), self.encoding):
+            lines.extend((name, b": ", value, b"\r\n"))
+        lines.append(b"transfer-encoding: chunked\r\n\r\n")
+        return b"".join(lines)
+
+    def wake(self) -> None:
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def write_chunk(self, data: bytes) -> None:
+        if data:
+            self.client.write(b"".join((b"%x\r\n" % len(data), data, b"\r\n")))
+
+    # Compresses what arrived since the last round in one go, one stream at a time per response
+    async def pump(self) -> None:
+        compression = self.compression
+        encoder = compression.start(self.encoding)
+        try:
+            while True:
+                if self.chunks:
+                    data = b"".join(self.chunks)
+                    self.chunks = []
+                    self.backlog = 0
+                    if not self.client.writing_paused:
+                        self.connection.resume_reading()
+                    self.write_chunk(await compression.compress(encoder, data))
+                elif self.keep_alive is not None:
+                    self.write_chunk(await compression.finish(encoder))
+                    self.client.write(b"0\r\n\r\n")
+                    if not self.done.done():
+                        self.done.set_result(self.keep_alive)
+                    return
+                else:
+                    self.wakeup = self.loop.create_future()
+                    await self.wakeup
+                    self.wakeup = None
+        except Exception as exc:
+            # relay() only expects connection and parser errors
+            self.fail(ConnectionError(f"Compression failed: {exc!r}"))
+
+    # httptools callbacks
+    def on_header(self, name: bytes, value: bytes) -> None:
+        self.headers.append((name, value))
+
+    def on_headers_complete(self) -> None:
+        if not self.head_only and self.compression.should_compress(self.parser.get_status_code(), self.headers):
+            self.compressing = True
+            # Replaces the upstream head held back so far
+            self.buffer = [self.build_head(self.parser.get_status_code())]
+            self.until_close = not any(name.lower() in (b"content-length", b"transfer-encoding") for name, _ in self.headers)
+        super().on_headers_complete()
+
+    def on_body(self, body: bytes) -> None:
+        if self.compressing:
+            self.chunks.append(body)
+            self.backlog += len(body)
+            if self.backlog > COMPRESSION_BACKLOG:
+                self.connection.pause_reading()
+            self.wake()
+
+    def on_message_complete(self) -> None:
+        if not self.compressing:
+            super().on_message_complete()
+        elif self.keep_alive is None:
+            self.keep_alive = self.parser.should_keep_alive()
+            self.wake()
+
+
+class UpstreamProtocol(asyncio.Protocol):
+    def __init__(self, server: BackendServer):
+        self.server = server
+        self.transport = None
+        self.exchange = None
+        self.closed = False
+        self.reading_paused = False
+        self.idle_since = 0.0
+        # Read by the idle sweeper while relaying an event stream
+        self.last_activity = 0.0
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        if self.exchange is None:
+            # Nothing was asked, the connection is out of sync
+            self.close()
+            return
+        self.last_activity = time.monotonic()
+        self.exchange.feed(data)
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.closed = True
+        if self.exchange is not None:
+            self.exchange.connection_lost()
+
+    def send(self, loop: asyncio.AbstractEventLoop, head: bytes, body: bytes, client: "ClientProtocol", head_only: bool, encoding: str = None) -> Exchange:
+        if encoding is None:
+            self.exchange = Exchange(loop, client, head_only)
+        else:
+            self.exchange = CompressingExchange(loop, client, head_only, self, client.proxy.lb.compression, encoding)
+        if body:
+            self.transport.writelines((head, body))
+        else:
+            self.transport.write(head)
+        return self.exchange
+
+    def pause_reading(self) -> None:
+        if not self.reading_paused and not self.closed:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self) -> None:
+        if self.reading_paused and not self.closed:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def close(self) -> None:
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+
+class TunnelProtocol(asyncio.Protocol):
+    """Upstream side of an upgraded connection, a WebSocket or anything else asked for with Upgrade.
+
+    The upstream's answer to the upgrade request goes to the client as is.
+    After a 101 bytes are copied both ways without being looked at, any
+    other answer ends the tunnel once it is complete. Not pooled, the
+    connection closes with the client's.
+    """
+    __slots__ = ("server", "client", "done", "transport", "parser", "last_activity", "closed", "reading_paused")
+
+    def __init__(self, server: BackendServer, client: "ClientProtocol", done: asyncio.Future):
+        self.server = server
+        self.client = client
+        self.done = done
+        self.transport = None
+        self.parser = httptools.HttpResponseParser(self)
+        # Read by the idle sweeper of LongLivedConnections
+        self.last_activity = time.monotonic()
+        self.closed = False
+        self.reading_paused = False
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+
+    def data_received(self, data: bytes) -> None:
+        self.last_activity = time.monotonic()
+        self.client.write(data)
+        if self.parser is not None:
+            try:
+                self.parser.feed_data(data)
+            except httptools.HttpParserUpgrade:
+                # Switched protocols, nothing is parsed from here on
+                self.parser = None
+            except httptools.HttpParserError:
+                self.close()
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.closed = True
+        if not self.done.done():
+            self.done.set_result(None)
+
+    # Bytes from the client
+    def forward(self, data: bytes) -> None:
+        self.last_activity = time.monotonic()
+        if not self.closed:
+            self.transport.write(data)
+
+    # httptools callback, a 101 is followed by HttpParserUpgrade
+    def on_message_complete(self) -> None:
+        if self.parser.get_status_code() != 101:
+            self.close()
+
+    # Flow control both ways, the client is paused while the upstream can't keep up
+    def pause_writing(self) -> None:
+        self.client.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.client.transport.resume_reading()
+
+    def pause_reading(self) -> None:
+        if not self.reading_paused and not self.closed:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def resume_reading(self) -> None:
+        if self.reading_paused and not self.closed:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    def close(self) -> None:
+        self.closed = True
+        if self.transport is not None:
+            self.transport.close()
+
+
+class RawUpstreamPool:
+    def __init__(self, config: dict):
+        self.config = config
+        self.max_keepalive = config['pool_max_keepalive']
+        self.keepalive_expiry = config['pool_keepalive_expiry']
+
+        self.idle: Dict[BackendServer, Deque[UpstreamProtocol]] = {}
+        # Bounds the connections leased out per server
+        self.leases: Dict[BackendServer, asyncio.Semaphore] = {}
+        self.requests: Dict[BackendServer, int] = {}
+        self.misses: Dict[BackendServer, int] = {}
+
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.idle:
+            return
+        self.idle[server] = deque()
+        self.leases[server] = asyncio.Semaphore(self.config['pool_max_connections'])
+        self.requests[server] = 0
+        self.misses[server] = 0
+
+    async def acquire(self, server: BackendServer) -> UpstreamProtocol:
+        if server not in self.idle:
+            self.add_server(server)
+
+        lease = self.leases[server]
+        await asyncio.wait_for(lease.acquire(), self.config['next_timeout'])
+        self.requests[server] += 1
+
+        loop = asyncio.get_running_loop()
+        idle = self.idle[server]
+        now = loop.time()
+        while idle:
+            # LIFO keeps the most recently used connections warm
+            connection = idle.pop()
+            if connection.closed or now - connection.idle_since > self.keepalive_expiry:
+                connection.close()
+                continue
+            return connection
+
+        self.misses[server] += 1
+        try:
+            _, connection = await asyncio.wait_for(
+                loop.create_connection(lambda: UpstreamProtocol(server), server.host, server.port),
+                self.config['connect_timeout']
+            )
+        except BaseException:
+            lease.release()
+            raise
+
+        return connection
+
+    def release(self, connection: UpstreamProtocol) -> None:
+        connection.exchange = None
+        connection.resume_reading()
+        idle = self.idle.get(connection.server)
+        if idle is not None and not connection.closed and len(idle) < self.max_keepalive:
+            connection.idle_since = asyncio.get_running_loop().time()
+            idle.append(connection)
+        else:
+            connection.close()
+        self.release_lease(connection.server)
+
+    async def prewarm(self, server: BackendServer, count: int) -> int:
+        """Opens up to `count` idle connections to the server, returns how many were added to the pool."""
+        if server not in self.idle:
+            self.add_server(server)
+        idle = self.idle[server]
+        loop = asyncio.get_running_loop()
+        results = await asyncio.gather(*[
+            asyncio.wait_for(
+                loop.create_connection(lambda: UpstreamProtocol(server), server.host, server.port),
+                self.config['connect_timeout']
+            )
+            for _ in range(min(count, self.max_keepalive - len(idle)))
+        ], return_exceptions=True)
+
+        opened = 0
+        now = loop.time()
+        for result in results:
+            if isinstance(result, BaseException):
+                continue
+            connection = result[1]
+            # The server was removed meanwhile, or requests filled its pool
+            if self.idle.get(server) is not idle or len(idle) >= self.max_keepalive:
+                connection.close()
+                continue
+            connection.idle_since = now
+            idle.append(connection)
+            opened += 1
+        return opened
+
+    def discard(self, connection: UpstreamProtocol) -> None:
+        connection.exchange = None
+        connection.close()
+        self.release_lease(connection.server)
+
+    def release_lease(self, server: BackendServer) -> None:
+        # Gone when the server was removed while this connection was still out
+        lease = self.leases.get(server)
+        if lease is not None:
+            lease.release()
+
+    def remove_server(self, server: BackendServer) -> None:
+        idle = self.idle.pop(server, None)
+        while idle:
+            idle.pop().close()
+        self.leases.pop(server, None)
+        self.requests.pop(server, None)
+        self.misses.pop(server, None)
+
+    def close(self) -> None:
+        for idle in self.idle.values():
+            while idle:
+                idle.pop().close()
+
+    def get_stats(self) -> dict:
+        total_requests = sum(self.requests.values())
+        total_misses = sum(self.misses.values())
+        return {
+            "pool_hits": total_requests - total_misses,
+            "pool_misses": total_misses,
+            "servers": [
+                {
+                    "url": server.get_url(),
+                    "pool_hits": self.requests[server] - self.misses[server],
+                    "pool_misses": self.misses[server],
+                    "idle_connections": len(self.idle[server])
+                }
+                for server in self.idle
+            ]
+        }
+
+
+class ClientProtocol(asyncio.Protocol):
+    def __init__(self, proxy: "RawProxyServer"):
+        self.proxy = proxy
+        self.loop = proxy.loop
+        self.parser = httptools.HttpRequestParser(self)
+        self.transport = None
+        self.client_ip = None
+        self.closed = False
+        self.reading_paused = False
+        self.writing_paused = False
+
+        self.pending: Deque[ProxyRequest] = deque()
+        self.task = None
+        # Upstream connection currently relaying a response to this client
+        self.upstream = None
+        # Once upgraded, bytes after the upgrade request wait here until the tunnel is up
+        self.upgrade_buffer = None
+        self.tunnel = None
+
+        self.url = b""
+        self.headers = []
+        self.body = []
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        self.transport = transport
+        peername = transport.get_extra_info("peername")
+        self.client_ip = peername[0] if peername else None
+
+    def connection_lost(self, exc: Exception) -> None:
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+
+    def data_received(self, data: bytes) -> None:
+        if self.tunnel is not None:
+            self.tunnel.forward(data)
+            return
+        if self.upgrade_buffer is not None:
+            self.upgrade_buffer.append(data)
+            return
+
+        try:
+            self.parser.feed_data(data)
+        except httptools.HttpParserUpgrade as exc:
+            # The rest isn't HTTP anymore, hold it and stop reading until the upstream is connected
+            self.upgrade_buffer = [data[exc.args[0]:]]
+            if not self.reading_paused:
+                self.reading_paused = True
+                self.transport.pause_reading()
+        except httptools.HttpParserError:
+            self.write(error_response(400, "Bad Request"))
+            self.transport.close()
+
+    def write(self, data: bytes) -> None:
+        if not self.closed:
+            self.transport.write(data)
+
+    # Flow control, a slow client stops reads from the upstream it is fed by
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+        if self.upstream is not None:
+            self.upstream.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        if self.upstream is not None:
+            self.upstream.resume_reading()
+
+    # httptools callbacks
+    def on_message_begin(self) -> None:
+        self.url = b""
+        self.headers = []
+        self.body = []
+
+    def on_url(self, url: bytes) -> None:
+        self.url += url
+
+    def on_header(self, name: bytes, value: bytes) -> None:
+        self.headers.append((name, value))
+
+    def on_headers_complete(self) -> None:
+        for name, value in self.headers:
+            if name.lower() == b"expect" and value.lower() == b"100-continue":
+                self.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+
+    def on_body(self, body: bytes) -> None:
+        self.body.append(body)
+
+    def on_message_complete(self) -> None:
+        request = ProxyRequest(self.parser.get_method(), self.url, self.headers, self.body, self.parser.should_keep_alive())
+        request.upgrade = self.parser.should_upgrade()
+        compression = self.proxy.lb.compression
+        # Compressed responses are sent chunked, which HTTP/1.0 clients don't understand
+        if compression.enabled and self.parser.get_http_version() == "1.1":
+            request.encoding = compression.negotiate_request(request.method.decode("latin-1"), self.headers)
+        self.pending.append(request)
+
+        if len(self.pending) >= MAX_PIPELINED_REQUESTS and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+        if self.task is None:
+            self.task = self.loop.create_task(self.process_requests())
+
+    def start_tunnel(self, tunnel: TunnelProtocol, head: bytes) -> None:
+        # Whatever the client sent after the upgrade request follows it
+        tunnel.transport.writelines([head] + self.upgrade_buffer)
+        self.upgrade_buffer = None
+        self.tunnel = tunnel
+        self.upstream = tunnel
+        if self.writing_paused:
+            tunnel.pause_reading()
+        if self.reading_paused:
+            self.reading_paused = False
+            self.transport.resume_reading()
+
+    async def process_requests(self) -> None:
+        try:
+            # Pipelined requests are answered one at a time, in order
+            while self.pending and not self.closed:
+                request = self.pending.popleft()
+                if request.upgrade:
+                    # Always the last request, the connection is handed over to the tunnel
+                    await self.proxy.tunnel(self, request)
+                    self.transport.close()
+                    return
+                if self.reading_paused and len(self.pending) < MAX_PIPELINED_REQUESTS:
+                    self.reading_paused = False
+                    self.transport.resume_reading()
+
+                lb = self.proxy.lb
+                metrics = lb.metrics
+                if lb.access_log.sample_rate:
+                    path = request.url.split(b"?", 1)[0].decode("latin-1")
+                    request.access = lb.access_log.sample(request.method.decode("latin-1"), path, self.client_ip)
+                metrics.in_flight += 1
+                started = time.perf_counter()
+                try:
+                    keep_alive = await self.proxy.forward(self, request)
+                finally:
+                    metrics.in_flight -= 1
+                    metrics.observe_request(request.status_code, time.perf_counter() - started)
+                    if request.access is not None:
+                        request.access.status = request.status_code
+                        lb.access_log.access(request.access)
+                if not keep_alive:
+                    self.transport.close()
+                    return
+        finally:
+            self.task = None
+
+
+class RawProxyServer:
+    """HTTP/1.1 pass-through engine on asyncio protocols, bypassing FastAPI.
+
+    Server selection, health state and counters are shared with the
+    LoadBalancer, only the request handling is different.
+    """
+    def __init__(self, lb):
+        self.lb = lb
+        self.config = lb.config
+        self.loop = None
+        self.pool = RawUpstreamPool(lb.config)
+
+    async def serve(self, host: str, port: int, sock: socket.socket = None) -> None:
+        self.loop = asyncio.get_running_loop()
+        for server in self.lb.backend_servers:
+            self.pool.add_server(server)
+
+        if sock is not None:
+            server = await self.loop.create_server(lambda: ClientProtocol(self), sock=sock, backlog=2048)
+        else:
+            server = await self.loop.create_server(lambda: ClientProtocol(self), host=host, port=port, backlog=2048)
+        print(f"Raw proxy engine listening on {host}:{port}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            self.pool.close()
+
+    async def forward(self, client: ClientProtocol, request: ProxyRequest) -> bool:
+        if is_event_stream(request.headers):
+            # Open ended, left to LongLivedConnections instead of max_inflight
+            return await self.dispatch(client, request, long_lived=True)
+
+        admission = self.lb.admission
+        try:
+            await admission.admit()
+        except HTTPException as e:
+            return self.reject(client, request, e)
+
+        try:
+            return await self.dispatch(client, request)
+        finally:
+            admission.release()
+
+    async def tunnel(self, client: ClientProtocol, request: ProxyRequest) -> None:
+        """Connects an upgrade request to the backend with the fewest open connections and relays it until either side closes."""
+        lb = self.lb
+        if request.method == b"CONNECT":
+            request.status_code = 501
+            client.write(error_response(501, "Not Implemented"))
+            return
+
+        tried = set()
+        retry = 0
+        while True:
+            try:
+                server = lb.long_lived.pick(exclude=tried)
+            except HTTPException as e:
+                self.reject(client, request, e)
+                return
+
+            # Held while connecting so concurrent upgrades spread out too
+            lb.lb_algo.acquire(server)
+            done = self.loop.create_future()
+            started = time.monotonic()
+            try:
+                _, upstream = await asyncio.wait_for(
+                    self.loop.create_connection(partial(TunnelProtocol, server, client, done), server.host, server.port),
+                    self.config['connect_timeout']
+                )
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                lb.lb_algo.release(server)
+                lb.record_upstream(server, None, time.monotonic() - started)
+                if retry >= self.config['retries']:
+                    request.status_code = 502
+                    client.write(error_response(502, "Bad Gateway"))
+                    return
+                lb.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+                retry += 1
+                lb.metrics.retries += 1
+                tried.add(server)
+            except BaseException:
+                lb.lb_algo.release(server)
+                raise
+
+        server.increment_requests_served()
+        lb.total_requests_served += 1
+        lb.long_lived.track(upstream)
+        try:
+            client.start_tunnel(upstream, request.build_upgrade_head())
+            await done
+        finally:
+            lb.long_lived.untrack(upstream)
+            lb.lb_algo.release(server)
+            upstream.close()
+
+    def reject(self, client: ClientProtocol, request: ProxyRequest, exc: HTTPException) -> bool:
+        request.status_code = exc.status_code
+        client.write(error_response(exc.status_code, HTTPStatus(exc.status_code).phrase, exc.headers))
+        return request.keep_alive
+
+    async def dispatch(self, client: ClientProtocol, request: ProxyRequest, long_lived: bool = False) -> bool:
+        lb = self.lb
+        session = None
+        if long_lived:
+            select_server = lb.select_long_lived
+        else:
+            if lb.sessions.enabled:
+                session = lb.sessions.get_session(request.headers)
+            select_server = partial(lb.select_server, pinned=lb.sessions.lookup(session))
+        retry_policy = lb.retry_policy
+        retry_limit = self.config['retries']
+        body = b"".join(request.body)
+        head = request.build_head(len(body))
+        method = request.method.decode("latin-1")
+
+        try:
+            server = await select_server(ip=client.client_ip)
+        except HTTPException as e:
+            return self.reject(client, request, e)
+
+        retry_policy.start_request()
+        idempotent = retry_policy.is_idempotent(method, any(name.lower() == b"idempotency-key" for name, _ in request.headers))
+        hedge_delay = None if long_lived else retry_policy.hedge_delay(method, bool(body))
+        attempt = partial(self.attempt, client, head, body, method == "HEAD", None if long_lived else request.encoding)
+
+        tried = set()
+        retry = 0
+        while True:
+            started = time.monotonic()
+            try:
+                if hedge_delay is not None:
+                    server, (connection, exchange, status_code) = await retry_policy.hedge(
+                        hedge_delay, attempt, server, partial(lb.pick_hedge_server, client.client_ip, server, tried), self.discard
+                    )
+                else:
+                    connection, exchange, status_code = await attempt(server)
+            except (OSError, asyncio.TimeoutError, httptools.HttpParserError) as e:
+                if retry >= retry_limit or not retry_policy.can_retry(idempotent, not isinstance(e, UpstreamConnectError)):
+                    break
+                lb.access_log.event("warning", "retry", upstream=server.get_url(), error=repr(e))
+            else:
+                if status_code not in RETRY_STATUS_CODES or retry >= retry_limit or not retry_policy.can_retry(idempotent, True):
+                    request.status_code = status_code
+                    if request.access is not None:
+                        request.access.upstream = server.get_url()
+                        request.access.retries = retry
+                        request.access.upstream_time = time.monotonic() - started
+                    if long_lived:
+                        lb.long_lived.track(connection)
+                    header = lb.session_header(session, server)
+                    extra_headers = b"%s: %s\r\n" % header if header is not None else b""
+                    try:
+                        # Event streams go quiet on purpose, the long-lived idle sweeper looks after them
+                        idle_timeout = None if long_lived else self.config['read_timeout']
+                        return await self.relay(client, connection, exchange, server, request, extra_headers, idle_timeout)
+                    finally:
+                        if long_lived:
+                            lb.long_lived.untrack(connection)
+                        lb.lb_algo.release(server)
+
+                lb.access_log.event("warning", "retry", upstream=server.get_url(), status=status_code)
+                await self.discard(server, (connection, exchange, status_code))
+
+            retry += 1
+            lb.metrics.retries += 1
+            tried.add(server)
+            await retry_policy.backoff(retry)
+            try:
+                server = await select_server(ip=client.client_ip, exclude=tried)
+            except HTTPException:
+                break
+
+        request.status_code = 502
+        client.write(error_response(502, "Bad Gateway"))
+        return request.keep_alive
+
+    async def attempt(self, client: ClientProtocol, head: bytes, body: bytes, head_only: bool, encoding: str, server: BackendServer) -> Tuple[UpstreamProtocol, Exchange, int]:
+        """Sends the request to `server` and waits for the status line.
+
+        On success the server stays acquired and the connection is left to
+        relay() or discard().
+        """
+        lb = self.lb
+        lb.lb_algo.acquire(server)
+        started = time.monotonic()
+        connection = None
+        try:
+            try:
+                connection = await self.pool.acquire(server)
+            except (OSError, asyncio.TimeoutError) as e:
+                raise UpstreamConnectError(f"No connection to {server.get_url()}: {e!r}") from e
+            exchange = connection.send(self.loop, head, body, client, head_only, encoding)
+            status_code = await asyncio.wait_for(exchange.headers_done, self.config['read_timeout'])
+        except (OSError, asyncio.TimeoutError, httptools.HttpParserError):
+            lb.record_upstream(server, None, time.monotonic() - started)
+            if connection is not None:
+                self.pool.discard(connection)
+            lb.lb_algo.release(server)
+            raise
+        except BaseException:
+            # Client went away or the attempt lost a hedge, the connection is left mid-exchange
+            if connection is not None:
+                self.pool.discard(connection)
+            lb.lb_algo.release(server)
+            raise
+
+        lb.record_upstream(server, status_code, time.monotonic() - started)
+        return connection, exchange, status_code
+
+    async def wait_for_body(self, exchange: Exchange, connection: UpstreamProtocol, idle_timeout: float = None) -> bool:
+        """Waits for the end of the response, TimeoutError once the upstream sent nothing for `idle_timeout` seconds.
+
+        Time the upstream spends paused because the client reads slowly
+        doesn't count, like httpx's read timeout it limits the gap between
+        reads, not the whole body.
+        """
+        if not idle_timeout:
+            return await exchange.done
+        while True:
+            remaining = idle_timeout
+            if not connection.reading_paused:
+                remaining -= time.monotonic() - connection.last_activity
+                if remaining <= 0:
+                    raise asyncio.TimeoutError()
+            try:
+                return await asyncio.wait_for(asyncio.shield(exchange.done), remaining)
+            except asyncio.TimeoutError:
+                continue
+
+    async def discard(self, server: BackendServer, result: Tuple[UpstreamProtocol, Exchange, int]) -> None:
+        self.pool.discard(result[0])
+        self.lb.lb_algo.release(server)
+
+    async def relay(self, client: ClientProtocol, connection: UpstreamProtocol, exchange: Exchange, server: BackendServer,
+                    request: ProxyRequest, extra_headers: bytes = b"", idle_timeout: float = None) -> bool:
+        server.increment_requests_served()
+        self.lb.total_requests_served += 1
+
+        client.upstream = connection
+        if client.writing_paused:
+            connection.pause_reading()
+        exchange.start_forwarding(extra_headers)
+
+        try:
+            upstream_keep_alive = await self.wait_for_body(exchange, connection, idle_timeout)
+        except asyncio.TimeoutError:
+            # The upstream stalled mid-body, give up on both sides instead of holding them forever
+            self.lb.access_log.event("warning", "upstream stalled", upstream=server.get_url(), idle_timeout=idle_timeout)
+            exchange.done.cancel()
+            self.pool.discard(connection)
+            return False
+        except (OSError, httptools.HttpParserError):
+            # The response was cut short, the client can't recover the framing
+            self.pool.discard(connection)
+            return False
+        except asyncio.CancelledError:
+            self.pool.discard(connection)
+            raise
+        finally:
+            client.upstream = None
+
+        if upstream_keep_alive:
+            self.pool.release(connection)
+        else:
+            self.pool.discard(connection)
+
+        return request.keep_alive and exchange.framed
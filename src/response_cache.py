@@ -0,0 +1,276 @@
+import asyncio, time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+from access_log import AccessLog
+
+# Status codes that are cacheable by default (RFC 9110 15.1)
+CACHEABLE_STATUS_CODES = {200, 203, 204, 300, 301, 308, 404, 405, 410, 414, 501}
+# How long a key whose response couldn't be stored skips waiting on concurrent misses, and how many such keys are kept
+PASS_TTL = 60
+MAX_PASS_KEYS = 10000
+
+def parse_cache_control(value: str) -> Dict[str, Optional[str]]:
+    directives = {}
+    for part in value.split(","):
+        name, _, arg = part.strip().partition("=")
+        if name:
+            directives[name.lower()] = arg.strip('"') if arg else None
+    return directives
+
+def parse_seconds(value: Optional[str]) -> Optional[int]:
+    try:
+        return max(int(value), 0)
+    except (TypeError, ValueError):
+        return None
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return None
+
+def get_header(headers: List[Tuple[bytes, bytes]], name: bytes) -> Optional[str]:
+    values = [value.decode("latin-1") for key, value in headers if key.lower() == name]
+    return ", ".join(values) if values else None
+
+class CachedResponse:
+    __slots__ = ("status_code", "headers", "body", "size", "stored_at", "expires_at", "stale_until")
+
+    def __init__(self, status_code: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        self.status_code = status_code
+        self.headers = headers
+        self.body = body
+        # Body plus headers, the bookkeeping of small entries is roughly constant
+        self.size = len(body) + sum(len(key) + len(value) for key, value in headers)
+        # Monotonic time it was stored at, 0 for responses that weren't
+        self.stored_at = 0.0
+        self.expires_at = 0.0
+        self.stale_until = 0.0
+
+    def get_age(self, now: float) -> int:
+        return int(now - self.stored_at)
+
+class ResponseCache:
+    """In-process cache of upstream responses, bounded by bytes with LRU eviction.
+
+    Freshness comes from Cache-Control (s-maxage, max-age) or Expires, with
+    `default_ttl` for responses that say nothing. Stale entries within their
+    stale-while-revalidate window are served while one background request
+    refreshes them, and concurrent misses on a key wait for a single
+    upstream request instead of all going to the backends. Keys whose
+    response couldn't be stored are remembered for PASS_TTL seconds and
+    go straight to the backends, waiting would only delay them.
+    """
+    def __init__(self, config: dict, access_log: AccessLog):
+        self.enabled = config['cache']
+        self.access_log = access_log
+        self.max_bytes = config['cache_max_bytes']
+        self.max_entry_bytes = config['cache_max_entry_bytes']
+        self.default_ttl = config['cache_default_ttl']
+
+        self.entries: "OrderedDict[str, CachedResponse]" = OrderedDict()
+        self.bytes = 0
+        self.inflight: Dict[str, asyncio.Future] = {}
+        self.refreshing: Set[asyncio.Task] = set()
+        # Key to the monotonic time it may be coalesced again, oldest first
+        self.pass_until: "OrderedDict[str, float]" = OrderedDict()
+
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.passes = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def is_cacheable_request(self, method: str, headers) -> bool:
+        if method not in ("GET", "HEAD"):
+            return False
+        # Responses to authenticated requests are per user
+        if "authorization" in headers:
+            return False
+        return "no-store" not in parse_cache_control(headers.get("cache-control", ""))
+
+    def make_key(self, method: str, url: str, headers) -> str:
+        # Compressed and identity responses are different entries, other Vary headers aren't stored
+        return f"{method} {url} {headers.get('accept-encoding', '')}"
+
+    def get_lifetime(self, response: CachedResponse, now: float) -> Optional[Tuple[float, float]]:
+        if len(response.body) > self.max_entry_bytes:
+            return None
+        return self.get_header_lifetime(response.status_code, response.headers)
+
+    def may_store(self, status_code: int, headers: List[Tuple[bytes, bytes]]) -> bool:
+        """Whether a response could be stored, judged from its headers before its body is read."""
+        length = get_header(headers, b"content-length")
+        if length is not None and length.isdigit() and int(length) > self.max_entry_bytes:
+            return False
+        return self.get_header_lifetime(status_code, headers) is not None
+
+    def get_header_lifetime(self, status_code: int, headers: List[Tuple[bytes, bytes]]) -> Optional[Tuple[float, float]]:
+        if status_code not in CACHEABLE_STATUS_CODES:
+            return None
+        if get_header(headers, b"set-cookie") is not None:
+            return None
+        vary = get_header(headers, b"vary")
+        if vary is not None and any(name.strip().lower() != "accept-encoding" for name in vary.split(",")):
+            return None
+
+        directives = parse_cache_control(get_header(headers, b"cache-control") or "")
+        if "no-store" in directives or "no-cache" in directives or "private" in directives:
+            return None
+
+        ttl = parse_seconds(directives.get("s-maxage"))
+        if ttl is None:
+            ttl = parse_seconds(directives.get("max-age"))
+        if ttl is None:
+            expires = parse_http_date(get_header(headers, b"expires"))
+            if expires is not None:
+                date = parse_http_date(get_header(headers, b"date")) or time.time()
+                ttl = max(expires - date, 0)
+        if ttl is None:
+            ttl = self.default_ttl
+        else:
+            ttl -= parse_seconds(get_header(headers, b"age")) or 0
+
+        stale = parse_seconds(directives.get("stale-while-revalidate")) or 0
+        if ttl <= 0 and stale <= 0:
+            return None
+
+        return ttl, stale
+
+    def lookup(self, key: str) -> Optional[CachedResponse]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def store(self, key: str, response: CachedResponse, now: float) -> bool:
+        if not isinstance(response, CachedResponse):
+            # Streamed through, too large or not cacheable
+            return False
+        lifetime = self.get_lifetime(response, now)
+        if lifetime is None:
+            return False
+
+        ttl, stale = lifetime
+        response.stored_at = now
+        response.expires_at = now + ttl
+        response.stale_until = response.expires_at + stale
+
+        self.remove(key)
+        self.entries[key] = response
+        self.bytes += response.size
+        self.stores += 1
+
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted.size
+            self.evictions += 1
+        return True
+
+    def remove(self, key: str) -> None:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry.size
+
+    async def fetch(self, key: str, fetcher: Callable[[], Awaitable[CachedResponse]]) -> Tuple[CachedResponse, str]:
+        """Returns the response for `key` and whether it was a HIT, STALE or MISS.
+
+        The fetcher can return a streaming response instead of a
+        CachedResponse for bodies it didn't buffer, it is passed on as a
+        MISS and never shared or stored.
+        """
+        now = time.monotonic()
+        entry = self.lookup(key)
+        if entry is not None:
+            if now < entry.expires_at:
+                self.hits += 1
+                return entry, "HIT"
+            if now < entry.stale_until:
+                self.stale_hits += 1
+                if key not in self.inflight:
+                    self.revalidate(key, fetcher)
+                return entry, "STALE"
+            self.remove(key)
+
+        self.misses += 1
+        if self.pass_until.get(key, 0) > now:
+            self.passes += 1
+            response = await self.fetch_pass(key, fetcher)
+            return response, "MISS"
+
+        waiter = self.inflight.get(key)
+        if waiter is not None:
+            self.coalesced += 1
+            # The shared response is only reused when it could be cached, otherwise fetch our own
+            entry = await asyncio.shield(waiter)
+            if entry is not None:
+                return entry, "HIT"
+            return await fetcher(), "MISS"
+
+        return await self.fetch_and_store(key, fetcher), "MISS"
+
+    async def fetch_pass(self, key: str, fetcher: Callable[[], Awaitable[CachedResponse]]) -> CachedResponse:
+        response = await fetcher()
+        # The upstream may have made it cacheable since, coalesce it again from now on
+        if self.store(key, response, time.monotonic()):
+            self.pass_until.pop(key, None)
+        return response
+
+    def mark_pass(self, key: str, now: float) -> None:
+        self.pass_until.pop(key, None)
+        self.pass_until[key] = now + PASS_TTL
+        while len(self.pass_until) > MAX_PASS_KEYS:
+            self.pass_until.popitem(last=False)
+
+    async def fetch_and_store(self, key: str, fetcher: Callable[[], Awaitable[CachedResponse]], waiter: asyncio.Future = None,
+                              background: bool = False) -> CachedResponse:
+        if waiter is None:
+            waiter = self.inflight[key] = asyncio.get_running_loop().create_future()
+        stored = None
+        try:
+            response = await fetcher()
+            now = time.monotonic()
+            if self.store(key, response, now):
+                stored = response
+            else:
+                self.mark_pass(key, now)
+                if background and not isinstance(response, CachedResponse):
+                    # Nobody reads a revalidation that turned into a stream
+                    await response.aclose()
+            return response
+        finally:
+            del self.inflight[key]
+            waiter.set_result(stored)
+
+    def revalidate(self, key: str, fetcher: Callable[[], Awaitable[CachedResponse]]) -> None:
+        # Registered before the task first runs, stale hits until then mustn't start another one
+        waiter = self.inflight[key] = asyncio.get_running_loop().create_future()
+        task = asyncio.ensure_future(self.fetch_and_store(key, fetcher, waiter, background=True))
+        self.refreshing.add(task)
+        task.add_done_callback(self.revalidated)
+
+    def revalidated(self, task: asyncio.Task) -> None:
+        self.refreshing.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            self.access_log.event("warning", "cache revalidation failed", error=repr(task.exception()))
+
+    def get_stats(self) -> dict:
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "passes": self.passes,
+            "pass_keys": len(self.pass_until),
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
@@ -0,0 +1,191 @@
+import asyncio, random, time
+import httpx
+from functools import partial
+from typing import Awaitable, Callable, Optional, Set, Tuple, TypeVar
+from server import BackendServer
+from metrics import Metrics
+
+T = TypeVar("T")
+
+# RFC 9110 9.2.2, repeating these has the same effect as sending them once
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "TRACE", "PUT", "DELETE"}
+# Failures before the request reached the backend, safe to retry for any method
+UNSENT_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+
+# Most tokens the budget saves up while traffic is quiet
+RETRY_BUDGET_CAPACITY = 100
+# Upstream responses seen before hedging starts, the percentile means little before that
+HEDGE_MIN_SAMPLES = 100
+HEDGE_WINDOW = 1024
+# The percentile is recomputed after this many new samples instead of on every request
+HEDGE_RECOMPUTE_EVERY = 128
+
+class RetryBudget:
+    """Token bucket that keeps retries to a share of the requests.
+
+    Every request adds `ratio` tokens and every retry or hedge takes a whole
+    one, so a brownout adds at most `ratio` extra load instead of multiplying
+    it by `retries + 1`. `min_per_second` tokens trickle in regardless so
+    that a quiet balancer can still retry.
+    """
+    def __init__(self, ratio: float, min_per_second: float):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.tokens = float(min_per_second)
+        self.updated = time.monotonic()
+
+    def deposit(self) -> None:
+        tokens = self.tokens + self.ratio
+        self.tokens = tokens if tokens < RETRY_BUDGET_CAPACITY else RETRY_BUDGET_CAPACITY
+
+    def withdraw(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.tokens + (now - self.updated) * self.min_per_second, RETRY_BUDGET_CAPACITY)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class LatencyTracker:
+    """Percentile of the most recent upstream response times."""
+    def __init__(self, percentile: float):
+        self.percentile = percentile
+        self.samples = [0.0] * HEDGE_WINDOW
+        self.count = 0
+        self.value = None
+
+    def observe(self, seconds: float) -> None:
+        self.samples[self.count % HEDGE_WINDOW] = seconds
+        self.count += 1
+        if self.count >= HEDGE_MIN_SAMPLES and self.count % HEDGE_RECOMPUTE_EVERY == 0 or self.count == HEDGE_MIN_SAMPLES:
+            self.recompute()
+
+    def recompute(self) -> None:
+        samples = sorted(self.samples[:min(self.count, HEDGE_WINDOW)])
+        self.value = samples[min(int(len(samples) * self.percentile / 100), len(samples) - 1)]
+
+class RetryPolicy:
+    """Decides whether a failed attempt may be retried and when GETs are hedged.
+
+    Retries need a token from the budget. Once a request may have reached a
+    backend, only idempotent methods (or requests with an Idempotency-Key)
+    are retried. Retries back off exponentially with full jitter. Hedged
+    requests go to a second backend when the first hasn't answered within
+    the `hedge_percentile` of recent upstream times, the first response wins.
+    """
+    def __init__(self, config: dict, metrics: Metrics):
+        self.metrics = metrics
+        self.budget = RetryBudget(config['retry_budget_ratio'], config['retry_budget_min_per_second'])
+        self.latency = LatencyTracker(config['hedge_percentile'])
+        # Discards of hedges that finished after losing
+        self.discarding: Set[asyncio.Task] = set()
+        self.update_config(config)
+
+    def update_config(self, config: dict) -> None:
+        self.budget.ratio = config['retry_budget_ratio']
+        self.budget.min_per_second = config['retry_budget_min_per_second']
+        self.backoff_base = config['retry_backoff_base']
+        self.backoff_max = config['retry_backoff_max']
+        self.hedge_enabled = config['hedge']
+        self.hedge_min_delay = config['hedge_min_delay']
+        if config['hedge_percentile'] != self.latency.percentile:
+            self.latency.percentile = config['hedge_percentile']
+            if self.latency.value is not None:
+                self.latency.recompute()
+
+    def is_idempotent(self, method: str, has_idempotency_key: bool) -> bool:
+        return method in IDEMPOTENT_METHODS or has_idempotency_key
+
+    def start_request(self) -> None:
+        self.budget.deposit()
+
+    def can_retry(self, idempotent: bool, sent: bool) -> bool:
+        """`sent` is False when the attempt failed before the request went out."""
+        if sent and not idempotent:
+            self.metrics.retries_skipped += 1
+            return False
+        if not self.budget.withdraw():
+            self.metrics.retries_throttled += 1
+            return False
+        return True
+
+    async def backoff(self, retry: int) -> None:
+        # Full jitter, retries spread out instead of arriving in waves
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (1 << (retry - 1))))
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def observe(self, seconds: float) -> None:
+        if self.hedge_enabled:
+            self.latency.observe(seconds)
+
+    def hedge_delay(self, method: str, has_body: bool) -> Optional[float]:
+        """Seconds to wait before hedging this request, None when it isn't hedged."""
+        if not self.hedge_enabled or has_body or method not in ("GET", "HEAD") or self.latency.value is None:
+            return None
+        return max(self.latency.value, self.hedge_min_delay)
+
+    async def hedge(self, delay: float, attempt: Callable[[BackendServer], Awaitable[T]], server: BackendServer,
+                    pick: Callable[[], Optional[BackendServer]],
+                    discard: Callable[[BackendServer, T], Awaitable[None]]) -> Tuple[BackendServer, T]:
+        """Runs `attempt` on `server` and, if it takes longer than `delay`, on a second server from `pick`.
+
+        Returns the server and result of the first attempt that didn't raise,
+        the other one is cancelled or, when it finished too, discarded. If
+        both fail the first attempt's error is raised.
+        """
+        loop = asyncio.get_running_loop()
+        primary = loop.create_task(attempt(server))
+        tasks = {primary: server}
+        try:
+            done, _ = await asyncio.wait([primary], timeout=delay)
+            if done:
+                return server, primary.result()
+
+            hedge_server = pick()
+            if hedge_server is None or not self.budget.withdraw():
+                return server, await primary
+
+            self.metrics.hedges += 1
+            secondary = loop.create_task(attempt(hedge_server))
+            tasks[secondary] = hedge_server
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    winner = winners[0]
+                    if winner is secondary:
+                        self.metrics.hedge_wins += 1
+                    for task in winners[1:]:
+                        self.discard_later(discard, tasks[task], task)
+                    return tasks[winner], winner.result()
+
+            return server, primary.result()
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+                    task.add_done_callback(partial(self.discard_later, discard, tasks[task]))
+
+    def discard_later(self, discard: Callable[[BackendServer, T], Awaitable[None]], server: BackendServer, task: asyncio.Task) -> None:
+        # A cancelled attempt can still have finished first, its result must be cleaned up
+        if task.cancelled() or task.exception() is not None:
+            return
+        cleanup = asyncio.ensure_future(discard(server, task.result()))
+        self.discarding.add(cleanup)
+        cleanup.add_done_callback(self.discarding.discard)
+
+    def get_stats(self, metrics: Metrics) -> dict:
+        return {
+            "budget_tokens": round(self.budget.tokens, 2),
+            "budget_ratio": self.budget.ratio,
+            "retries": metrics.retries,
+            "retries_throttled": metrics.retries_throttled,
+            "retries_skipped_non_idempotent": metrics.retries_skipped,
+            "hedge": self.hedge_enabled,
+            "hedge_delay_ms": round(max(self.latency.value, self.hedge_min_delay) * 1000, 3) if self.latency.value is not None else None,
+            "hedges": metrics.hedges,
+            "hedge_wins": metrics.hedge_wins
+        }
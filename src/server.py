@@ -1,3 +1,4 @@
+import math
 from enum import Enum
 
 class ServerStatus(Enum):
@@ -6,17 +7,45 @@ class ServerStatus(Enum):
     DEAD = 3
 
 class BackendServer:
-    def __init__(self, host, port, weight=1):
+    """One upstream, kept small because a fleet can have thousands of them.
+
+    `__slots__` leaves out the per-instance dict and the URL is formatted
+    once, it is read on every request, probe and hash ring insert. `health`
+    is the only health state, the health checker keeps its probe counters
+    here as well.
+    """
+    __slots__ = ("host", "port", "url", "weight", "max_connections", "http2", "active_connections",
+                 "long_lived_connections", "failures", "health", "fail_count", "pass_count", "ejected_until",
+                 "requests_served", "latency_ewma", "latency_updated", "ring_points")
+
+    def __init__(self, host, port, weight=1, max_connections=0, http2=False):
         self.host = host
         self.port = port
+        self.url = f"http://{host}:{port}"
         self.weight = weight
+        # Requests in flight this server takes at most, 0 for no limit
+        self.max_connections = max_connections
+        # Talk h2c with prior knowledge, requests share multiplexed connections
+        self.http2 = http2
         self.active_connections = 0
+        # WebSockets, tunnels and event streams, also counted in active_connections
+        self.long_lived_connections = 0
         self.failures = 0
         self.health = ServerStatus.UNHEALTHY
+        # Consecutive probe results and the end of a passive ejection, see HealthCheck
+        self.fail_count = 0
+        self.pass_count = 0
+        self.ejected_until = 0.0
         self.requests_served = 0
 
+        # Peak-EWMA of the response time in seconds, 0 until the first response
+        self.latency_ewma = 0.0
+        self.latency_updated = 0.0
+        # Hash ring points of the URL, computed on the first insert and kept across health flaps
+        self.ring_points = None
+
     def __str__(self):
-        return (f"Server: {self.get_url()}, "
+        return (f"Server: {self.url}, "
                 f"Weight: {self.weight}, "
                 f"health: {self.health}, "
                 f"Active Connections: {self.active_connections}, "
@@ -26,7 +55,7 @@ class BackendServer:
         return self.__str__()
 
     def get_url(self) -> str:
-        return f"http://{self.host}:{self.port}"
+        return self.url
 
     def get_status(self) -> ServerStatus:
         if self.health == ServerStatus.HEALTHY:
@@ -48,13 +77,35 @@ class BackendServer:
     def increment_requests_served(self):
         self.requests_served += 1
 
+    def record_latency(self, rtt: float, decay_time: float, now: float) -> None:
+        # Jump straight to latency peaks, only decay back down over time
+        if rtt >= self.latency_ewma:
+            self.latency_ewma = rtt
+        else:
+            weight = math.exp(-max(now - self.latency_updated, 0.0) / decay_time)
+            self.latency_ewma = self.latency_ewma * weight + rtt * (1.0 - weight)
+        self.latency_updated = now
+
+    def get_latency(self, decay_time: float, now: float) -> float:
+        # A server that stopped getting traffic slowly looks fast again and gets probed
+        return self.latency_ewma * math.exp(-max(now - self.latency_updated, 0.0) / decay_time)
+
+    def reset_latency(self) -> None:
+        self.latency_ewma = 0.0
+        self.latency_updated = 0.0
+
     def get_stats(self) -> dict:
         return {
             "host": self.host,
             "port": self.port,
             "weight": self.weight,
-            "health": self.health,
+            "health": self.health.value,
             "failures": self.failures,
-            "requests_served": self.requests_served
+            "requests_served": self.requests_served,
+            "active_connections": self.active_connections,
+            "long_lived_connections": self.long_lived_connections,
+            "max_connections": self.max_connections,
+            "http2": self.http2,
+            "latency_ewma_ms": round(self.latency_ewma * 1000, 3)
         }
     
@@ -0,0 +1,41 @@
+import asyncio, json, time
+from types import MappingProxyType
+from typing import Callable, Dict, Mapping
+
+class StatsSnapshot:
+    """JSON documents for the debug app, rebuilt every `interval` seconds.
+
+    `build` walks the servers and counters once per interval and the result
+    is encoded right away. Requests to the debug app only read the encoded
+    bytes, however often they poll they never touch the servers the proxy is
+    using, and with thousands of backends the walk isn't repeated per poll.
+    Every refresh replaces the mapping as a whole, readers see one complete
+    snapshot or the next.
+    """
+    def __init__(self, build: Callable[[], Dict[str, dict]], interval: float):
+        self.build = build
+        self.interval = interval
+        self.documents: Mapping[str, bytes] = MappingProxyType({})
+        self.updated_at = 0.0
+        self.refreshes = 0
+
+    def refresh(self) -> None:
+        updated_at = time.time()
+        documents = {}
+        for name, document in self.build().items():
+            document["snapshot_time"] = updated_at
+            documents[name] = json.dumps(document, separators=(",", ":")).encode()
+        self.documents = MappingProxyType(documents)
+        self.updated_at = updated_at
+        self.refreshes += 1
+
+    def get(self, name: str) -> bytes:
+        if not self.refreshes:
+            # Served before the first refresh, e.g. during the initial health screen
+            self.refresh()
+        return self.documents[name]
+
+    async def run(self) -> None:
+        while True:
+            self.refresh()
+            await asyncio.sleep(self.interval)
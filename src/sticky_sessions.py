@@ -0,0 +1,178 @@
+import array, multiprocessing, random, secrets, time
+from typing import Dict, List, Optional, Tuple
+from server import BackendServer
+from lb_algo import LBAlgo
+from metrics import Metrics
+
+# Slots looked at to find one to reuse once the table is full, like Redis' approximated LRU
+EVICTION_SAMPLES = 5
+SLOT_BITS = 32
+SLOT_MASK = (1 << SLOT_BITS) - 1
+
+class StickySessions:
+    """Pins clients to a backend with an affinity token, a cookie or a header.
+
+    The balancer issues the tokens itself, so a token is the slot of its
+    session in the table plus a random nonce that has to match the one
+    stored there. A lookup is one array read, whatever the number of
+    sessions or servers. The table is three flat arrays sized for
+    `max_sessions` up front, about 16 bytes per session, allocated in
+    shared memory with several workers so a session works on all of them.
+    Sessions expire `ttl` seconds after their last request. Once the table
+    is full a new session reuses the least recently used of a few sampled
+    slots, expired ones first.
+
+    Each worker only allocates and repins slots in its own share of the
+    table, every slot has a single writer apart from its last-use time.
+    Nonces are never 0, the value of slots that were never used.
+    """
+    def __init__(self, servers: List[BackendServer], lb_algo: LBAlgo, config: dict, metrics: Metrics):
+        self.mode = config['sticky_sessions']
+        self.enabled = self.mode != 'off'
+        self.lb_algo = lb_algo
+        self.metrics = metrics
+        self.ttl = config['sticky_ttl']
+        self.capacity = config['sticky_max_sessions'] if self.enabled else 0
+        if self.capacity > SLOT_MASK:
+            raise ValueError(f"[StickySessionError] sticky_max_sessions can be at most {SLOT_MASK}")
+
+        self.cookie = config['sticky_cookie'].encode()
+        self.header = config['sticky_header'].lower().encode()
+
+        # Forked workers see the same ids, servers added by a reload get the next ones
+        self.servers: List[BackendServer] = []
+        self.ids: Dict[BackendServer, int] = {}
+        for server in servers:
+            self.register(server)
+
+        if config['workers'] > 1:
+            ctx = multiprocessing.get_context("fork")
+            self.nonces = ctx.RawArray('Q', self.capacity)
+            self.server_ids = ctx.RawArray('I', self.capacity)
+            self.last_used = ctx.RawArray('I', self.capacity)
+        else:
+            self.nonces = array.array('Q', bytes(8 * self.capacity))
+            self.server_ids = array.array('I', bytes(4 * self.capacity))
+            self.last_used = array.array('I', bytes(4 * self.capacity))
+
+        # Slots this process allocates from, never used ones first
+        self.start = 0
+        self.end = self.capacity
+        self.next_free = 0
+
+    def set_partition(self, worker_id: int, workers: int) -> None:
+        self.start = self.capacity * worker_id // workers
+        self.end = self.capacity * (worker_id + 1) // workers
+        self.next_free = self.start
+
+    def register(self, server: BackendServer) -> int:
+        server_id = self.ids.get(server)
+        if server_id is None:
+            server_id = self.ids[server] = len(self.servers)
+            self.servers.append(server)
+        return server_id
+
+    def get_session(self, headers: List[Tuple[bytes, bytes]]) -> Optional[int]:
+        """The token the request carries, None without one or if it is malformed."""
+        token = None
+        if self.mode == 'cookie':
+            prefix = self.cookie + b"="
+            for name, value in headers:
+                if name.lower() == b"cookie":
+                    for cookie in value.split(b";"):
+                        cookie = cookie.strip()
+                        if cookie.startswith(prefix):
+                            token = cookie[len(prefix):]
+        else:
+            for name, value in headers:
+                if name.lower() == self.header:
+                    token = value.strip()
+        if not token or len(token) > 24:
+            return None
+        try:
+            session = int(token, 16)
+        except ValueError:
+            return None
+        # Nonce 0 would match every slot that was never used
+        if not session >> SLOT_BITS or (session & SLOT_MASK) >= self.capacity:
+            return None
+        return session
+
+    def lookup(self, session: Optional[int]) -> Optional[BackendServer]:
+        """The server the session is pinned to, None once it expired or the server isn't healthy."""
+        if session is None:
+            return None
+        slot = session & SLOT_MASK
+        if self.nonces[slot] != session >> SLOT_BITS:
+            return None
+        now = int(time.monotonic())
+        if now - self.last_used[slot] > self.ttl:
+            return None
+        self.last_used[slot] = now
+        server = self.servers[self.server_ids[slot]]
+        if server not in self.lb_algo.healthy_index:
+            return None
+        self.metrics.sticky_hits += 1
+        return server
+
+    def pin(self, session: Optional[int], server: BackendServer) -> Optional[bytes]:
+        """Pins the session to the server that answered, returns a token to issue for a new session."""
+        server_id = self.register(server)
+        now = int(time.monotonic())
+        if session is not None:
+            slot = session & SLOT_MASK
+            if self.nonces[slot] == session >> SLOT_BITS:
+                if self.server_ids[slot] == server_id:
+                    self.last_used[slot] = now
+                    return None
+                if self.start <= slot < self.end:
+                    # Its server was unhealthy, full or failed, the session stays on the new one
+                    self.server_ids[slot] = server_id
+                    self.metrics.sticky_repinned += 1
+                    self.last_used[slot] = now
+                    return None
+                # Owned by another worker, the client gets a new session from this one's share
+
+        slot = self.allocate(now)
+        nonce = secrets.randbits(64 - SLOT_BITS) or 1
+        self.nonces[slot] = nonce
+        self.server_ids[slot] = server_id
+        self.last_used[slot] = now
+        self.metrics.sticky_created += 1
+        return b"%x" % ((nonce << SLOT_BITS) | slot)
+
+    def allocate(self, now: int) -> int:
+        if self.next_free < self.end:
+            slot = self.next_free
+            self.next_free += 1
+            self.metrics.sticky_slots_used += 1
+            return slot
+
+        last_used = self.last_used
+        slot = random.randrange(self.start, self.end)
+        for _ in range(EVICTION_SAMPLES - 1):
+            candidate = random.randrange(self.start, self.end)
+            if last_used[candidate] < last_used[slot]:
+                slot = candidate
+        if now - last_used[slot] <= self.ttl:
+            self.metrics.sticky_evicted += 1
+        return slot
+
+    def token_header(self, token: bytes) -> Tuple[bytes, bytes]:
+        if self.mode == 'cookie':
+            # A session cookie, the table decides how long the session lasts
+            return b"set-cookie", self.cookie + b"=" + token + b"; Path=/; HttpOnly; SameSite=Lax"
+        return self.header, token
+
+    def get_stats(self, metrics: Metrics) -> dict:
+        return {
+            "mode": self.mode,
+            "max_sessions": self.capacity,
+            "ttl": self.ttl,
+            "table_bytes": self.capacity * (8 + 4 + 4),
+            "slots_used": metrics.sticky_slots_used,
+            "created": metrics.sticky_created,
+            "hits": metrics.sticky_hits,
+            "repinned": metrics.sticky_repinned,
+            "evicted": metrics.sticky_evicted
+        }
@@ -0,0 +1,112 @@
+import httpx
+from fastapi import Request
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+from typing import AsyncIterator, Callable, List, Tuple
+from compression import ResponseCompression
+
+# Headers that only apply to a single transport level connection (RFC 7230 6.1)
+HOP_BY_HOP_HEADERS = {
+    b"connection",
+    b"keep-alive",
+    b"proxy-authenticate",
+    b"proxy-authorization",
+    b"te",
+    b"trailer",
+    b"trailers",
+    b"transfer-encoding",
+    b"upgrade",
+}
+
+def filter_hop_by_hop(raw_headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    hop_by_hop = HOP_BY_HOP_HEADERS
+    for name, value in raw_headers:
+        # Headers listed in Connection are hop-by-hop as well
+        if name.lower() == b"connection":
+            hop_by_hop = hop_by_hop | {token.strip().lower() for token in value.split(b",")}
+
+    return [(name, value) for name, value in raw_headers if name.lower() not in hop_by_hop]
+
+# Set by the ASGI server on every response, the upstream's copies would be sent twice
+SERVER_HEADERS = {b"date", b"server"}
+
+def filter_response_headers(raw_headers: List[Tuple[bytes, bytes]]) -> List[Tuple[bytes, bytes]]:
+    """Upstream response headers to relay through uvicorn or hypercorn."""
+    return [(name, value) for name, value in filter_hop_by_hop(raw_headers) if name.lower() not in SERVER_HEADERS]
+
+def is_event_stream(raw_headers: List[Tuple[bytes, bytes]]) -> bool:
+    # Server-sent events, the response is open ended
+    for name, value in raw_headers:
+        if name.lower() == b"accept" and b"text/event-stream" in value:
+            return True
+    return False
+
+async def prepend(prefix: bytes, chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    if prefix:
+        yield prefix
+    async for chunk in chunks:
+        yield chunk
+
+def has_body(request: Request) -> bool:
+    return "content-length" in request.headers or "transfer-encoding" in request.headers
+
+class RequestBodyStream:
+    """Pipes the client request body to the upstream chunk by chunk.
+
+    Once httpx has started pulling the body it can't be replayed, so the
+    proxy checks `started` before retrying on another server.
+    """
+    def __init__(self, request: Request):
+        self.request = request
+        self.started = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        self.started = True
+        async for chunk in self.request.stream():
+            if chunk:
+                yield chunk
+
+class UpstreamStreamingResponse(StreamingResponse):
+    """Streams an upstream httpx response back to the client as raw bytes.
+
+    `on_close` runs exactly once when the response is done, also when the
+    client disconnects before or during the body. With `on_idle` a read
+    timeout ends the body normally and calls it, event streams going quiet
+    for that long are idle rather than failed. With an `encoding` the body
+    is compressed as it is relayed. `body` replaces the upstream body, e.g.
+    for one that was partly read already.
+    """
+    def __init__(self, response: httpx.Response, on_close: Callable[[], None] = None, on_idle: Callable[[], None] = None,
+                 compression: ResponseCompression = None, encoding: str = None, body: AsyncIterator[bytes] = None):
+        if body is None:
+            # Raw bytes so content-encoding and binary bodies pass through untouched
+            body = response.aiter_raw() if on_idle is None else self.relay_until_idle(response, on_idle)
+        raw_headers = filter_response_headers(response.headers.raw)
+        if encoding is not None:
+            # Sent chunked, the compressed length isn't known up front
+            body = compression.compress_stream(body, encoding)
+            raw_headers = compression.encode_headers(raw_headers, encoding)
+        super().__init__(body, status_code=response.status_code)
+        self.raw_headers = raw_headers
+        self.upstream_response = response
+        self.on_close = on_close
+
+    async def relay_until_idle(self, response: httpx.Response, on_idle: Callable[[], None]) -> AsyncIterator[bytes]:
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        except httpx.ReadTimeout:
+            on_idle()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            await self.aclose()
+
+    # Also for responses that are dropped without being sent
+    async def aclose(self) -> None:
+        await self.upstream_response.aclose()
+        if self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close()
@@ -0,0 +1,127 @@
+import asyncio, httpx
+from functools import partial
+from server import BackendServer
+from typing import Dict, List
+
+class UpstreamPool:
+    def __init__(self, servers: List[BackendServer], config: dict):
+        self.servers = servers
+        self.config = config
+
+        self.clients: Dict[BackendServer, httpx.AsyncClient] = {}
+        # Event streams stay open for minutes, they get clients of their own so
+        # they can't use up pool_max_connections and starve regular requests
+        self.stream_clients: Dict[BackendServer, httpx.AsyncClient] = {}
+        # Per server counters, hits are derived as requests - misses
+        self.requests: Dict[BackendServer, int] = {}
+        self.misses: Dict[BackendServer, int] = {}
+        self._traces = {}
+
+    def create_client(self, server: BackendServer, long_lived: bool = False) -> httpx.AsyncClient:
+        timeout = httpx.Timeout(
+            connect=self.config['connect_timeout'],
+            read=self.config['read_timeout'],
+            write=self.config['send_timeout'],
+            pool=self.config['next_timeout']
+        )
+        limits = httpx.Limits(
+            max_connections=None if long_lived else self.config['pool_max_connections'],
+            max_keepalive_connections=self.config['pool_max_keepalive'],
+            keepalive_expiry=self.config['pool_keepalive_expiry']
+        )
+        # HTTP/2 servers get streams multiplexed over a few connections, http1=False skips the
+        # upgrade dance and speaks h2c right away. The limits then count connections, not streams.
+        return httpx.AsyncClient(
+            base_url=server.get_url(), timeout=timeout, limits=limits,
+            http2=server.http2, http1=not server.http2
+        )
+
+    def open(self) -> None:
+        for server in self.servers:
+            self.add_server(server)
+
+    def add_server(self, server: BackendServer) -> None:
+        if server in self.clients:
+            return
+        self.clients[server] = self.create_client(server)
+        self.requests[server] = 0
+        self.misses[server] = 0
+        self._traces[server] = partial(self._trace, server)
+
+    async def remove_server(self, server: BackendServer) -> None:
+        client = self.clients.pop(server, None)
+        stream_client = self.stream_clients.pop(server, None)
+        self.requests.pop(server, None)
+        self.misses.pop(server, None)
+        self._traces.pop(server, None)
+        if client is not None:
+            await client.aclose()
+        if stream_client is not None:
+            await stream_client.aclose()
+
+    async def close(self) -> None:
+        for server in list(self.clients):
+            await self.remove_server(server)
+
+    def get_client(self, server: BackendServer, long_lived: bool = False) -> httpx.AsyncClient:
+        if server not in self.clients:
+            self.add_server(server)
+        if long_lived:
+            client = self.stream_clients.get(server)
+            if client is None:
+                client = self.stream_clients[server] = self.create_client(server, long_lived=True)
+            return client
+        return self.clients[server]
+
+    def build_request(self, server: BackendServer, method: str, url: str, long_lived: bool = False, **kwargs) -> httpx.Request:
+        client = self.get_client(server, long_lived)
+        self.requests[server] += 1
+        if long_lived:
+            # Read from the current config so a reloaded idle timeout applies to new streams
+            kwargs["timeout"] = httpx.Timeout(
+                connect=self.config['connect_timeout'],
+                read=self.config['long_lived_idle_timeout'] or None,
+                write=self.config['send_timeout'],
+                pool=self.config['next_timeout']
+            )
+        return client.build_request(method, url, extensions={"trace": self._traces[server]}, **kwargs)
+
+    async def request(self, server: BackendServer, method: str, url: str, **kwargs) -> httpx.Response:
+        request = self.build_request(server, method, url, **kwargs)
+        return await self.clients[server].send(request)
+
+    async def prewarm(self, server: BackendServer, count: int, path: str) -> int:
+        """Opens up to `count` keep-alive connections to the server, returns how many requests got through.
+
+        httpx can't open idle connections, concurrent requests to `path`
+        each need one and leave it in the pool. HTTP/2 servers need a
+        single connection. They don't count as pool hits or misses.
+        """
+        client = self.get_client(server)
+        if server.http2:
+            count = 1
+        count = min(count, self.config['pool_max_keepalive'], self.config['pool_max_connections'])
+        results = await asyncio.gather(*[client.get(path) for _ in range(count)], return_exceptions=True)
+        return sum(1 for result in results if isinstance(result, httpx.Response))
+
+    # httpcore emits connect_tcp only when no idle pooled connection could be reused
+    async def _trace(self, server: BackendServer, event_name: str, info: dict) -> None:
+        if event_name == "connection.connect_tcp.started":
+            self.misses[server] += 1
+
+    def get_stats(self) -> dict:
+        total_requests = sum(self.requests.values())
+        total_misses = sum(self.misses.values())
+        return {
+            "pool_hits": total_requests - total_misses,
+            "pool_misses": total_misses,
+            "servers": [
+                {
+                    "url": server.get_url(),
+                    "protocol": "h2c" if server.http2 else "http/1.1",
+                    "pool_hits": self.requests[server] - self.misses[server],
+                    "pool_misses": self.misses[server]
+                }
+                for server in self.clients
+            ]
+        }
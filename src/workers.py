@@ -0,0 +1,149 @@
+import asyncio, multiprocessing, signal, socket
+from server import BackendServer
+from metrics import Metrics
+from typing import Dict, List
+
+# How often workers pick up health state and publish their counters
+WORKER_SYNC_INTERVAL = 0.25
+
+class SharedState:
+    """Health flags and counters shared between the master and its workers.
+
+    The master owns the health flags, every worker owns one row of counters,
+    so each slot has a single writer and no locking is needed.
+    """
+    COUNTERS = ("requests_served", "failures", "active_connections", "latency_ewma_us")
+
+    def __init__(self, servers: List[BackendServer], workers: int):
+        ctx = multiprocessing.get_context("fork")
+        self.servers = servers
+        self.workers = workers
+        self.index: Dict[BackendServer, int] = {server: i for i, server in enumerate(servers)}
+
+        self.health = ctx.RawArray('b', len(servers))
+        self.counters = ctx.RawArray('q', workers * len(servers) * len(self.COUNTERS))
+        self.total_requests = ctx.RawArray('q', workers)
+        self.metrics_width = Metrics.width(len(servers))
+        self.metrics = ctx.RawArray('d', workers * self.metrics_width)
+
+    # master side
+    def publish_health(self, server: BackendServer, healthy: bool) -> None:
+        self.health[self.index[server]] = 1 if healthy else 0
+
+    def publish_all_health(self, healthy_servers) -> None:
+        for server, i in self.index.items():
+            self.health[i] = 1 if server in healthy_servers else 0
+
+    def aggregate_counters(self, server: BackendServer) -> dict:
+        width = len(self.COUNTERS)
+        offset = self.index[server] * width
+        row = len(self.servers) * width
+        totals = dict.fromkeys(self.COUNTERS, 0)
+        latency_samples = 0
+        for worker_id in range(self.workers):
+            base = worker_id * row + offset
+            for i, name in enumerate(self.COUNTERS):
+                totals[name] += self.counters[base + i]
+            if self.counters[base + 3]:
+                latency_samples += 1
+
+        # Latency is averaged over the workers that have seen the server, not summed
+        if latency_samples:
+            totals["latency_ewma_us"] //= latency_samples
+
+        return totals
+
+    def aggregate_total_requests(self) -> int:
+        return sum(self.total_requests)
+
+    def aggregate_metrics(self) -> Metrics:
+        metrics = Metrics()
+        for worker_id in range(self.workers):
+            base = worker_id * self.metrics_width
+            metrics.add_values(self.metrics[base:base + self.metrics_width], self.servers)
+        return metrics
+
+    # worker side
+    def apply_health(self, healthchecker) -> None:
+        healthy_servers = healthchecker.healthy_servers
+        for server, i in self.index.items():
+            # Servers this worker ejected stay out until their ejection is over
+            healthy = self.health[i] == 1 and not healthchecker.is_ejected(server)
+            if healthy == (server in healthy_servers):
+                if not healthy and healthchecker.warming:
+                    # Went down again before it was warm
+                    healthchecker.stop_warming(server)
+                continue
+            # Recovered servers take traffic here once this worker opened connections to them
+            if healthy and not healthchecker.is_warm(server):
+                continue
+            healthchecker.set_server_health(server, healthy)
+
+    def publish_counters(self, worker_id: int, total_requests: int, metrics: Metrics) -> None:
+        width = len(self.COUNTERS)
+        base = worker_id * len(self.servers) * width
+        for server, i in self.index.items():
+            offset = base + i * width
+            self.counters[offset] = server.requests_served
+            self.counters[offset + 1] = server.failures
+            self.counters[offset + 2] = server.active_connections
+            self.counters[offset + 3] = int(server.latency_ewma * 1e6)
+        self.total_requests[worker_id] = total_requests
+
+        # One slice assignment per sync, the hot path never touches shared memory
+        base = worker_id * self.metrics_width
+        self.metrics[base:base + self.metrics_width] = metrics.to_values(self.servers)
+
+
+def create_listen_socket(port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(("0.0.0.0", port))
+    sock.listen(2048)
+    sock.setblocking(False)
+    sock.set_inheritable(True)
+    return sock
+
+def worker_main(lb, sock: socket.socket, worker_id: int) -> None:
+    # Ctrl+C reaches the whole process group, let the master drive the shutdown
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(lb.run_worker(sock, worker_id))
+
+def run_workers(lb, workers: int) -> None:
+    """Pre-fork `workers` processes that accept on one inherited listening socket.
+
+    The master keeps running the health checks and the debug app.
+    """
+    sock = create_listen_socket(lb.port)
+
+    # Workers start with the health state of the initial screen
+    lb.access_log.start()
+    asyncio.run(lb.initial_health_screen())
+    # Flushed before forking so the workers don't inherit and repeat queued lines
+    lb.access_log.stop()
+    lb.shared_state = SharedState(lb.backend_servers, workers)
+    lb.shared_state.publish_all_health(lb.healthy_servers)
+
+    ctx = multiprocessing.get_context("fork")
+    processes = []
+    for worker_id in range(workers):
+        process = ctx.Process(target=worker_main, args=(lb, sock, worker_id), daemon=True)
+        process.start()
+        processes.append(process)
+    print(f"[Success] Started {workers} workers on port {lb.port}")
+
+    # Registered after the fork so only the master publishes health, not local worker ejections
+    lb.healthchecker.add_listener(lb.shared_state.publish_health)
+
+    # Only the workers accept connections
+    sock.close()
+
+    try:
+        asyncio.run(lb.run_master())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
@@ -0,0 +1,152 @@
+import asyncio, inspect, os, socket, sys
+from contextlib import asynccontextmanager
+from http import HTTPStatus
+from typing import Awaitable, Callable, Dict, List, Tuple, Union
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import config
+from server import BackendServer, ServerStatus
+from load_balancer import LoadBalancer
+
+# Content is a body with a content-length, or a list of chunks sent chunked
+Handler = Callable[[str, str, Dict[str, str], bytes], Awaitable[Tuple[int, List[Tuple[str, str]], Union[bytes, List[bytes]]]]]
+
+def make_config(**overrides) -> dict:
+    """The defaults of initialize_config with a small sticky table, `overrides` replace them."""
+    data = {
+        'upstream': [{'domain': 'http://127.0.0.1:1'}],
+        'sticky_max_sessions': 1024,
+        'send_alert_webhook': '',
+    }
+    data.update(overrides)
+    data = config.initialize_config(data)
+    config.validate_config(data)
+    return data
+
+async def echo(method: str, path: str, headers: Dict[str, str], body: bytes):
+    return 200, [("Content-Type", "text/plain")], f"{method} {path}".encode() + body
+
+def encode_response(method: str, status: int, headers: List[Tuple[str, str]], content: Union[bytes, List[bytes]]) -> bytes:
+    lines = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"] + [f"{name}: {value}" for name, value in headers]
+    if isinstance(content, list):
+        lines.append("Transfer-Encoding: chunked")
+        payload = b"".join(b"%x\r\n%s\r\n" % (len(chunk), chunk) for chunk in content) + b"0\r\n\r\n"
+    else:
+        # A handler can send a wrong length on purpose, e.g. to stall mid-body
+        if not any(name.lower() == "content-length" for name, _ in headers):
+            lines.append(f"Content-Length: {len(content)}")
+        payload = content
+    head = ("\r\n".join(lines) + "\r\n\r\n").encode("latin-1")
+    return head if method == "HEAD" else head + payload
+
+class Backend:
+    """Keep-alive HTTP/1.1 stand-in for an upstream, answers every request with `handler`."""
+    def __init__(self, handler: Handler = echo):
+        self.handler = handler
+        # Method, path and headers of every request it got
+        self.requests: List[Tuple[str, str, Dict[str, str]]] = []
+        self.server = None
+        self.port = None
+
+    async def start(self) -> None:
+        self.server = await asyncio.start_server(self.serve, '127.0.0.1', 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+                request_line, *lines = head.decode("latin-1").split("\r\n")[:-2]
+                method, path, _ = request_line.split(" ", 2)
+                headers = {}
+                for line in lines:
+                    name, value = line.split(":", 1)
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests.append((method, path, headers))
+
+                status, response_headers, content = await self.handler(method, path, headers, body)
+                writer.write(encode_response(method, status, response_headers, content))
+                await writer.drain()
+        except (asyncio.CancelledError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def close(self) -> None:
+        self.server.close()
+
+@asynccontextmanager
+async def running_backend(handler: Handler = echo):
+    backend = Backend(handler)
+    await backend.start()
+    try:
+        yield backend
+    finally:
+        backend.close()
+
+async def wait_for_listener(port: int) -> None:
+    for _ in range(100):
+        try:
+            _, writer = await asyncio.open_connection('127.0.0.1', port)
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.01)
+            continue
+        writer.close()
+        return
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+@asynccontextmanager
+async def running_lb(*backends: Backend, **overrides):
+    """A LoadBalancer in front of `backends` with them already healthy, the raw engine listening on `lb.raw_port`."""
+    lb_config = make_config(upstream=[{'domain': f'http://127.0.0.1:{backend.port}'} for backend in backends], **overrides)
+    servers = [BackendServer('127.0.0.1', backend.port) for backend in backends]
+    for server in servers:
+        server.set_status(ServerStatus.HEALTHY)
+    lb = LoadBalancer(servers, set(servers), lb_config, 0)
+    lb.upstream_pool.open()
+    raw_task = None
+    if lb.raw_proxy is not None:
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            lb.raw_port = sock.getsockname()[1]
+        raw_task = asyncio.ensure_future(lb.raw_proxy.serve('127.0.0.1', lb.raw_port))
+        await wait_for_listener(lb.raw_port)
+    try:
+        yield lb
+    finally:
+        if raw_task is not None:
+            raw_task.cancel()
+            try:
+                await raw_task
+            except asyncio.CancelledError:
+                pass
+        await lb.upstream_pool.close()
+        lb.compression.close()
+
+@pytest.hookimpl(tryfirst=True)
+def pytest_pyfunc_call(pyfuncitem):
+    """Runs `async def` tests to completion on a fresh event loop each."""
+    if not inspect.iscoroutinefunction(pyfuncitem.obj):
+        return None
+    arguments = {name: pyfuncitem.funcargs[name] for name in pyfuncitem._fixtureinfo.argnames}
+    asyncio.run(pyfuncitem.obj(**arguments))
+    return True
+
+@pytest.fixture
+def lb_config():
+    return make_config
+
+@pytest.fixture
+def backend():
+    return running_backend
+
+@pytest.fixture
+def balancer():
+    return running_lb
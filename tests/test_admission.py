@@ -0,0 +1,82 @@
+import asyncio
+import httpx
+import pytest
+from admission import AdmissionControl, Overloaded
+from lb_algo import LBAlgo
+from metrics import Metrics
+from server import BackendServer
+
+def make_admission(lb_config, max_connections: int = 0, **overrides):
+    servers = [BackendServer('127.0.0.1', 9000 + i, 1, max_connections) for i in range(2)]
+    lb_algo = LBAlgo(servers, set(servers), 'round-robin')
+    admission = AdmissionControl(lb_algo, lb_config(backend_max_connections=max_connections, **overrides), Metrics())
+    lb_algo.release_listener = admission.on_release
+    return servers, lb_algo, admission
+
+async def test_full_queue_sheds_new_requests(lb_config):
+    _, _, admission = make_admission(lb_config, max_inflight=1, queue_size=1)
+    await admission.admit()
+    queued = asyncio.ensure_future(admission.admit())
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded) as shed:
+        await admission.admit()
+    assert shed.value.status_code == 503 and shed.value.headers == {"Retry-After": "1"}
+    assert admission.metrics.shed == 1
+
+    # A released slot goes to the queued request
+    admission.release()
+    await asyncio.wait_for(queued, 1)
+    assert admission.inflight == 1
+    assert admission.metrics.queued == 0
+
+async def test_queued_request_times_out(lb_config):
+    _, _, admission = make_admission(lb_config, max_inflight=1, queue_timeout=0.05)
+    await admission.admit()
+    with pytest.raises(Overloaded):
+        await admission.admit()
+
+    assert admission.metrics.queue_timeouts == 1
+    assert admission.metrics.queued == 0
+    assert not admission.admission_queue.waiters
+    assert admission.inflight == 1
+
+async def test_cancelled_waiter_passes_its_wakeup_on(lb_config):
+    _, _, admission = make_admission(lb_config, max_inflight=1)
+    await admission.admit()
+    first = asyncio.ensure_future(admission.admit())
+    second = asyncio.ensure_future(admission.admit())
+    await asyncio.sleep(0)
+    # Woken and cancelled before it ran, the slot must not be lost
+    admission.release()
+    first.cancel()
+    await asyncio.wait_for(second, 1)
+    assert admission.inflight == 1
+
+async def test_requests_wait_for_backend_capacity(lb_config):
+    servers, lb_algo, admission = make_admission(lb_config, max_connections=1, queue_timeout=1)
+    picked = []
+    for _ in range(2):
+        server = await admission.get_server()
+        lb_algo.acquire(server)
+        picked.append(server)
+    # Full servers are skipped before queueing
+    assert set(picked) == set(servers)
+
+    waiting = asyncio.ensure_future(admission.get_server())
+    await asyncio.sleep(0.01)
+    assert not waiting.done()
+    lb_algo.release(picked[1])
+    assert await asyncio.wait_for(waiting, 1) is picked[1]
+
+async def test_shed_requests_get_503_with_retry_after(backend, balancer):
+    async def slow(method, path, headers, body):
+        await asyncio.sleep(0.2)
+        return 200, [], b"ok"
+
+    async with backend(slow) as upstream, balancer(upstream, max_inflight=1, queue_size=0) as lb:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=lb.app), base_url="http://lb") as client:
+            responses = await asyncio.gather(client.get("/a"), client.get("/b"))
+
+    assert sorted(response.status_code for response in responses) == [200, 503]
+    shed = next(response for response in responses if response.status_code == 503)
+    assert shed.headers["retry-after"] == "1"
@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+from server import ServerStatus
+
+def upstream(*backends, **fields):
+    return [{'domain': f'http://127.0.0.1:{backend.port}', **fields} for backend in backends]
+
+async def test_kept_servers_keep_their_state(lb_config, backend, balancer):
+    async with backend() as first, backend() as second, backend() as third, balancer(first, second) as lb:
+        kept, removed = lb.backend_servers
+        kept.increment_requests_served()
+        lb.apply_config(lb_config(upstream=upstream(first, weight=3) + upstream(third)))
+
+        assert lb.backend_servers[0] is kept
+        assert kept.weight == 3 and kept.requests_served == 1
+        assert kept.health == ServerStatus.HEALTHY and kept in lb.lb_algo.healthy_index
+        # New servers take traffic after their first passing health check
+        added = lb.backend_servers[1]
+        assert added.port == third.port and added not in lb.healthy_servers
+        assert added in lb.upstream_pool.clients
+
+        assert removed not in lb.healthy_servers and removed not in lb.lb_algo.healthy_index
+        await asyncio.gather(*lb.draining)
+        assert removed not in lb.upstream_pool.clients
+
+async def test_removed_server_drains_its_requests(lb_config, backend, balancer):
+    async with backend() as first, backend() as second, balancer(first, second) as lb:
+        removed = lb.backend_servers[1]
+        removed.active_connections = 1
+        lb.apply_config(lb_config(upstream=upstream(first)))
+
+        # No new requests, the pooled connections stay open until the in-flight one is done
+        assert all(lb.get_next_server() is not removed for _ in range(4))
+        await asyncio.sleep(0.15)
+        assert lb.draining and removed in lb.upstream_pool.clients
+        removed.active_connections = 0
+        await asyncio.wait_for(asyncio.gather(*lb.draining), 1)
+        assert removed not in lb.upstream_pool.clients
+
+async def test_invalid_upstream_keeps_the_current_config(lb_config, backend, balancer):
+    async with backend() as first, backend() as second, balancer(first) as lb:
+        servers = list(lb.backend_servers)
+        new_config = lb_config(upstream=upstream(second) + [{'domain': 'http://127.0.0.1:99999'}], lb_method='least-connections')
+        with pytest.raises(ValueError):
+            lb.apply_config(new_config)
+
+        assert lb.backend_servers == servers
+        assert lb.config['lb_method'] == 'round-robin' and lb.lb_algo.get_algo() == 'round-robin'
+
+async def test_lb_method_switch(lb_config, backend, balancer):
+    async with backend() as first, backend() as second, balancer(first, second) as lb:
+        lb.apply_config(lb_config(upstream=upstream(first, second), lb_method='least-connections'))
+        assert lb.config['lb_method'] == 'least-connections' and lb.lb_algo.get_algo() == 'least-connections'
+
+        busy = lb.backend_servers[0]
+        lb.lb_algo.acquire(busy)
+        assert all(lb.get_next_server() is not busy for _ in range(4))
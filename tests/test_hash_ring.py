@@ -0,0 +1,57 @@
+from hash_ring import REBUILD_THRESHOLD, HashRing
+from server import BackendServer
+
+def make_servers(count: int):
+    return [BackendServer(f'10.0.0.{i}', 8080) for i in range(count)]
+
+def snapshot(ring: HashRing):
+    return list(ring.keys), dict(ring.owners)
+
+def test_incremental_updates_match_a_rebuild():
+    ring = HashRing(20)
+    servers = make_servers(12)
+    for server in servers:
+        ring.add_server(server)
+    for server in servers[::3]:
+        ring.remove_server(server)
+    ring.add_server(servers[3])
+    # Reweighted servers leave and rejoin with their new points
+    ring.remove_server(servers[1])
+    servers[1].weight = 3
+    ring.add_server(servers[1])
+
+    incremental = snapshot(ring)
+    ring.rebuild()
+    assert snapshot(ring) == incremental
+    assert len(ring.keys) == 20 * (8 + 3)
+    assert set(ring.owners.values()) == set(servers) - {servers[0], servers[6], servers[9]}
+
+def test_removing_a_server_only_moves_its_keys():
+    ring = HashRing(20)
+    servers = make_servers(5)
+    for server in servers:
+        ring.add_server(server)
+    clients = [f'192.168.0.{i}' for i in range(200)]
+    before = {client: ring.get_server(client) for client in clients}
+
+    ring.remove_server(servers[2])
+    for client in clients:
+        if before[client] is not servers[2]:
+            assert ring.get_server(client) is before[client]
+        else:
+            assert ring.get_server(client) is not servers[2]
+
+def test_large_batch_is_applied_once_it_exits():
+    ring = HashRing(20)
+    servers = make_servers(REBUILD_THRESHOLD + 4)
+    with ring.batch():
+        for server in servers:
+            ring.add_server(server)
+        # The first changes go in right away, the rest waits for the rebuild
+        assert len(ring.keys) == 20 * REBUILD_THRESHOLD
+    assert len(ring.keys) == 20 * len(servers)
+
+    one_by_one = HashRing(20)
+    for server in servers:
+        one_by_one.add_server(server)
+    assert snapshot(ring) == snapshot(one_by_one)
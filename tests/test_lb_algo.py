@@ -0,0 +1,81 @@
+from collections import Counter
+from lb_algo import LBAlgo
+from server import BackendServer
+
+def make_algo(algo: str, weights=(1, 1, 1)):
+    servers = [BackendServer('127.0.0.1', 9000 + i, weight) for i, weight in enumerate(weights)]
+    return servers, LBAlgo(servers, set(servers), algo)
+
+def pick_counts(lb_algo: LBAlgo, picks: int) -> Counter:
+    return Counter(lb_algo.get_next_server() for _ in range(picks))
+
+def test_weighted_round_robin_follows_the_weights():
+    servers, lb_algo = make_algo('weighted-round-robin', (1, 2, 3))
+    counts = pick_counts(lb_algo, 600)
+    assert [counts[server] for server in servers] == [100, 200, 300]
+
+    # Interleaved, the heaviest server never gets more than two picks in a row
+    picks = [lb_algo.get_next_server() for _ in range(60)]
+    assert not any(picks[i] is picks[i + 1] is picks[i + 2] for i in range(len(picks) - 2))
+
+def test_weighted_round_robin_after_set_weight():
+    servers, lb_algo = make_algo('weighted-round-robin', (1, 2, 3))
+    pick_counts(lb_algo, 7)
+    lb_algo.set_weight(servers[0], 4)
+    counts = pick_counts(lb_algo, 900)
+    for server, expected in zip(servers, (400, 200, 300)):
+        assert abs(counts[server] - expected) <= 2
+
+def test_least_connections_buckets_follow_acquire_and_release():
+    servers, lb_algo = make_algo('least-connections')
+    lc = lb_algo.least_connections
+    for server in (servers[0], servers[0], servers[1]):
+        lb_algo.acquire(server)
+    assert lb_algo.get_next_server() is servers[2]
+    assert {count: list(bucket) for count, bucket in lc.buckets.items()} == {2: [servers[0]], 1: [servers[1]], 0: [servers[2]]}
+
+    lb_algo.acquire(servers[2])
+    lb_algo.acquire(servers[2])
+    assert lc.min_count == 1 and lb_algo.get_next_server() is servers[1]
+    lb_algo.release(servers[0])
+    lb_algo.release(servers[0])
+    assert lc.min_count == 0 and lb_algo.get_next_server() is servers[0]
+
+def test_least_connections_after_health_changes():
+    servers, lb_algo = make_algo('least-connections')
+    lb_algo.acquire(servers[1])
+    lb_algo.acquire(servers[2])
+    lb_algo.on_health_change(servers[0], False)
+    assert servers[0] not in lb_algo.least_connections.members
+    assert lb_algo.least_connections.min_count == 1
+
+    # Its connections finished while it was out, it comes back with none
+    lb_algo.acquire(servers[0])
+    lb_algo.release(servers[0])
+    lb_algo.on_health_change(servers[0], True)
+    assert lb_algo.least_connections.min_count == 0
+    assert lb_algo.get_next_server() is servers[0]
+
+def test_excluded_servers_are_skipped():
+    for algo in ('random', 'round-robin', 'weighted-round-robin', 'least-connections', 'power-of-two', 'ewma'):
+        servers, lb_algo = make_algo(algo)
+        exclude = {servers[0], servers[2]}
+        assert all(lb_algo.get_next_server(exclude=exclude) is servers[1] for _ in range(20)), algo
+
+def test_every_healthy_server_excluded_falls_back_to_all_of_them():
+    for algo in ('random', 'round-robin', 'ip-hash', 'weighted-round-robin', 'least-connections', 'power-of-two', 'ewma'):
+        servers, lb_algo = make_algo(algo)
+        lb_algo.on_health_change(servers[2], False)
+        # A retry with nowhere new to go, the unhealthy server doesn't count
+        exclude = {servers[0], servers[1], servers[2]}
+        picked = {lb_algo.get_next_server(ip='10.0.0.1', exclude=exclude) for _ in range(20)}
+        assert picked and picked <= {servers[0], servers[1]}, algo
+
+def test_healthy_index_follows_health_changes():
+    servers, lb_algo = make_algo('round-robin', (1, 1, 1, 1))
+    lb_algo.on_health_change(servers[1], False)
+    lb_algo.on_health_change(servers[1], False)
+    lb_algo.on_health_change(servers[3], True)
+    assert len(lb_algo.healthy_list) == 3 and servers[1] not in lb_algo.healthy_index
+    assert all(lb_algo.healthy_list[i] is server for server, i in lb_algo.healthy_index.items())
+    assert servers[1] not in pick_counts(lb_algo, 30)
@@ -0,0 +1,107 @@
+import asyncio, time
+from access_log import AccessLog
+from health_check import HealthCheck
+from outlier_detection import OutlierDetector
+from server import BackendServer, ServerStatus
+
+def make_detector(lb_config, count: int = 4, servers=None, **overrides):
+    outlier_config = lb_config(outlier_detection=True, **overrides)
+    if servers is None:
+        servers = [BackendServer('127.0.0.1', 9000 + i) for i in range(count)]
+    for server in servers:
+        server.set_status(ServerStatus.HEALTHY)
+    healthchecker = HealthCheck(servers, set(servers), outlier_config, AccessLog(outlier_config))
+    return servers, healthchecker, OutlierDetector(healthchecker, outlier_config)
+
+def ejection_time(server: BackendServer) -> float:
+    return round(server.ejected_until - time.monotonic())
+
+def readmit(healthchecker: HealthCheck, server: BackendServer) -> None:
+    # The ejection just ran out and the probes passed
+    server.ejected_until = time.monotonic() - 0.001
+    healthchecker.set_server_health(server, True)
+
+def test_consecutive_failures_eject(lb_config):
+    servers, healthchecker, detector = make_detector(lb_config, outlier_consecutive_failures=3)
+    for _ in range(2):
+        detector.record_result(servers[0], False)
+    detector.record_result(servers[0], True)
+    for _ in range(2):
+        detector.record_result(servers[0], False)
+    assert servers[0] in healthchecker.healthy_servers
+
+    detector.record_result(servers[0], False)
+    assert servers[0] not in healthchecker.healthy_servers
+    assert healthchecker.is_ejected(servers[0])
+
+def test_error_rate_is_judged_per_window(lb_config):
+    servers, healthchecker, detector = make_detector(lb_config, outlier_consecutive_failures=100, outlier_error_rate=0.5,
+                                                     outlier_min_requests=4, outlier_window=10)
+    server = servers[0]
+    for success in (False, True, False):
+        detector.record_result(server, success)
+    # The window tumbles, its errors don't count towards the next one
+    detector.state[server].window_start -= 11
+    for success in (True, False):
+        detector.record_result(server, success)
+    assert detector.state[server].window_requests == 2
+    assert server in healthchecker.healthy_servers
+
+    for _ in range(2):
+        detector.record_result(server, False)
+    assert server not in healthchecker.healthy_servers
+
+def test_ejection_time_doubles_up_to_the_max(lb_config):
+    servers, healthchecker, detector = make_detector(lb_config, outlier_consecutive_failures=1, outlier_base_ejection_time=10,
+                                                     outlier_max_ejection_time=50)
+    server = servers[0]
+    times = []
+    for _ in range(4):
+        detector.record_result(server, False)
+        times.append(ejection_time(server))
+        readmit(healthchecker, server)
+    assert times == [10, 20, 40, 50]
+
+    # Behaved for longer than the max ejection time, it starts over
+    server.ejected_until -= 51
+    detector.record_result(server, False)
+    assert ejection_time(server) == 10
+
+def test_ejections_are_capped(lb_config):
+    servers, healthchecker, detector = make_detector(lb_config, outlier_consecutive_failures=1, outlier_max_ejection_percent=50)
+    for server in servers:
+        detector.record_result(server, False)
+    assert len(healthchecker.healthy_servers) == 2
+    assert detector.skipped_ejections == 2
+
+def test_small_fleet_can_eject_one_server(lb_config):
+    # 50% of 1 and 10% of 3 round down to 0
+    servers, healthchecker, detector = make_detector(lb_config, 1, outlier_consecutive_failures=1)
+    detector.record_result(servers[0], False)
+    assert healthchecker.healthy_servers == {servers[0]}
+
+    servers, healthchecker, detector = make_detector(lb_config, 3, outlier_consecutive_failures=1, outlier_max_ejection_percent=10)
+    for server in servers:
+        detector.record_result(server, False)
+    assert len(healthchecker.healthy_servers) == 2
+
+async def test_probes_readmit_a_server_once_its_ejection_is_over(lb_config, backend):
+    async with backend() as upstream:
+        fleet = [BackendServer('127.0.0.1', upstream.port), BackendServer('127.0.0.1', 1)]
+        servers, healthchecker, detector = make_detector(lb_config, servers=fleet, outlier_consecutive_failures=1,
+                                                         outlier_base_ejection_time=0.1, health_check_pass=1)
+        server = servers[0]
+        healthchecker.client = healthchecker.create_client()
+        healthchecker.semaphore = asyncio.Semaphore(1)
+        try:
+            detector.record_result(server, False)
+            # Passing probes don't end an ejection early
+            await healthchecker.perform_health_check(server)
+            assert server not in healthchecker.healthy_servers
+
+            await asyncio.sleep(0.1)
+            await healthchecker.perform_health_check(server)
+            assert server in healthchecker.healthy_servers
+            assert server.health == ServerStatus.HEALTHY
+        finally:
+            await healthchecker.client.aclose()
@@ -0,0 +1,86 @@
+import asyncio, time
+import httptools
+
+async def exchange(port: int, data: bytes) -> bytes:
+    """Sends `data` in one write and reads until the proxy closes the connection."""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(data)
+    await writer.drain()
+    try:
+        return await asyncio.wait_for(reader.read(-1), 5)
+    finally:
+        writer.close()
+
+class Responses:
+    """Parses a stream of pipelined responses, none of them to HEAD requests."""
+    def __init__(self, data: bytes):
+        self.parsed = []
+        self.body = b""
+        self.headers = {}
+        self.parser = httptools.HttpResponseParser(self)
+        self.parser.feed_data(data)
+
+    def on_message_begin(self):
+        self.body = b""
+        self.headers = {}
+
+    def on_header(self, name: bytes, value: bytes):
+        self.headers[name.lower()] = value
+
+    def on_body(self, body: bytes):
+        self.body += body
+
+    def on_message_complete(self):
+        self.parsed.append((self.parser.get_status_code(), self.headers, self.body))
+
+async def test_pipelined_requests_are_answered_in_order(backend, balancer):
+    async with backend() as upstream, balancer(upstream, engine='raw') as lb:
+        data = await exchange(lb.raw_port,
+                              b"GET /a HTTP/1.1\r\nHost: lb\r\n\r\n"
+                              b"GET /b HTTP/1.1\r\nHost: lb\r\n\r\n"
+                              b"GET /c HTTP/1.1\r\nHost: lb\r\nConnection: close\r\n\r\n")
+
+    responses = Responses(data).parsed
+    assert [(status, body) for status, _, body in responses] == [(200, b"GET /a"), (200, b"GET /b"), (200, b"GET /c")]
+
+async def test_head_response_has_no_body(backend, balancer):
+    async with backend() as upstream, balancer(upstream, engine='raw') as lb:
+        data = await exchange(lb.raw_port,
+                              b"HEAD /a HTTP/1.1\r\nHost: lb\r\n\r\n"
+                              b"GET /b HTTP/1.1\r\nHost: lb\r\nConnection: close\r\n\r\n")
+
+    assert [method for method, _, _ in upstream.requests] == ["HEAD", "GET"]
+    head, rest = data.split(b"\r\n\r\n", 1)
+    assert head.startswith(b"HTTP/1.1 200")
+    assert b"content-length: 7" in head.lower()
+    # The next response follows the headers right away
+    assert Responses(rest).parsed[0][2] == b"GET /b"
+
+async def test_chunked_bodies_are_relayed(backend, balancer):
+    async def chunked(method, path, headers, body):
+        return 200, [], [b"a", b"bb", body]
+
+    async with backend(chunked) as upstream, balancer(upstream, engine='raw') as lb:
+        data = await exchange(lb.raw_port,
+                              b"POST /up HTTP/1.1\r\nHost: lb\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n"
+                              b"2\r\ncc\r\n1\r\nc\r\n0\r\n\r\n")
+
+    responses = Responses(data).parsed
+    assert len(responses) == 1
+    status, headers, body = responses[0]
+    assert status == 200 and body == b"abbccc"
+    assert headers[b"transfer-encoding"] == b"chunked"
+    # The request body was read whole and sent with its length
+    assert upstream.requests[0][2]["content-length"] == "3"
+
+async def test_stalled_upstream_is_closed_after_read_timeout(backend, balancer):
+    async def stall(method, path, headers, body):
+        return 200, [("Content-Length", "10")], b"abc"
+
+    async with backend(stall) as upstream, balancer(upstream, engine='raw', read_timeout=1) as lb:
+        started = time.monotonic()
+        data = await exchange(lb.raw_port, b"GET /slow HTTP/1.1\r\nHost: lb\r\n\r\n")
+        elapsed = time.monotonic() - started
+
+    assert data.endswith(b"\r\n\r\nabc")
+    assert 1 <= elapsed < 4
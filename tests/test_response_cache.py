@@ -0,0 +1,132 @@
+import asyncio
+import httpx
+import pytest
+from access_log import AccessLog
+from response_cache import CachedResponse, ResponseCache
+
+def make_cache(lb_config, **overrides) -> ResponseCache:
+    cache_config = lb_config(cache=True, proxy_mode='streaming', **overrides)
+    return ResponseCache(cache_config, AccessLog(cache_config))
+
+def cacheable(body: bytes = b"ok", cache_control: str = "max-age=60") -> CachedResponse:
+    return CachedResponse(200, [(b"cache-control", cache_control.encode()), (b"content-length", str(len(body)).encode())], body)
+
+class Fetcher:
+    """Counts upstream fetches, each one takes `delay` seconds."""
+    def __init__(self, make_response, delay: float = 0):
+        self.make_response = make_response
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.make_response()
+
+async def test_stored_response_is_a_hit(lb_config):
+    cache = make_cache(lb_config)
+    fetcher = Fetcher(cacheable)
+    first, first_status = await cache.fetch("GET /a", fetcher)
+    second, second_status = await cache.fetch("GET /a", fetcher)
+
+    assert (first_status, second_status) == ("MISS", "HIT")
+    assert second is first and fetcher.calls == 1
+    assert first.stored_at > 0
+    assert first.get_age(first.stored_at + 2.5) == 2
+    assert (cache.hits, cache.misses, cache.stores) == (1, 1, 1)
+
+async def test_stale_entry_is_served_while_one_request_revalidates(lb_config):
+    cache = make_cache(lb_config)
+    fetcher = Fetcher(lambda: cacheable(b"new", "max-age=60, stale-while-revalidate=30"), delay=0.05)
+    old = cacheable(b"old", "max-age=60, stale-while-revalidate=30")
+    cache.store("GET /a", old, 0)
+    # Past max-age but within stale-while-revalidate
+    old.expires_at = 0
+    old.stale_until = float("inf")
+
+    statuses = [(await cache.fetch("GET /a", fetcher))[1] for _ in range(3)]
+    await asyncio.gather(*cache.refreshing)
+    fresh, status = await cache.fetch("GET /a", fetcher)
+
+    assert statuses == ["STALE", "STALE", "STALE"]
+    assert fetcher.calls == 1
+    assert (fresh.body, status) == (b"new", "HIT")
+    assert cache.stale_hits == 3
+
+async def test_concurrent_misses_are_coalesced(lb_config):
+    cache = make_cache(lb_config)
+    fetcher = Fetcher(cacheable, delay=0.05)
+    results = await asyncio.gather(*(cache.fetch("GET /a", fetcher) for _ in range(5)))
+
+    assert fetcher.calls == 1
+    assert sorted(status for _, status in results) == ["HIT"] * 4 + ["MISS"]
+    assert len({id(response) for response, _ in results}) == 1
+    assert cache.coalesced == 4
+
+async def test_uncacheable_keys_skip_coalescing(lb_config):
+    cache = make_cache(lb_config)
+    fetcher = Fetcher(lambda: cacheable(cache_control="no-store"), delay=0.05)
+    first, status = await cache.fetch("GET /a", fetcher)
+    assert (status, first.stored_at) == ("MISS", 0)
+
+    # Known not to be storable, concurrent misses go upstream at once instead of waiting on each other
+    results = await asyncio.gather(*(cache.fetch("GET /a", fetcher) for _ in range(3)))
+    assert fetcher.calls == 4
+    assert [status for _, status in results] == ["MISS"] * 3
+    assert (cache.coalesced, cache.passes) == (0, 3)
+    assert not cache.entries
+
+async def test_passed_key_is_stored_once_cacheable_again(lb_config):
+    cache = make_cache(lb_config)
+    await cache.fetch("GET /a", Fetcher(lambda: cacheable(cache_control="no-store")))
+    fetcher = Fetcher(cacheable)
+    await cache.fetch("GET /a", fetcher)
+    _, status = await cache.fetch("GET /a", fetcher)
+
+    assert status == "HIT" and fetcher.calls == 1
+    assert not cache.pass_until
+
+def test_cache_needs_streaming_mode(lb_config):
+    # Buffered mode answers with a JSON envelope, cached responses are relayed as they are
+    with pytest.raises(ValueError):
+        lb_config(cache=True, proxy_mode='buffered')
+
+def test_may_store_checks_headers_before_the_body(lb_config):
+    cache = make_cache(lb_config, cache_max_entry_bytes=100)
+    assert cache.may_store(200, [(b"cache-control", b"max-age=60"), (b"content-length", b"100")])
+    assert not cache.may_store(200, [(b"cache-control", b"max-age=60"), (b"content-length", b"101")])
+    assert not cache.may_store(200, [(b"cache-control", b"private, max-age=60")])
+    assert not cache.may_store(200, [(b"cache-control", b"max-age=60"), (b"set-cookie", b"a=b")])
+    # No freshness information and no cache_default_ttl
+    assert not cache.may_store(200, [])
+
+async def test_proxied_age_and_cache_headers(backend, balancer):
+    async def handler(method, path, headers, body):
+        if path == "/cached":
+            return 200, [("Cache-Control", "max-age=60")], b"cached"
+        if path == "/large":
+            return 200, [("Cache-Control", "max-age=60")], [b"x" * 4096] * 4
+        return 200, [], b"uncached"
+
+    async with backend(handler) as upstream, balancer(upstream, cache=True, proxy_mode='streaming', cache_max_entry_bytes=8192) as lb:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=lb.app), base_url="http://lb") as client:
+            miss = await client.get("/cached")
+            # Stored five seconds ago
+            for entry in lb.response_cache.entries.values():
+                entry.stored_at -= 5
+            hit = await client.get("/cached")
+            uncached = [await client.get("/uncached") for _ in range(2)]
+            large = [await client.get("/large") for _ in range(2)]
+
+    # Stored on the way through, it is as old as the entry
+    assert miss.headers["x-cache"] == "MISS" and miss.headers["age"] == "0"
+    assert hit.headers["x-cache"] == "HIT" and hit.headers["age"] == "5"
+    assert hit.text == "cached"
+    # Not storable, every request goes upstream and none gets an Age
+    for response in uncached + large:
+        assert response.headers["x-cache"] == "MISS" and "age" not in response.headers
+    assert all(response.text == "uncached" for response in uncached)
+    assert all(response.content == b"x" * 16384 for response in large)
+    paths = [path for _, path, _ in upstream.requests]
+    assert paths.count("/cached") == 1
+    assert paths.count("/large") == 2
@@ -0,0 +1,94 @@
+import asyncio
+import httpx
+from metrics import Metrics
+from retry_policy import RetryPolicy
+from server import BackendServer
+
+def test_sent_non_idempotent_requests_are_not_retried(lb_config):
+    policy = RetryPolicy(lb_config(), Metrics())
+    assert not policy.is_idempotent("POST", False)
+    assert policy.is_idempotent("POST", True)
+    assert not policy.can_retry(False, True)
+    # It never reached the backend, retrying can't apply it twice
+    assert policy.can_retry(False, False)
+    assert policy.metrics.retries_skipped == 1
+
+def test_retry_budget_runs_out(lb_config):
+    policy = RetryPolicy(lb_config(retry_budget_ratio=0.5, retry_budget_min_per_second=0), Metrics())
+    assert not policy.can_retry(True, True)
+    policy.start_request()
+    policy.start_request()
+    assert policy.can_retry(True, True)
+    assert not policy.can_retry(True, True)
+    assert policy.metrics.retries_throttled == 2
+
+async def test_slow_attempt_is_hedged_and_cancelled(lb_config):
+    primary, secondary = BackendServer('127.0.0.1', 9001), BackendServer('127.0.0.1', 9002)
+    cancelled = []
+
+    async def attempt(server):
+        if server is primary:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                cancelled.append(server)
+                raise
+        return server.port
+
+    async def discard(server, result):
+        raise AssertionError("nothing to discard")
+
+    policy = RetryPolicy(lb_config(hedge=True), Metrics())
+    assert await policy.hedge(0.01, attempt, primary, lambda: secondary, discard) == (secondary, 9002)
+    await asyncio.sleep(0)
+    assert cancelled == [primary]
+    assert (policy.metrics.hedges, policy.metrics.hedge_wins) == (1, 1)
+
+async def test_losing_attempt_that_finished_is_discarded(lb_config):
+    primary, secondary = BackendServer('127.0.0.1', 9001), BackendServer('127.0.0.1', 9002)
+    discarded = []
+
+    async def attempt(server):
+        if server is primary:
+            try:
+                await asyncio.sleep(1)
+            except asyncio.CancelledError:
+                # Its response arrived as it was cancelled, the connection still has to be let go
+                return "late"
+        return "won"
+
+    async def discard(server, result):
+        discarded.append((server, result))
+
+    policy = RetryPolicy(lb_config(hedge=True), Metrics())
+    assert await policy.hedge(0.01, attempt, primary, lambda: secondary, discard) == (secondary, "won")
+    for _ in range(3):
+        await asyncio.sleep(0)
+    await asyncio.gather(*policy.discarding)
+    assert discarded == [(primary, "late")]
+
+async def test_no_hedge_without_a_second_server(lb_config):
+    server = BackendServer('127.0.0.1', 9001)
+
+    async def attempt(server):
+        await asyncio.sleep(0.05)
+        return "done"
+
+    policy = RetryPolicy(lb_config(hedge=True), Metrics())
+    assert await policy.hedge(0.01, attempt, server, lambda: None, None) == (server, "done")
+    assert policy.metrics.hedges == 0
+
+async def test_proxy_retries_only_idempotent_requests(backend, balancer):
+    async def unavailable(method, path, headers, body):
+        return 503, [], b"unavailable"
+
+    async with backend(unavailable) as upstream, balancer(upstream, retries=2) as lb:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=lb.app), base_url="http://lb") as client:
+            await client.get("/get")
+            await client.post("/post", content=b"x")
+            await client.post("/keyed", content=b"x", headers={"Idempotency-Key": "1"})
+
+    paths = [path for _, path, _ in upstream.requests]
+    assert paths.count("/get") == 3
+    assert paths.count("/post") == 1
+    assert paths.count("/keyed") == 3
@@ -0,0 +1,67 @@
+import random, time
+import pytest
+from lb_algo import SLOW_START_MIN_FACTOR, LBAlgo
+from server import BackendServer
+
+def make_algo(slow_start: float = 100, mode: str = 'linear', count: int = 2):
+    servers = [BackendServer('127.0.0.1', 9000 + i) for i in range(count)]
+    return servers, LBAlgo(servers, set(servers), 'round-robin', slow_start=slow_start, slow_start_mode=mode)
+
+def recover(lb_algo: LBAlgo, server: BackendServer, seconds_ago: float) -> None:
+    lb_algo.on_health_change(server, False)
+    lb_algo.on_health_change(server, True)
+    lb_algo.ramping[server] = time.monotonic() - seconds_ago
+
+def share(lb_algo: LBAlgo, server: BackendServer, picks: int = 4000) -> float:
+    return sum(lb_algo.get_next_server() is server for _ in range(picks)) / picks
+
+def test_initial_servers_take_their_full_share():
+    servers, lb_algo = make_algo()
+    assert not lb_algo.ramping
+    assert share(lb_algo, servers[1]) == 0.5
+
+@pytest.mark.parametrize("mode, halfway", [("linear", (1 + SLOW_START_MIN_FACTOR) / 2), ("exponential", SLOW_START_MIN_FACTOR ** 0.5)])
+def test_ramp_factor(mode, halfway):
+    servers, lb_algo = make_algo(mode=mode)
+    recover(lb_algo, servers[1], 0)
+    now = lb_algo.ramping[servers[1]]
+    assert lb_algo.slow_start_factor(servers[1], now) == pytest.approx(SLOW_START_MIN_FACTOR)
+    assert lb_algo.slow_start_factor(servers[1], now + 50) == pytest.approx(halfway)
+    assert lb_algo.slow_start_factor(servers[1], now + 100) == 1.0
+
+def test_recovering_server_share_ramps_up():
+    random.seed(1)
+    servers, lb_algo = make_algo()
+    shares = []
+    for seconds_ago in (0, 50, 100):
+        recover(lb_algo, servers[1], seconds_ago)
+        shares.append(share(lb_algo, servers[1]))
+
+    # As if its weight was scaled by the ramp factor
+    for factor, ramped in zip((SLOW_START_MIN_FACTOR, (1 + SLOW_START_MIN_FACTOR) / 2), shares):
+        assert ramped == pytest.approx(factor / (1 + factor), abs=0.03)
+    assert shares[2] == 0.5
+    assert not lb_algo.ramping
+
+def test_every_server_ramping_takes_full_share():
+    servers, lb_algo = make_algo()
+    for server in servers:
+        recover(lb_algo, server, 0)
+    assert share(lb_algo, servers[1]) == 0.5
+
+async def test_initial_screen_does_not_ramp_and_recovery_prewarms(backend, balancer):
+    async with backend() as first, backend() as second, balancer(first, second, slow_start=30, prewarm_connections=2) as lb:
+        for server in list(lb.healthy_servers):
+            lb.healthchecker.set_server_health(server, False)
+        await lb.initial_health_screen()
+        assert lb.healthy_servers == set(lb.backend_servers)
+        assert not lb.lb_algo.ramping
+        # The screen runs before the prewarm hook is set, it only probes
+        assert [path for _, path, _ in second.requests] == ["/health"]
+
+        lb.healthchecker.prewarm = lb.prewarm
+        recovering = lb.backend_servers[1]
+        lb.healthchecker.set_server_health(recovering, False)
+        await lb.healthchecker.mark_healthy(recovering)
+        assert recovering in lb.healthy_servers and recovering in lb.lb_algo.ramping
+        assert [path for _, path, _ in second.requests] == ["/health"] * 3
@@ -0,0 +1,98 @@
+import httpx
+from lb_algo import LBAlgo
+from metrics import Metrics
+from server import BackendServer
+from sticky_sessions import SLOT_BITS, StickySessions
+
+def make_sessions(lb_config, mode: str = 'cookie', **overrides):
+    servers = [BackendServer('127.0.0.1', 9000 + i) for i in range(2)]
+    lb_algo = LBAlgo(servers, set(servers), 'round-robin')
+    sessions = StickySessions(servers, lb_algo, lb_config(sticky_sessions=mode, **overrides), Metrics())
+    return servers, lb_algo, sessions
+
+def cookie(token: bytes):
+    return [(b"cookie", b"theme=dark; lb_session=" + token)]
+
+def test_issued_token_pins_the_session(lb_config):
+    servers, _, sessions = make_sessions(lb_config)
+    token = sessions.pin(None, servers[1])
+    assert sessions.token_header(token)[0] == b"set-cookie"
+
+    session = sessions.get_session(cookie(token))
+    assert sessions.lookup(session) is servers[1]
+    # Still valid, nothing new to issue
+    assert sessions.pin(session, servers[1]) is None
+    assert sessions.metrics.sticky_hits == 1
+
+def test_header_mode(lb_config):
+    servers, _, sessions = make_sessions(lb_config, 'header')
+    token = sessions.pin(None, servers[0])
+    name, value = sessions.token_header(token)
+    assert (name, value) == (b"x-lb-session", token)
+    assert sessions.lookup(sessions.get_session([(b"X-LB-Session", token)])) is servers[0]
+
+def test_malformed_and_forged_tokens_are_rejected(lb_config):
+    servers, _, sessions = make_sessions(lb_config)
+    token = sessions.pin(None, servers[0])
+    session = int(token, 16)
+    slot = session & ((1 << SLOT_BITS) - 1)
+
+    assert sessions.get_session(cookie(b"not-hex")) is None
+    assert sessions.get_session(cookie(b"f" * 25)) is None
+    # Beyond the table
+    assert sessions.get_session(cookie(b"%x" % ((1 << SLOT_BITS) | 1024))) is None
+    # Nonce 0 is what slots that were never used hold
+    assert sessions.get_session(cookie(b"%x" % (slot + 1))) is None
+    # Right slot, wrong nonce
+    forged = sessions.get_session(cookie(b"%x" % (session ^ (1 << SLOT_BITS))))
+    assert sessions.lookup(forged) is None
+
+def test_sessions_expire_after_ttl(lb_config):
+    servers, _, sessions = make_sessions(lb_config, sticky_ttl=60)
+    session = int(sessions.pin(None, servers[0]), 16)
+    slot = session & ((1 << SLOT_BITS) - 1)
+    sessions.last_used[slot] -= 61
+    assert sessions.lookup(session) is None
+
+def test_unhealthy_server_is_repinned_without_a_new_token(lb_config):
+    servers, lb_algo, sessions = make_sessions(lb_config)
+    session = int(sessions.pin(None, servers[0]), 16)
+    lb_algo.on_health_change(servers[0], False)
+    assert sessions.lookup(session) is None
+
+    assert sessions.pin(session, servers[1]) is None
+    assert sessions.lookup(session) is servers[1]
+    assert sessions.metrics.sticky_repinned == 1
+
+def test_only_the_owning_partition_repins(lb_config):
+    servers, _, sessions = make_sessions(lb_config)
+    sessions.set_partition(0, 2)
+    session = int(sessions.pin(None, servers[0]), 16)
+
+    sessions.set_partition(1, 2)
+    token = sessions.pin(session, servers[1])
+    # A new session from this worker's share, the other worker's slot is left alone
+    assert token is not None
+    assert sessions.lookup(session) is servers[0]
+    new_slot = int(token, 16) & ((1 << SLOT_BITS) - 1)
+    assert sessions.start <= new_slot < sessions.end
+    assert sessions.metrics.sticky_repinned == 0
+
+def test_full_table_reuses_a_slot(lb_config):
+    servers, _, sessions = make_sessions(lb_config, sticky_max_sessions=4)
+    tokens = [sessions.pin(None, servers[0]) for _ in range(4)]
+    assert sessions.pin(None, servers[1]) is not None
+
+    # One sampled session made room, it was still live so it counts as an eviction
+    assert sum(sessions.lookup(int(token, 16)) is None for token in tokens) == 1
+    assert sessions.metrics.sticky_slots_used == 4
+    assert sessions.metrics.sticky_evicted == 1
+
+async def test_cache_misses_follow_the_pinned_backend(backend, balancer):
+    async with backend() as first, backend() as second, balancer(first, second, cache=True, proxy_mode='streaming', sticky_sessions='cookie') as lb:
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=lb.app), base_url="http://lb") as client:
+            # Not storable, so every request is a cache miss that goes upstream
+            for _ in range(6):
+                await client.get("/a")
+
+    assert sorted([len(first.requests), len(second.requests)]) == [0, 6]